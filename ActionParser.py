@@ -0,0 +1,70 @@
+import re
+
+
+class ActionParser:
+    """
+    Incrementally strips ``[ACTION: ...]`` tags from a streamed response.
+
+    Text is fed in chunks as it arrives. Everything that cannot be part of a tag is released immediately for
+    display, while a possible tag is held back until its closing bracket shows whether it is one.
+    """
+
+    TAG_PREFIX = "[ACTION: "
+    TAG_PATTERN = re.compile(r"\[ACTION: (.*?); BOOK_TITLE: (.*?); AUTHOR: (.*?); GENRE: (.*?)\]")
+
+    def __init__(self):
+        """
+        Initialize an ActionParser object.
+        """
+        self._buffer = ""
+
+    def feed(self, chunk):
+        """
+        Consume the next chunk of the response.
+
+        :param chunk: The next piece of the response text.
+        :type chunk: str
+
+        :return: The text that can be displayed so far, and the ``(action, title, author, genre)`` tuples of every
+                 tag that closed in this chunk.
+        :rtype: tuple
+        """
+        self._buffer += chunk
+        text = []
+        actions = []
+        while self._buffer:
+            start = self._buffer.find("[")
+            if start == -1:
+                text.append(self._buffer)
+                self._buffer = ""
+                break
+            text.append(self._buffer[:start])
+            self._buffer = self._buffer[start:]
+
+            if not self.TAG_PREFIX.startswith(self._buffer[:len(self.TAG_PREFIX)]):
+                # Not a tag after all, release the bracket and keep scanning
+                text.append(self._buffer[0])
+                self._buffer = self._buffer[1:]
+                continue
+
+            end = self._buffer.find("]")
+            if end == -1:
+                # Possibly an unfinished tag, wait for more text
+                break
+            match = self.TAG_PATTERN.fullmatch(self._buffer[:end + 1])
+            if match:
+                actions.append(match.groups())
+            else:
+                text.append(self._buffer[:end + 1])
+            self._buffer = self._buffer[end + 1:]
+        return "".join(text), actions
+
+    def close(self):
+        """
+        Finish the response, releasing any text held back as a possible tag.
+
+        :return: The remaining text.
+        :rtype: str
+        """
+        text, self._buffer = self._buffer, ""
+        return text
@@ -0,0 +1,78 @@
+import Config
+from AsyncElasticsearchManager import AsyncElasticsearchManager
+from CartManager import CartManager
+
+
+class AsyncCartManager:
+    """
+    Manages interactions with the Elasticsearch index for shopping carts without blocking the event loop.
+
+    Stores the same per-session documents as :class:`CartManager`.
+    """
+
+    DEFAULT_SESSION = CartManager.DEFAULT_SESSION
+
+    def __init__(self, es_manager=None):
+        """
+        Initialize an AsyncCartManager object.
+
+        :param es_manager: The async Elasticsearch manager to use, or None to create one.
+        :type es_manager: AsyncElasticsearchManager
+        """
+        self.es_manager = es_manager or AsyncElasticsearchManager()
+        self.index = AsyncElasticsearchManager.CART_INDEX_NAME
+
+    async def add(self, title, session_id=DEFAULT_SESSION):
+        """
+        Add a book to the shopping cart. Adding a book already in the cart leaves a single item.
+
+        :param title: The title of the book to add.
+        :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.es_manager.put(self.index, CartManager.item_id(session_id, title),
+                                  CartManager.item(session_id, title), routing=session_id, refresh="wait_for")
+
+    async def remove(self, title, session_id=DEFAULT_SESSION):
+        """
+        Remove a book from the shopping cart. Removing a book not in the cart does nothing.
+
+        :param title: The title of the book to remove.
+        :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.es_manager.delete_by_id(self.index, CartManager.item_id(session_id, title), routing=session_id,
+                                           refresh="wait_for")
+
+    async def get_cart(self, session_id=DEFAULT_SESSION):
+        """
+        Retrieve all items from the shopping cart, oldest first.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+
+        :return: A list of items in the shopping cart.
+        :rtype: list
+        """
+        return await self.es_manager.get_by_term(self.index, "session_id", session_id, routing=session_id,
+                                                 size=Config.CART_MAX_ITEMS, sort=[{"added_at": "asc"}])
+
+    async def iter_cart(self, session_id=DEFAULT_SESSION, page_size=None):
+        """
+        Iterate over every item in the shopping cart, oldest first. See :meth:`CartManager.iter_cart`.
+        """
+        hits = self.es_manager.iter_all(self.index, query={"term": {"session_id": session_id}},
+                                        page_size=page_size, sort=[{"added_at": "asc"}], routing=session_id)
+        async for hit in hits:
+            yield hit["_source"]
+
+    async def clear(self, session_id=DEFAULT_SESSION):
+        """
+        Clear all items from the shopping cart.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.es_manager.delete_by_term(self.index, "session_id", session_id, routing=session_id, refresh=True)
@@ -0,0 +1,540 @@
+import asyncio
+import queue
+import threading
+import time
+
+import Config
+import Telemetry
+from dotenv import load_dotenv
+from ActionParser import ActionParser
+from AsyncCartManager import AsyncCartManager
+from AsyncElasticsearchManager import AsyncElasticsearchManager
+from CartManager import CartManager
+from Chatbot import Chatbot, default_llm
+from ElasticsearchManager import ElasticsearchManager
+from IntentRouter import IntentRouter
+from LRUCache import LRUCache
+from ConversationMemory import ConversationMemory
+from SemanticCache import SemanticCache
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+class AsyncChatbot:
+    """
+    An asyncio version of :class:`Chatbot`.
+
+    Every network call is awaited instead of blocking a thread, and the cart is fetched while the LLM is still
+    responding, so one process can serve many concurrent sessions.
+    """
+
+    CART_ACTIONS = Chatbot.CART_ACTIONS
+
+    def __init__(self, es_manager=None, cart_manager=None, router=None, response_cache=None, llm=None):
+        """
+        Initialize an AsyncChatbot object.
+
+        :param es_manager: The async Elasticsearch manager to use, or None to create one.
+        :type es_manager: AsyncElasticsearchManager
+        :param cart_manager: The async cart manager to use, or None to create one.
+        :type cart_manager: AsyncCartManager
+        :param router: The local intent router to use, or None to create one if ROUTER_ENABLED is set.
+        :type router: IntentRouter
+        :param response_cache: The semantic response cache to use, or None to create one if SEMANTIC_CACHE_ENABLED
+                               is set.
+        :type response_cache: SemanticCache
+        :param llm: The client chat completions are requested from, or None for the ``openai`` module, imported
+                    on first use.
+        :type llm: module
+        """
+        self.es = es_manager or AsyncElasticsearchManager()
+        self.cart_manager = cart_manager or AsyncCartManager(self.es)
+        # Last cart read from Elasticsearch per session; re-read only after an action changes it
+        self.carts = LRUCache(max_size=Config.CART_CACHE_SESSIONS)
+        self.memory = ConversationMemory()
+        if response_cache is None and Config.SEMANTIC_CACHE_ENABLED:
+            response_cache = SemanticCache()
+        self.response_cache = response_cache
+        if router is None and Config.ROUTER_ENABLED:
+            router = IntentRouter(self._match_values)
+        self.router = router
+        # The event loop routing runs for, on which the router's catalog lookups are awaited
+        self._loop = None
+        self._llm = llm
+
+    @property
+    def llm(self):
+        """
+        The client chat completions are requested from.
+        """
+        if self._llm is None:
+            self._llm = default_llm()
+        return self._llm
+
+    async def handle_query(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
+        """
+        Handle a user query.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param query: The user's query.
+        :type query: str
+        :param session_id: The session of the conversation, which owns the cart.
+        :type session_id: str
+        :param report: A dict to fill in with details of the turn, or None. ``turn`` is set to the spans of the
+                       turn, as described by Telemetry.Turn.breakdown, and, if the LLM is asked, ``prompt`` to the
+                       size of the prompt, as reported by ConversationMemory.afit.
+        :type report: dict
+
+        :return: Updated list of messages, response, and shopping cart items.
+        :rtype: tuple
+        """
+        with Telemetry.record_turn() as turn, Telemetry.span("chat.turn"):
+            cart_task = self._prefetch_cart(session_id)
+            query_lower = query.lower()
+            routed = await self.route(messages, query_lower)
+            if routed is None:
+                messages, response = await self.generate_response(messages, query_lower, report=report)
+                routed = Chatbot.extract_action(response)
+            result = await self._complete_turn(messages, session_id, cart_task, *routed)
+        if report is not None:
+            report["turn"] = turn.breakdown()
+        return result
+
+    async def _complete_turn(self, messages, session_id, cart_task, action, title, author, genre, response):
+        """
+        Carry out the action of a turn and read the cart if needed.
+
+        :return: Updated list of messages, response, and shopping cart items.
+        :rtype: tuple
+        """
+        search_response = await self.dispatch_action(action, title, author, genre, session_id)
+        if action == "Search":
+            response += search_response
+            # Ensure the response is part of the conversation history
+            messages.append({"role": "assistant", "content": response})
+
+        return messages, response, await self._refresh_cart(session_id, [action], cart_task)
+
+    def _match_values(self, field, text, size):
+        """
+        Look up catalog values for the router, which runs on a worker thread, with the async client on the loop.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.es.match_values(ElasticsearchManager.BOOKS_INDEX_NAME, field, text, size), self._loop)
+        return future.result()
+
+    @Telemetry.traced("chat.route")
+    async def route(self, messages, query):
+        """
+        Answer a query with the local intent router, if it recognizes it. See :meth:`Chatbot.route`.
+
+        Routing embeds text, which is CPU-bound, so it runs off the event loop; its queries of the books index are
+        sent back to the loop and awaited with the async client.
+        """
+        if self.router is None:
+            return None
+        self._loop = asyncio.get_running_loop()
+        routed = await asyncio.to_thread(self.router.route, query)
+        Telemetry.annotate(routed=routed is not None)
+        if routed is None:
+            return None
+        messages.append({"role": "user", "content": query})
+        messages.append({"role": "assistant",
+                         "content": f"{routed[-1]} {IntentRouter.format_action_tag(*routed[:-1])}"})
+        return routed
+
+    async def handle_query_stream(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
+        """
+        Handle a user query, yielding the response as it is generated.
+
+        See :meth:`Chatbot.handle_query_stream`; actions run as tasks on the event loop as soon as their tags close.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param query: The user's query.
+        :type query: str
+        :param session_id: The session of the conversation, which owns the cart.
+        :type session_id: str
+        :param report: A dict to fill in with details of the turn, or None. ``turn`` is set to the spans of the
+                       turn, as described by Telemetry.Turn.breakdown, and, if the LLM is asked, ``prompt`` to the
+                       size of the prompt, as reported by ConversationMemory.afit.
+        :type report: dict
+
+        :return: An async generator of response text chunks.
+        :rtype: async_generator
+        """
+        with Telemetry.record_turn() as turn:
+            with Telemetry.span("chat.turn", current=False):
+                async for chunk in self._stream_turn(messages, query, session_id, report):
+                    yield chunk
+            if report is not None:
+                report["turn"] = turn.breakdown()
+
+    async def _stream_turn(self, messages, query, session_id, report):
+        """
+        Carry out a turn for :meth:`handle_query_stream`.
+        """
+        cart_task = self._prefetch_cart(session_id)
+        query_lower = query.lower()
+        routed = await self.route(messages, query_lower)
+        if routed is not None:
+            messages, response, carts = await self._complete_turn(messages, session_id, cart_task, *routed)
+            yield response
+            return
+
+        parser = ActionParser()
+        dispatched = []
+        # The latest cart action; cart actions run one after the other, in the order of their tags
+        last_cart_action = None
+        response = ""
+        async for chunk in self.stream_response(messages, query_lower, report=report):
+            text, actions = parser.feed(chunk)
+            for action in actions:
+                previous = last_cart_action if action[0] in self.CART_ACTIONS else None
+                task = asyncio.create_task(self._dispatch_after(previous, *action, session_id))
+                if action[0] in self.CART_ACTIONS:
+                    last_cart_action = task
+                dispatched.append((action[0], task))
+            if text:
+                response += text
+                yield text
+        text = parser.close()
+        if text:
+            response += text
+            yield text
+
+        searched = False
+        for action, task in dispatched:
+            search_response = await task
+            if action == "Search":
+                searched = True
+                response += search_response
+                yield search_response
+        if searched:
+            # Ensure the response is part of the conversation history
+            messages.append({"role": "assistant", "content": response})
+
+        await self._refresh_cart(session_id, [action for action, task in dispatched], cart_task)
+
+    async def _dispatch_after(self, previous, action, title, author, genre, session_id):
+        """
+        Carry out an action once the task of the previous one, if any, is done. See :meth:`dispatch_action`.
+        """
+        if previous is not None:
+            await previous
+        return await self.dispatch_action(action, title, author, genre, session_id)
+
+    @Telemetry.traced("chat.dispatch_action")
+    async def dispatch_action(self, action, title, author, genre, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Carry out an action extracted from a response.
+
+        :param action: The action name, e.g. "Search" or "Add_to_Cart".
+        :type action: str
+        :param title: The book title of the action.
+        :type title: str
+        :param author: The author of the action.
+        :type author: str
+        :param genre: The genre of the action.
+        :type genre: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+
+        :return: Text to append to the response; empty for anything but a search.
+        :rtype: str
+        """
+        Telemetry.annotate(action=action)
+        if action == "Search":
+            books = await self.es.search_book(title=title, author=author, genre=genre)
+            return Chatbot.format_search_results(books)
+        elif action == "Add_to_Cart":
+            await self.add_to_cart(title, session_id)
+        elif action == "Remove_from_Cart":
+            await self.remove_from_cart(title, session_id)
+        elif action == "Clear_Cart":
+            await self.remove_all(session_id)
+        return ""
+
+    def _prefetch_cart(self, session_id):
+        """
+        Start reading the cart of a session in the background if it has not been read yet.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+
+        :return: The task reading the cart, or None.
+        :rtype: asyncio.Task
+        """
+        if self.carts.get(session_id) is None:
+            return asyncio.create_task(self.cart_manager.get_cart(session_id))
+        return None
+
+    async def get_cart(self, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Return the cart of a session, reading it only if it is not known yet.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+
+        :return: A list of items in the shopping cart.
+        :rtype: list
+        """
+        return await self._refresh_cart(session_id, [], self._prefetch_cart(session_id))
+
+    async def _refresh_cart(self, session_id, actions, cart_task):
+        """
+        Re-read the cart if one of the actions changed it, otherwise use the prefetched or known cart.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        :param actions: The actions dispatched this turn.
+        :type actions: list
+        :param cart_task: The task started by :meth:`_prefetch_cart`, or None.
+        :type cart_task: asyncio.Task
+
+        :return: The cart of the session.
+        :rtype: list
+        """
+        if any(action in self.CART_ACTIONS for action in actions):
+            if cart_task is not None:
+                cart_task.cancel()
+            # Cart writes wait for a refresh, so this read already sees them
+            carts = await self.cart_manager.get_cart(session_id)
+        elif cart_task is not None:
+            carts = await cart_task
+        else:
+            return self.carts.get(session_id)
+        self.carts.put(session_id, carts)
+        return carts
+
+    async def add_to_cart(self, title, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Add an item to the shopping cart.
+
+        :param title: The title of the item to add.
+        :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.cart_manager.add(title, session_id)
+
+    async def remove_from_cart(self, title, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Remove an item from the shopping cart.
+
+        :param title: The title of the item to remove.
+        :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.cart_manager.remove(title, session_id)
+
+    async def remove_all(self, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Remove all items from the shopping cart.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        await self.cart_manager.clear(session_id)
+
+    @Telemetry.traced("chat.generate_response")
+    async def generate_response(self, messages, user_query, temperature=0.7, report=None):
+        """
+        Generate a response to a user query.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param user_query: The user's query.
+        :type user_query: str
+        :param temperature: Controls the randomness of the response.
+        :type temperature: float
+        :param report: A dict whose ``prompt`` is set to the size of the prompt if the LLM is asked, or None.
+        :type report: dict
+
+        :return: Updated list of messages and the generated response.
+        :rtype: tuple
+        """
+        messages.append({"role": "user", "content": user_query})
+        # Taken before the messages are compacted, so that the response is stored under the key it is looked up by
+        fingerprint = self._fingerprint(messages)
+        ai_response = await self._cached_response(fingerprint, user_query)
+        Telemetry.annotate(cache_hit=ai_response is not None)
+        if ai_response is None:
+            prompt_report = await self.memory.afit(messages, self.summarize)
+            if report is not None:
+                report["prompt"] = prompt_report
+
+            started = time.perf_counter()
+            with Telemetry.span("openai.chat_completion", model="gpt-4",
+                                prompt_tokens=prompt_report["prompt_tokens"]) as record:
+                completion = await self.llm.ChatCompletion.acreate(model="gpt-4",
+                                                                   messages=messages,
+                                                                   temperature=temperature)
+
+                ai_response = completion.choices[0].message.content
+                record.set(completion_tokens=self.memory.count_text(ai_response))
+            await self._store_response(fingerprint, user_query, ai_response, time.perf_counter() - started)
+        messages.append({"role": "assistant", "content": ai_response})
+
+        return messages, ai_response
+
+    @Telemetry.traced("chat.summarize")
+    async def summarize(self, request):
+        """
+        Fold old conversation turns into the rolling summary.
+
+        :param request: The summarization request built by ConversationMemory.
+        :type request: list
+
+        :return: The new summary.
+        :rtype: str
+        """
+        completion = await self.llm.ChatCompletion.acreate(model=Config.SUMMARY_MODEL,
+                                                           messages=request,
+                                                           temperature=0,
+                                                           max_tokens=self.memory.summary_max_tokens)
+        return completion.choices[0].message.content
+
+    @Telemetry.traced("chat.stream_response")
+    async def stream_response(self, messages, user_query, temperature=0.7, report=None):
+        """
+        Generate a response to a user query, yielding it as it arrives.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param user_query: The user's query.
+        :type user_query: str
+        :param temperature: Controls the randomness of the response.
+        :type temperature: float
+        :param report: A dict whose ``prompt`` is set to the size of the prompt if the LLM is asked, or None.
+        :type report: dict
+
+        :return: An async generator of response text chunks.
+        :rtype: async_generator
+        """
+        messages.append({"role": "user", "content": user_query})
+        # Taken before the messages are compacted, so that the response is stored under the key it is looked up by
+        fingerprint = self._fingerprint(messages)
+        ai_response = await self._cached_response(fingerprint, user_query)
+        if ai_response is not None:
+            messages.append({"role": "assistant", "content": ai_response})
+            yield ai_response
+            return
+        prompt_report = await self.memory.afit(messages, self.summarize)
+        if report is not None:
+            report["prompt"] = prompt_report
+
+        started = time.perf_counter()
+        # Kept open across yields, so not the current span
+        with Telemetry.span("openai.chat_completion", current=False, model="gpt-4", stream=True,
+                            prompt_tokens=prompt_report["prompt_tokens"]) as record:
+            completion = await self.llm.ChatCompletion.acreate(model="gpt-4",
+                                                               messages=messages,
+                                                               temperature=temperature,
+                                                               stream=True)
+
+            chunks = []
+            async for chunk in completion:
+                content = chunk.choices[0].delta.get("content")
+                if content:
+                    if not chunks:
+                        record.set(first_token_ms=round((time.perf_counter() - started) * 1000.0, 2))
+                    chunks.append(content)
+                    yield content
+            ai_response = "".join(chunks)
+            record.set(completion_tokens=self.memory.count_text(ai_response))
+        await self._store_response(fingerprint, user_query, ai_response, time.perf_counter() - started)
+        messages.append({"role": "assistant", "content": ai_response})
+
+    def _fingerprint(self, messages):
+        """
+        Identify the conversation of the latest query for the response cache. See :meth:`Chatbot._fingerprint`.
+        """
+        if self.response_cache is None:
+            return None
+        return SemanticCache.fingerprint(messages[:-1])
+
+    async def _cached_response(self, fingerprint, user_query):
+        """
+        Look up a cached response to a query similar to ``user_query``, embedding it off the event loop.
+
+        :return: The cached response, or None.
+        :rtype: str
+        """
+        if self.response_cache is None:
+            return None
+        return await asyncio.to_thread(self.response_cache.lookup, user_query, fingerprint)
+
+    async def _store_response(self, fingerprint, user_query, ai_response, latency):
+        """
+        Offer a fresh LLM response to the response cache, embedding it off the event loop.
+        """
+        if self.response_cache is not None:
+            await asyncio.to_thread(self.response_cache.store, user_query, fingerprint, ai_response, latency)
+
+
+class SyncChatbot:
+    """
+    A blocking front end to :class:`AsyncChatbot` with the same interface as :class:`Chatbot`.
+
+    The async chatbot runs on an event loop in a background thread, so callers like the Streamlit app can use it
+    from ordinary synchronous code.
+    """
+
+    _DONE = object()
+
+    def __init__(self):
+        """
+        Initialize a SyncChatbot object and start its event loop.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chatbot-loop", daemon=True)
+        self._thread.start()
+        self._chatbot = self._run(self._create())
+
+    @staticmethod
+    async def _create():
+        chatbot = AsyncChatbot()
+        await chatbot.es.create_indices()
+        return chatbot
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    @property
+    def response_cache(self):
+        return self._chatbot.response_cache
+
+    def handle_query(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
+        """
+        Handle a user query. See :meth:`AsyncChatbot.handle_query`.
+        """
+        return self._run(self._chatbot.handle_query(messages, query, session_id, report))
+
+    def get_cart(self, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Return the cart of a session. See :meth:`AsyncChatbot.get_cart`.
+        """
+        return self._run(self._chatbot.get_cart(session_id))
+
+    def handle_query_stream(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
+        """
+        Handle a user query, yielding the response as it is generated. See :meth:`AsyncChatbot.handle_query_stream`.
+        """
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self._chatbot.handle_query_stream(messages, query, session_id, report):
+                    chunks.put(chunk)
+            finally:
+                chunks.put(self._DONE)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        while (chunk := chunks.get()) is not self._DONE:
+            yield chunk
+        # Re-raise any error from the async side
+        future.result()
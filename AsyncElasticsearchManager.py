@@ -0,0 +1,262 @@
+import asyncio
+
+import Config
+import Telemetry
+from ElasticsearchManager import ElasticsearchManager, serializer_options
+from Vectorizer import Vectorizer
+
+_clients = {}
+
+
+def get_async_client():
+    """
+    Return the async Elasticsearch client shared by the running event loop, creating it on first use.
+
+    Async clients are bound to the loop they were created in, so each loop gets its own, configured like
+    :func:`ElasticsearchManager.get_client`.
+
+    :return: The shared async Elasticsearch client.
+    :rtype: AsyncElasticsearch
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        from elasticsearch import AsyncElasticsearch
+
+        client = AsyncElasticsearch(
+            hosts=Config.ES_HOSTS,
+            basic_auth=(Config.ES_USERNAME, Config.ES_PASSWORD),
+            verify_certs=Config.ES_VERIFY_CERTS,
+            request_timeout=Config.ES_REQUEST_TIMEOUT,
+            max_retries=Config.ES_MAX_RETRIES,
+            retry_on_timeout=Config.ES_RETRY_ON_TIMEOUT,
+            retry_on_status=(429, 502, 503, 504),
+            connections_per_node=Config.ES_CONNECTIONS_PER_NODE,
+            dead_node_backoff_factor=Config.ES_BACKOFF_FACTOR,
+            max_dead_node_backoff=Config.ES_MAX_BACKOFF,
+            **serializer_options()
+        )
+        _clients[loop] = client
+    return client
+
+
+@Telemetry.instrument("async_elasticsearch")
+class AsyncElasticsearchManager:
+    """
+    Manages interactions with Elasticsearch indices for books and the shopping cart without blocking the event loop.
+
+    Mirrors the query-side methods of :class:`ElasticsearchManager`; methods are coroutines. Every public method
+    runs in a Telemetry span named ``async_elasticsearch.<method>``.
+    """
+
+    BOOKS_INDEX_NAME = ElasticsearchManager.BOOKS_INDEX_NAME
+    CART_INDEX_NAME = ElasticsearchManager.CART_INDEX_NAME
+
+    def __init__(self, dimension=384, es=None):
+        """
+        Initialize an AsyncElasticsearchManager object. Call :meth:`create_indices` once before first use.
+
+        :param dimension: The dimension of the dense vectors.
+        :type dimension: int
+        :param es: The async Elasticsearch client to use, or None for the client shared by the running loop.
+        :type es: AsyncElasticsearch
+        """
+        self._es = es
+        self.dimension = dimension
+        self.vectorizer = Vectorizer()
+
+    @property
+    def es(self):
+        if self._es is None:
+            self._es = get_async_client()
+        return self._es
+
+    async def create_indices(self):
+        """
+        Create the books and cart indices if they do not exist yet.
+        """
+        for index_name, mapping in ElasticsearchManager.index_mappings(self.dimension).items():
+            await self.es.options(ignore_status=400).indices.create(index=index_name, body=mapping)
+
+    async def index(self, index_name, document, refresh=None):
+        """
+        Index a document into the specified Elasticsearch index.
+
+        :param index_name: The name of the index to index the document into.
+        :type index_name: str
+        :param document: The document to be indexed.
+        :type document: dict
+        :param refresh: "wait_for" to return only once the document is visible to search, or None not to wait.
+        :type refresh: str
+
+        :return: Response of the index operation, including the ``_id`` of the new document.
+        :rtype: dict
+        """
+        response = await self.es.index(index=index_name, body=document, refresh=refresh)
+        ElasticsearchManager.invalidate_search_cache(index_name)
+        return response
+
+    async def put(self, index_name, document_id, document, routing=None, refresh=None):
+        """
+        Create or overwrite the document with the given id. See :meth:`ElasticsearchManager.put`.
+        """
+        response = await self.es.index(index=index_name, id=document_id, document=document, routing=routing,
+                                       refresh=refresh)
+        ElasticsearchManager.invalidate_search_cache(index_name)
+        return response
+
+    async def delete_by_id(self, index_name, document_id, routing=None, refresh=None):
+        """
+        Delete the document with the given id, if it exists. See :meth:`ElasticsearchManager.delete_by_id`.
+        """
+        response = await self.es.options(ignore_status=404).delete(index=index_name, id=document_id,
+                                                                    routing=routing, refresh=refresh)
+        ElasticsearchManager.invalidate_search_cache(index_name)
+        return response
+
+    async def get_by_term(self, index_name, field, value, routing=None, size=100, sort=None):
+        """
+        Retrieve the documents whose keyword field equals a value. See :meth:`ElasticsearchManager.get_by_term`.
+        """
+        response = await self.es.search(index=index_name, query={"term": {field: value}}, routing=routing,
+                                        size=size, sort=sort)
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    async def delete_by_term(self, index_name, field, value, routing=None, refresh=False):
+        """
+        Delete the documents whose keyword field equals a value. See :meth:`ElasticsearchManager.delete_by_term`.
+        """
+        await self.es.delete_by_query(index=index_name, query={"term": {field: value}}, routing=routing,
+                                      wait_for_completion=True, refresh=refresh)
+        ElasticsearchManager.invalidate_search_cache(index_name)
+
+    async def search(self, index_name, query):
+        """
+        Search documents in the specified Elasticsearch index based on a query.
+
+        :param index_name: The name of the index to search.
+        :type index_name: str
+        :param query: The query string.
+        :type query: str
+
+        :return: List of documents matching the query.
+        :rtype: list
+        """
+        response = await self.es.search(index=index_name, query={"multi_match": {"query": query, "fields": ["title"]}})
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    async def match_values(self, index_name, field, text, size=Config.ROUTER_CANDIDATES):
+        """
+        Find the distinct values of a text field that best match a text. See :meth:`ElasticsearchManager.match_values`.
+        """
+        query = {"match": {field: {"query": text, "fuzziness": "AUTO"}}}
+        response = await self.es.search(index=index_name, query=query, size=size, source=[field])
+        return ElasticsearchManager.distinct_values(response["hits"]["hits"], field)
+
+    async def get_all(self, index_name, source=None, size=50):
+        """
+        Retrieve the first documents of the specified Elasticsearch index, at most ``size`` of them.
+        See :meth:`ElasticsearchManager.get_all`.
+        """
+        if source is None:
+            source = {"excludes": ["vector"]}
+        response = await self.es.search(index=index_name, query={"match_all": {}}, size=size, source=source)
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    async def iter_all(self, index_name, query=None, page_size=None, source=True, sort=None, routing=None):
+        """
+        Iterate over the documents of the specified Elasticsearch index, one page at a time.
+        See :meth:`ElasticsearchManager.iter_all`.
+        """
+        response = await self.es.open_point_in_time(index=index_name, keep_alive=Config.PIT_KEEP_ALIVE,
+                                                    routing=routing)
+        pit_id = response["id"]
+        search_after = None
+        try:
+            while True:
+                response = await self.es.search(**ElasticsearchManager.page_request(
+                    pit_id, query, page_size, source, sort, search_after))
+                hits = response["hits"]["hits"]
+                for hit in hits:
+                    yield hit
+                if len(hits) < (page_size or Config.PAGE_SIZE):
+                    return
+                pit_id = response.get("pit_id", pit_id)
+                search_after = hits[-1]["sort"]
+        finally:
+            await self.es.close_point_in_time(id=pit_id)
+
+    async def delete(self, index_name, title, refresh=None):
+        """
+        Delete a document from the specified Elasticsearch index based on its title.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param title: The title of the document to delete.
+        :type title: str
+        :param refresh: "wait_for" to return only once the deletion is visible to search, or None not to wait.
+        :type refresh: str
+
+        :return: Response indicating the status of the delete operation.
+        :rtype: dict or str
+        """
+        query = {"query": {"match": {"title": title}}}
+        search_resp = await self.es.search(index=index_name, body=query, size=1)
+        if search_resp['hits']['hits']:
+            document_id = search_resp['hits']['hits'][0]['_id']
+            response = await self.es.delete(index=index_name, id=document_id, refresh=refresh)
+            ElasticsearchManager.invalidate_search_cache(index_name)
+            return response
+        else:
+            return "Document not found."
+
+    async def clear(self, index_name, refresh=False):
+        """
+        Clear all documents from the specified Elasticsearch index.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param refresh: Whether to refresh the index so the deletions are visible to search on return.
+        :type refresh: bool
+        """
+        await self.es.delete_by_query(index=index_name, body={"query": {"match_all": {}}},
+                                      wait_for_completion=True, refresh=refresh)
+        ElasticsearchManager.invalidate_search_cache(index_name)
+
+    async def search_book(self, title, author, genre, hybrid=None):
+        """
+        Search books by title, author and genre, falling back to the books closest to the keywords.
+
+        See :meth:`ElasticsearchManager.search_book`; both managers share the same result cache.
+
+        :param title: The title of the book, or None.
+        :type title: str
+        :param author: The author of the book, or None.
+        :type author: str
+        :param genre: The genre of the book, or None.
+        :type genre: str
+        :param hybrid: Whether to use hybrid retrieval for the fallback, or None to follow the SEARCH_MODE setting.
+        :type hybrid: bool
+
+        :return: List of documents matching the query, with fallback search in other fields if necessary.
+        :rtype: list
+        """
+        hybrid = Config.SEARCH_MODE == "hybrid" if hybrid is None else hybrid
+        query, fallback_query = ElasticsearchManager.search_book_queries(title, author, genre)
+        if query is None:
+            return []
+
+        key = ElasticsearchManager.search_book_key(title, author, genre, hybrid)
+        books = ElasticsearchManager.search_cache.get(key)
+        Telemetry.annotate(cache_hit=books is not None)
+        if books is None:
+            query_vector = None
+            if hybrid:
+                # Embedding is CPU-bound, keep it off the event loop
+                query_vector = await asyncio.to_thread(self.vectorizer.vectorize,
+                                                       fallback_query["multi_match"]["query"])
+            searches = ElasticsearchManager.search_book_msearch(query, fallback_query, query_vector)
+            responses = (await self.es.msearch(searches=searches))["responses"]
+            books = ElasticsearchManager.search_book_results(responses)
+            ElasticsearchManager.search_cache.put(key, books)
+        return books
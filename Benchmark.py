@@ -0,0 +1,356 @@
+"""
+This script measures the throughput and latency of BookWise Bot's hot paths and reports them as JSON.
+
+It runs offline. InMemoryElasticsearchManager stands in for Elasticsearch and FakeOpenAI for the OpenAI API.
+Catalogs are synthetic and given random vectors. Numbers from different commits are comparable when the
+benchmark runs on the same machine with the same arguments.
+
+It covers:
+
+* ``vectorize``: texts embedded per second, one text per call and in batches.
+* ``ingest``: books per second through Ingest.py, including embedding them.
+* ``search``: p50/p99 latency of ``search_book`` and ``search_vector`` at every catalog size.
+* ``chat``: end-to-end latency of ``Chatbot.handle_query``, plus the time to first chunk of
+  ``Chatbot.handle_query_stream``, with the LLM answering after ``--llm-latency`` seconds.
+
+The vectorize and ingest benchmarks load the embedding model, which must already be in the local Hugging Face
+cache. Pass ``--fake-embeddings`` to embed ingested rows and chat queries with FakeVectorizer instead; the
+vectorize benchmark is then skipped.
+
+Usage::
+
+    python Benchmark.py --output benchmark.json
+    python Benchmark.py --only search chat --sizes 1000 100000 --fake-embeddings
+"""
+
+import argparse
+import csv
+import functools
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import Config
+from Book import Book
+from BookManager import BookManager
+from Chatbot import Chatbot
+from EmbeddingCache import EmbeddingCache
+from FakeOpenAI import FakeOpenAI
+from FakeVectorizer import FakeVectorizer
+from InMemoryElasticsearchManager import InMemoryElasticsearchManager
+from Ingest import ingest
+from IntentRouter import IntentRouter
+from SemanticCache import SemanticCache
+from Vectorizer import Vectorizer
+
+BENCHMARKS = ("vectorize", "ingest", "search", "chat")
+
+_SYLLABLES = ["an", "bel", "cor", "da", "el", "fen", "gar", "hol", "is", "jor", "ka", "lin", "mor", "nel", "or",
+              "pra", "quin", "ros", "sa", "tor", "ul", "ven", "wil", "xan", "yor", "zel"]
+_GENRES = ["Classic", "Fantasy", "Fiction", "History", "Psychology", "Biography", "Science", "Computer Science",
+           "Mystery", "Romance", "Thriller", "Poetry", "Philosophy", "Travel", "Cooking", "Horror"]
+
+
+def summarize_latencies(latencies):
+    """
+    Summarize latencies in seconds as milliseconds.
+
+    :param latencies: The measured latencies.
+    :type latencies: list
+
+    :return: The count, mean, p50 and p99 of the latencies.
+    :rtype: dict
+    """
+    milliseconds = np.asarray(latencies, dtype=np.float64) * 1000.0
+    return {
+        "count": len(latencies),
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+    }
+
+
+def time_calls(function, arguments):
+    """
+    Call a function once per argument tuple and time each call.
+
+    :return: The latency of every call, in seconds.
+    :rtype: list
+    """
+    latencies = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def synthetic_rows(count, seed=0):
+    """
+    Generate catalog rows with made-up titles and authors.
+
+    :param count: The number of rows.
+    :type count: int
+    :param seed: The seed of the random generator, so that runs see the same catalog.
+    :type seed: int
+
+    :return: A list of ``(title, author, genre)`` tuples.
+    :rtype: list
+    """
+    rng = np.random.default_rng(seed)
+
+    def word():
+        return "".join(rng.choice(_SYLLABLES, size=rng.integers(2, 4))).capitalize()
+
+    return [(" ".join(word() for _ in range(rng.integers(1, 5))), f"{word()} {word()}", str(rng.choice(_GENRES)))
+            for _ in range(count)]
+
+
+def build_catalog(es_manager, size, seed=0):
+    """
+    Fill the books index of an in-memory manager with a synthetic catalog with random vectors.
+
+    :return: The rows of the catalog.
+    :rtype: list
+    """
+    rows = synthetic_rows(size, seed)
+    vectors = np.random.default_rng(seed).standard_normal((size, es_manager.dimension), dtype=np.float32)
+    documents = ({"title": title, "author": author, "genre": genre, "vector": vector}
+                 for (title, author, genre), vector in zip(rows, vectors))
+    for ok, item in es_manager.bulk_index(es_manager.BOOKS_INDEX_NAME, documents):
+        pass
+    return rows
+
+
+def bench_vectorize(count, batch_size, backend=None):
+    """
+    Measure how many texts the embedding model encodes per second, with a cold embedding cache, and how closely
+    the backend agrees with the ``torch`` one.
+    """
+    texts = [f"{Book.combined_info(*row)} {number}" for number, row in enumerate(synthetic_rows(2 * count))]
+    Vectorizer(cache=EmbeddingCache(), backend=backend).vectorize("warm up")
+
+    single = Vectorizer(batch_size=batch_size, cache=EmbeddingCache(), backend=backend)
+    started = time.perf_counter()
+    for text in texts[:count]:
+        single.vectorize(text)
+    single_seconds = time.perf_counter() - started
+
+    batched = Vectorizer(batch_size=batch_size, cache=EmbeddingCache(), backend=backend)
+    started = time.perf_counter()
+    batched.vectorize_batch(texts[count:])
+    batched_seconds = time.perf_counter() - started
+
+    return {
+        "texts": count,
+        "batch_size": batch_size,
+        "backend": batched.backend,
+        "min_cosine_to_torch": batched.agreement(texts[:min(count, 64)]),
+        "single_texts_per_s": count / single_seconds,
+        "batched_texts_per_s": count / batched_seconds,
+    }
+
+
+def bench_ingest(count, batch_size, concurrency, vectorizer, workers=0):
+    """
+    Measure how many books per second Ingest.py reads, embeds and indexes.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalog.csv")
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["title", "author", "genre"])
+            writer.writerows(synthetic_rows(count))
+
+        book_manager = BookManager(es_manager=InMemoryElasticsearchManager(vectorizer=vectorizer))
+        started = time.perf_counter()
+        indexed = ingest(path, batch_size=batch_size, concurrency=concurrency, book_manager=book_manager,
+                         vectorizer=vectorizer, workers=workers)
+        seconds = time.perf_counter() - started
+
+    return {"books": indexed, "batch_size": batch_size, "workers": workers, "books_per_s": indexed / seconds}
+
+
+def bench_search(size, queries, seed=0):
+    """
+    Measure ``search_book`` and ``search_vector`` latency against a synthetic catalog of ``size`` books.
+
+    A quarter of the ``search_book`` queries each look up an existing title, an existing author, a genre, and
+    made-up keywords that usually match no book and so take the fallback path.
+    """
+    es_manager = InMemoryElasticsearchManager(vectorizer=FakeVectorizer())
+    started = time.perf_counter()
+    rows = build_catalog(es_manager, size, seed)
+    build_seconds = time.perf_counter() - started
+
+    rng = np.random.default_rng(seed + 1)
+    picks = [rows[index] for index in rng.integers(0, size, queries)]
+    misses = synthetic_rows(queries, seed + 2)
+    lookups = []
+    for number, ((title, author, genre), miss) in enumerate(zip(picks, misses)):
+        lookups.append([(title, None, None), (None, author, None), (None, None, genre),
+                        (miss[0], None, None)][number % 4])
+
+    results = {"books": size, "build_s": build_seconds}
+    for mode, hybrid in (("lexical", False), ("hybrid", True)):
+        results[f"search_book_{mode}"] = summarize_latencies(time_calls(
+            lambda title, author, genre: es_manager.search_book(title, author, genre, hybrid=hybrid), lookups))
+    query_vectors = rng.standard_normal((queries, es_manager.dimension), dtype=np.float32)
+    results["search_vector"] = summarize_latencies(time_calls(
+        lambda vector: es_manager.search_vector(es_manager.BOOKS_INDEX_NAME, vector), [(v,) for v in query_vectors]))
+    return results
+
+
+def chat_script(rows):
+    """
+    Build a conversation over a catalog, with the reply the fake LLM gives to each query.
+
+    :return: ``(query, reply)`` pairs.
+    :rtype: list
+    """
+    script = []
+    for title, author, genre in rows:
+        script += [
+            (f"Do you have {title}?",
+             f"Let me check. [ACTION: Search; BOOK_TITLE: {title}; AUTHOR: None; GENRE: None]"),
+            (f"Can you recommend a {genre.lower()} book?",
+             f"You might enjoy '{title}' by {author}. [ACTION: Search; BOOK_TITLE: None; AUTHOR: None; "
+             f"GENRE: {genre}]"),
+            (f"Add {title} to my cart",
+             f"I've added {title} to your cart. [ACTION: Add_to_Cart; BOOK_TITLE: {title}; AUTHOR: {author}; "
+             f"GENRE: {genre}]"),
+            ("What's your return policy?",
+             "Returns are accepted within 30 days in original condition. [ACTION: LAST_BOOK; "
+             f"BOOK_TITLE: {title}; AUTHOR: {author}; GENRE: {genre}]"),
+            (f"Remove {title} from my cart",
+             f"I've removed {title} from your cart. [ACTION: Remove_from_Cart; BOOK_TITLE: {title}; "
+             f"AUTHOR: {author}; GENRE: {genre}]"),
+        ]
+    return script
+
+
+def bench_chat(turns, llm_latency, vectorizer, catalog_size=1000, prompt_path="prompt.txt"):
+    """
+    Measure end-to-end chat turns against an in-memory catalog and a fake LLM.
+
+    Routing and the response cache follow the ROUTER_ENABLED and SEMANTIC_CACHE_ENABLED settings, so the numbers
+    reflect the configured pipeline.
+    """
+    es_manager = InMemoryElasticsearchManager(vectorizer=vectorizer)
+    rows = build_catalog(es_manager, catalog_size)
+    script = chat_script(rows[:turns // 5 + 1])[:turns]
+    replies = {query.lower(): reply for query, reply in script}
+    llm = FakeOpenAI(reply=lambda messages: replies.get(messages[-1]["content"], "How can I help you today?"),
+                     latency=llm_latency)
+
+    router = None
+    if Config.ROUTER_ENABLED:
+        router = IntentRouter(functools.partial(es_manager.match_values, es_manager.BOOKS_INDEX_NAME),
+                              vectorizer=vectorizer)
+    response_cache = SemanticCache(vectorizer=vectorizer) if Config.SEMANTIC_CACHE_ENABLED else None
+    chatbot = Chatbot(es_manager=es_manager, router=router, response_cache=response_cache, llm=llm)
+    with open(prompt_path, encoding="utf-8") as file:
+        system_prompt = file.read()
+
+    messages = [{"role": "system", "content": system_prompt}]
+    latencies = []
+    for query, reply in script:
+        started = time.perf_counter()
+        messages, response, carts = chatbot.handle_query(messages, query, session_id="benchmark")
+        latencies.append(time.perf_counter() - started)
+    llm_calls = llm.calls
+
+    messages = [{"role": "system", "content": system_prompt}]
+    first_chunk_latencies = []
+    stream_latencies = []
+    for query, reply in script:
+        started = time.perf_counter()
+        first_chunk = None
+        for chunk in chatbot.handle_query_stream(messages, query, session_id="benchmark-stream"):
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - started
+        stream_latencies.append(time.perf_counter() - started)
+        first_chunk_latencies.append(first_chunk if first_chunk is not None else stream_latencies[-1])
+
+    return {
+        "turns": len(script),
+        "llm_latency_s": llm_latency,
+        "llm_calls": llm_calls,
+        "handle_query": summarize_latencies(latencies),
+        "handle_query_stream": summarize_latencies(stream_latencies),
+        "handle_query_stream_first_chunk": summarize_latencies(first_chunk_latencies),
+    }
+
+
+def git_commit():
+    """
+    Return the commit being benchmarked, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark BookWise Bot offline and report the results as JSON.")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help="benchmarks to run")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000],
+                        help="catalog sizes of the search benchmark")
+    parser.add_argument("--queries", type=int, default=200, help="queries timed per catalog size")
+    parser.add_argument("--texts", type=int, default=256, help="texts embedded per vectorize mode")
+    parser.add_argument("--backend", choices=Vectorizer.BACKENDS,
+                        help="inference backend of the vectorize benchmark, by default VECTORIZER_BACKEND")
+    parser.add_argument("--ingest-books", type=int, default=2000, help="books loaded by the ingest benchmark")
+    parser.add_argument("--batch-size", type=int, default=Config.INGEST_BATCH_SIZE,
+                        help="texts per forward pass and books per _bulk request")
+    parser.add_argument("--concurrency", type=int, default=Config.INGEST_CONCURRENCY,
+                        help="_bulk requests in flight at once while ingesting")
+    parser.add_argument("--workers", type=int, default=Config.INGEST_WORKERS,
+                        help="worker processes embedding rows while ingesting")
+    parser.add_argument("--turns", type=int, default=50, help="chat turns timed")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the fake LLM takes per request")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="embed with FakeVectorizer instead of the model, and skip the vectorize benchmark")
+    parser.add_argument("--output", help="file to write the JSON report to, instead of standard output")
+    args = parser.parse_args()
+
+    vectorizer = FakeVectorizer() if args.fake_embeddings else Vectorizer()
+
+    results = {}
+    if "vectorize" in args.only and not args.fake_embeddings:
+        results["vectorize"] = bench_vectorize(args.texts, args.batch_size, args.backend)
+    if "ingest" in args.only:
+        results["ingest"] = bench_ingest(args.ingest_books, args.batch_size, args.concurrency, vectorizer,
+                                         args.workers)
+    if "search" in args.only:
+        results["search"] = [bench_search(size, args.queries) for size in args.sizes]
+    if "chat" in args.only:
+        results["chat"] = bench_chat(args.turns, args.llm_latency, vectorizer)
+
+    report = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": vars(args),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
+import hashlib
+import re
+
+import numpy as np
+
 from Vectorizer import Vectorizer
 
 
 class Book:
     """Represents a book entity with title, author, genre, and a vectorized representation."""
 
-    def __init__(self, title, author, genre):
+    __slots__ = ("title", "author", "genre", "vector")
+
+    def __init__(self, title, author, genre, vector=None):
         """
         Initialize a Book object.
 
@@ -14,22 +21,95 @@ class Book:
         :type author: str
         :param genre: The genre of the book.
         :type genre: str
+        :param vector: A precomputed vector for the book, or None to vectorize it here. It is kept as float32.
+        :type vector: numpy.ndarray
         """
         self.title = title
         self.author = author
         self.genre = genre
-        self.vector = Vectorizer()
 
-        # Combine book parameters into a single string
-        combined_info = f"{title} {author} {genre}"
+        if vector is None:
+            # Vectorize the combined book parameters
+            vector = Vectorizer().vectorize(self.combined_info(title, author, genre))
+        self.vector = np.asarray(vector, dtype=np.float32)
+
+    @staticmethod
+    def combined_info(title, author, genre):
+        """
+        Combine book parameters into the single string that gets vectorized.
+
+        :param title: The title of the book.
+        :type title: str
+        :param author: The author of the book.
+        :type author: str
+        :param genre: The genre of the book.
+        :type genre: str
+
+        :return: The combined string.
+        :rtype: str
+        """
+        return f"{title} {author} {genre}"
+
+    @staticmethod
+    def book_id(title, author):
+        """
+        Build the stable Elasticsearch id of a book, so that indexing it again overwrites it.
+
+        :param title: The title of the book.
+        :type title: str
+        :param author: The author of the book.
+        :type author: str
+
+        :return: A hex digest of the case-folded, whitespace-collapsed title and author.
+        :rtype: str
+        """
+        key = "\0".join(" ".join(value.casefold().split()) for value in (title, author))
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_book_id(doc_id):
+        """
+        Tell whether an id was built by :meth:`book_id`, rather than given at random by Elasticsearch to a book
+        indexed before ids were stable.
+
+        :param doc_id: The id of an indexed book.
+        :type doc_id: str
 
-        # Vectorize the combined string
-        self.vector = self.vector.vectorize(combined_info)
+        :return: True for a stable book id.
+        :rtype: bool
+        """
+        return re.fullmatch(r"[0-9a-f]{40}", doc_id) is not None
+
+    @staticmethod
+    def content_hash(title, author, genre):
+        """
+        Hash the fields a book is embedded from, to tell whether an indexed book is out of date.
+
+        :param title: The title of the book.
+        :type title: str
+        :param author: The author of the book.
+        :type author: str
+        :param genre: The genre of the book.
+        :type genre: str
+
+        :return: A hex digest of the exact title, author and genre.
+        :rtype: str
+        """
+        return hashlib.sha1(f"{title}\0{author}\0{genre}".encode("utf-8")).hexdigest()
+
+    @property
+    def id(self):
+        """
+        The stable Elasticsearch id of the book, see :meth:`book_id`.
+        """
+        return self.book_id(self.title, self.author)
 
     def to_dict(self):
         """
         Convert the book entity to a dictionary suitable for indexing in Elasticsearch.
 
+        The vector stays a float32 array; the Elasticsearch client encodes it when the request is sent.
+
         :return: A dictionary representing the book entity.
         :rtype: dict
         """
@@ -37,5 +117,6 @@ class Book:
             "title": self.title,
             "author": self.author,
             "genre": self.genre,
-            "vector": self.vector.tolist()
+            "content_hash": self.content_hash(self.title, self.author, self.genre),
+            "vector": self.vector
         }
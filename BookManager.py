@@ -1,34 +1,347 @@
+import itertools
+import json
+import os
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import Config
+from Book import Book
 from ElasticsearchManager import ElasticsearchManager
+from LocalVectorIndex import LocalVectorIndex
+from NeighbourTable import NeighbourTable
 
 
 class BookManager:
     """Manages interactions with the Elasticsearch index for books."""
 
-    def __init__(self):
+    def __init__(self, local_index=None, es_manager=None, neighbour_table=None):
         """
         Initialize a BookManager object.
+
+        :param local_index: A local vector index to serve recommendations from, or None to use the one configured
+                            by LOCAL_VECTOR_INDEX_PATH, if any.
+        :type local_index: LocalVectorIndex
+        :param es_manager: The Elasticsearch manager to use, or None to create one.
+        :type es_manager: ElasticsearchManager
+        :param neighbour_table: A table of precomputed recommendations, or None to use the one configured by
+                                NEIGHBOUR_TABLE_PATH, if any.
+        :type neighbour_table: NeighbourTable
         """
-        self.es_manager = ElasticsearchManager()
+        self.es_manager = es_manager or ElasticsearchManager()
         self.index = "books"
+        if local_index is None and Config.LOCAL_VECTOR_INDEX_PATH:
+            local_index = LocalVectorIndex(Config.LOCAL_VECTOR_INDEX_PATH, dimension=self.es_manager.dimension)
+        self.local_index = local_index
+        if neighbour_table is None and Config.NEIGHBOUR_TABLE_PATH:
+            neighbour_table = NeighbourTable(Config.NEIGHBOUR_TABLE_PATH, k=Config.NEIGHBOUR_TABLE_K)
+        self.neighbour_table = neighbour_table
 
     def index_book(self, book):
         """
-        Index a book in Elasticsearch.
+        Index a book in Elasticsearch under its stable id, replacing any earlier version of it.
+
+        The neighbour table is updated but not written to disk; call :meth:`save_neighbour_table` once the books
+        have been indexed.
 
         :param book: The book object to index.
         :type book: Book
         """
         book_dict = book.to_dict()
-        self.es_manager.index(self.index, book_dict)
+        response = self.es_manager.put(self.index, book.id, book_dict)
+        self._add_local([(response["_id"], book_dict, book.vector)])
+
+    def index_books(self, books, chunk_size=500, thread_count=1, save=True):
+        """
+        Index many books in Elasticsearch through the ``_bulk`` API, under their stable ids.
+
+        The neighbour table is written to disk once, after the last book, if ``save`` is set.
+
+        :param books: The book objects to index. May be a generator.
+        :type books: iterable
+        :param chunk_size: The number of books sent per ``_bulk`` request.
+        :type chunk_size: int
+        :param thread_count: The number of ``_bulk`` requests in flight at once.
+        :type thread_count: int
+        :param save: Whether to write the neighbour table to disk at the end.
+        :type save: bool
+
+        :return: A generator of ``(ok, item)`` results, one per book, in input order.
+        :rtype: generator
+        """
+        pending = deque()
+        local = self.local_index is not None or self.neighbour_table is not None
+
+        def actions():
+            for book in books:
+                book_dict = book.to_dict()
+                if local:
+                    pending.append((book_dict, book.vector))
+                yield {"_id": book.id, "_source": book_dict}
+
+        results = self.es_manager.bulk(self.index, actions(), chunk_size=chunk_size, thread_count=thread_count)
+        acknowledged = []
+        try:
+            for ok, item in results:
+                if local:
+                    book_dict, vector = pending.popleft()
+                    if ok:
+                        acknowledged.append((item["index"]["_id"], book_dict, vector))
+                    if len(acknowledged) >= chunk_size:
+                        self._add_local(acknowledged)
+                        acknowledged = []
+                yield ok, item
+        finally:
+            self._add_local(acknowledged)
+            if save:
+                self.save_neighbour_table()
+
+    def _add_local(self, documents):
+        """
+        Add acknowledged ``(doc_id, source, vector)`` tuples to the local vector index and the neighbour table.
+        """
+        if documents and self.local_index is not None:
+            self.local_index.add_many(documents)
+        if self.neighbour_table is not None:
+            self.neighbour_table.add_many(documents)
+
+    def save_neighbour_table(self):
+        """
+        Write the neighbour table to disk, if there is one.
+        """
+        if self.neighbour_table is not None:
+            self.neighbour_table.save()
+
+    def delete_books(self, book_ids, chunk_size=500, save=True):
+        """
+        Delete books from Elasticsearch through the ``_bulk`` API.
+
+        The neighbour table is written to disk once, after the last deletion, if ``save`` is set.
+
+        :param book_ids: The ids of the books to delete.
+        :type book_ids: iterable
+        :param chunk_size: The number of deletions sent per ``_bulk`` request.
+        :type chunk_size: int
+        :param save: Whether to write the neighbour table to disk at the end.
+        :type save: bool
+
+        :return: A generator of ``(ok, item)`` results, one per id, in input order.
+        :rtype: generator
+        """
+        actions = ({"_op_type": "delete", "_id": book_id} for book_id in book_ids)
+        deleted = []
+        try:
+            for ok, item in self.es_manager.bulk(self.index, actions, chunk_size=chunk_size):
+                if ok:
+                    deleted.append(item["delete"]["_id"])
+                yield ok, item
+        finally:
+            if self.local_index is not None:
+                self.local_index.remove_many(deleted)
+            if self.neighbour_table is not None:
+                self.neighbour_table.remove_many(deleted)
+            if save:
+                self.save_neighbour_table()
+
+    def sync_catalog(self, rows, batch_size=Config.INGEST_BATCH_SIZE, thread_count=1, vectorize_books=None,
+                     summary_path=None, max_delete_fraction=Config.SYNC_MAX_DELETE_FRACTION):
+        """
+        Make the books index match a catalog, writing only what changed since the last sync.
+
+        The ids and content hashes of the indexed books are read first. Rows whose book is missing or whose
+        content hash differs are embedded and upserted; rows whose book is unchanged are skipped without being
+        embedded. Indexed books absent from the catalog are deleted, including books indexed under random ids
+        before ids were stable, which are replaced by their rows.
+
+        So that an empty, truncated or mis-headed catalog file cannot wipe the index, nothing is deleted if no rows
+        were read. Otherwise books under random ids are always deleted, but books under stable ids missing from the
+        catalog are only deleted if they are at most ``max_delete_fraction`` of the books under stable ids; if they
+        are more, they are counted as ``delete_refused`` instead.
+
+        :param rows: The ``(title, author, genre)`` rows of the whole catalog. May be a generator.
+        :type rows: iterable
+        :param batch_size: The number of rows vectorized together, and of books sent per ``_bulk`` request.
+        :type batch_size: int
+        :param thread_count: The number of ``_bulk`` requests in flight at once.
+        :type thread_count: int
+        :param vectorize_books: A function turning rows into Book objects in input order, or None to vectorize
+                                ``batch_size`` rows at a time in this process.
+        :type vectorize_books: callable
+        :param summary_path: A file to write the summary to as JSON, or None not to write one.
+        :type summary_path: str
+        :param max_delete_fraction: The largest fraction of the indexed books deleted, 1 to allow deleting all
+                                    of them.
+        :type max_delete_fraction: float
+
+        :return: The number of books added, updated, deleted, unchanged, skipped as duplicate rows, failed and
+                 refused deletion, and when and for how long the sync ran.
+        :rtype: dict
+        """
+        started = time.perf_counter()
+        summary = {"started_at": datetime.now(timezone.utc).isoformat(), "added": 0, "updated": 0, "deleted": 0,
+                   "unchanged": 0, "duplicates": 0, "failed": 0, "delete_refused": 0}
+        indexed = {hit["_id"]: hit["_source"].get("content_hash")
+                   for hit in self.iter_books(fields=["content_hash"])}
+        seen = set()
+
+        def changed_rows():
+            for title, author, genre in rows:
+                book_id = Book.book_id(title, author)
+                if book_id in seen:
+                    summary["duplicates"] += 1
+                    continue
+                seen.add(book_id)
+                if indexed.get(book_id) == Book.content_hash(title, author, genre):
+                    summary["unchanged"] += 1
+                    continue
+                yield title, author, genre
+
+        books = (vectorize_books or self._vectorize_books)(changed_rows(), batch_size)
+        try:
+            for ok, item in self.index_books(books, chunk_size=batch_size, thread_count=thread_count, save=False):
+                if ok:
+                    summary["added" if item["index"]["result"] == "created" else "updated"] += 1
+                else:
+                    summary["failed"] += 1
+
+            removed = [book_id for book_id in indexed if book_id not in seen]
+            if seen:
+                legacy = [book_id for book_id in removed if not Book.is_book_id(book_id)]
+                stale = [book_id for book_id in removed if Book.is_book_id(book_id)]
+                stable_count = len(indexed) - len(legacy)
+                if len(stale) > max_delete_fraction * stable_count:
+                    summary["delete_refused"] = len(stale)
+                    stale = []
+                for ok, item in self.delete_books(legacy + stale, chunk_size=batch_size, save=False):
+                    summary["deleted" if ok else "failed"] += 1
+            else:
+                summary["delete_refused"] = len(removed)
+        finally:
+            self.save_neighbour_table()
 
-    def get_books(self):
+        summary["seconds"] = time.perf_counter() - started
+        if summary_path:
+            tmp_path = summary_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                json.dump(summary, file, indent=2)
+            os.replace(tmp_path, summary_path)
+        return summary
+
+    def _vectorize_books(self, rows, batch_size):
+        """
+        Turn rows into Book objects, vectorizing ``batch_size`` rows at a time with the manager's vectorizer.
         """
-        Retrieve all books from Elasticsearch.
+        iterator = iter(rows)
+        while batch := list(itertools.islice(iterator, batch_size)):
+            texts = [Book.combined_info(*row) for row in batch]
+            for (title, author, genre), vector in zip(batch, self.es_manager.vectorizer.vectorize_batch(texts)):
+                yield Book(title=title, author=author, genre=genre, vector=vector)
+
+    def get_refresh_interval(self):
+        """
+        Get the refresh interval of the books index.
+
+        :return: The refresh interval, or None if the index uses the cluster default.
+        :rtype: str
+        """
+        return self.es_manager.get_refresh_interval(self.index)
+
+    def set_refresh_interval(self, interval):
+        """
+        Set the refresh interval of the books index.
+
+        :param interval: The refresh interval, "-1" to disable refreshes, or None to restore the default.
+        :type interval: str
+        """
+        self.es_manager.set_refresh_interval(self.index, interval)
+
+    def sync_local_index(self, reembed=False):
+        """
+        Rebuild the local vector index from every book in Elasticsearch.
+
+        :param reembed: Whether to recompute the vectors if Elasticsearch does not keep them, see
+                        :meth:`iter_books`.
+        :type reembed: bool
+        """
+        self.local_index.sync(self.iter_books(vectors=True, reembed=reembed))
+
+    def build_neighbour_table(self, page_size=None, reembed=False):
+        """
+        Rebuild the neighbour table from every book in Elasticsearch, and write it to disk.
+
+        :param page_size: The number of books fetched and vectorized per request, or None for the default.
+        :type page_size: int
+        :param reembed: Whether to recompute the vectors if Elasticsearch does not keep them, see
+                        :meth:`iter_books`.
+        :type reembed: bool
+        """
+        hits = self.iter_books(page_size=page_size, vectors=True, reembed=reembed)
+        self.neighbour_table.build((hit["_id"], hit["_source"], hit["_source"]["vector"]) for hit in hits)
+        self.save_neighbour_table()
+
+    def refresh(self):
+        """
+        Make all books indexed so far visible to search.
+        """
+        self.es_manager.refresh(self.index)
+
+    def get_books(self, size=50):
+        """
+        Retrieve the first books from Elasticsearch, without their vectors. Use :meth:`iter_books` to go through
+        the whole catalog.
+
+        :param size: The maximum number of books returned.
+        :type size: int
 
         :return: A list of books.
         :rtype: list
         """
-        return self.es_manager.get_all(index_name=self.index)
+        return self.es_manager.get_all(index_name=self.index, size=size)
+
+    def iter_books(self, page_size=None, fields=None, vectors=False, reembed=False):
+        """
+        Iterate over every book in Elasticsearch in bounded memory.
+
+        :param page_size: The number of books fetched per request, or None for the default.
+        :type page_size: int
+        :param fields: The fields of each book to return, or None for all of them except the vector.
+        :type fields: list
+        :param vectors: Whether to add the vector of each book to its ``_source``. Vectors are read from
+                        Elasticsearch, which only keeps them if SOURCE_VECTORS was set when the books index was
+                        created.
+        :type vectors: bool
+        :param reembed: Whether to recompute the vectors from the title, author and genre with the current
+                        vectorizer if SOURCE_VECTORS is not set. See SOURCE_VECTORS in Config.py for the cost.
+        :type reembed: bool
+
+        :return: A generator of hits, each with ``_id`` and ``_source``.
+        :rtype: generator
+
+        :raises ValueError: If vectors are asked for, SOURCE_VECTORS is not set and ``reembed`` is not either.
+        """
+        if vectors and not Config.SOURCE_VECTORS and not reembed:
+            raise ValueError("Elasticsearch does not keep book vectors without SOURCE_VECTORS; "
+                             "re-embed the catalog explicitly to recompute them")
+        page_size = page_size or Config.PAGE_SIZE
+        source = fields or {"excludes": ["vector"]}
+        if vectors and Config.SOURCE_VECTORS:
+            source = list(fields) + ["vector"] if fields else True
+        hits = self.es_manager.iter_all(self.index, page_size=page_size, source=source)
+        if vectors and not Config.SOURCE_VECTORS:
+            hits = self._with_vectors(hits, page_size)
+        return hits
+
+    def _with_vectors(self, hits, batch_size):
+        """
+        Add recomputed vectors to hits read without them, vectorizing ``batch_size`` books at a time.
+        """
+        iterator = iter(hits)
+        while batch := list(itertools.islice(iterator, batch_size)):
+            texts = [Book.combined_info(hit["_source"]["title"], hit["_source"]["author"], hit["_source"]["genre"])
+                     for hit in batch]
+            for hit, vector in zip(batch, self.es_manager.vectorizer.vectorize_batch(texts)):
+                hit["_source"]["vector"] = vector
+                yield hit
 
     def search_books(self, query):
         """
@@ -42,23 +355,37 @@ class BookManager:
         """
         return self.es_manager.search(index_name=self.index, query=query)
 
-    def recommend_books(self, book):
+    def recommend_books(self, book, size=5, num_candidates=None, exact=False):
         """
         Recommend books similar to a given book based on vector similarity.
 
-        This method uses the vector representation of the provided book object and employs
-        Elasticsearch's script_score query to compute similarity scores with other books in
-        the database. It returns a list of books that are most similar to the given book,
-        based on their vector representations.
+        This method uses the vector representation of the provided book object and runs an
+        approximate kNN search over the HNSW-indexed vectors of the other books in the database.
+        It returns a list of books that are most similar to the given book, based on their
+        vector representations. If the manager has a local vector index, the search runs
+        in process against it instead, without a round trip to Elasticsearch. If the manager has
+        a neighbour table holding the book, its precomputed neighbours are returned without any
+        search; unlike a search, they never include the book itself.
 
         Parameters:
         - book (Book): The book object to find similar books to. This object must have a 'vector'
                        attribute that represents its combined title, author, and genre features.
+        - size (int): The number of books to return. Defaults to 5.
+        - num_candidates (int): The number of kNN candidates considered per shard, or None for the default.
+        - exact (bool): Whether to rescore the kNN candidates with their exact similarity, skipping the neighbour
+                        table. Defaults to False.
 
         Returns:
         - list: A list of dictionaries, where each dictionary represents a book similar to the given book.
-                Each dictionary contains keys like 'title', 'author', 'genre', and 'vector', detailing
-                the properties of the recommended books.
+                Each dictionary contains keys like 'title', 'author' and 'genre', detailing the
+                properties of the recommended books.
         """
 
-        return self.es_manager.search_vector(index_name=self.index, query_vector=book.vector)
+        if self.neighbour_table is not None and size <= self.neighbour_table.k and not exact:
+            hits = self.neighbour_table.lookup(book.id, size)
+            if hits is not None:
+                return hits
+        if self.local_index is not None:
+            return self.local_index.search(book.vector, k=size)
+        return self.es_manager.search_vector(index_name=self.index, query_vector=book.vector, size=size,
+                                             num_candidates=num_candidates, exact=exact)
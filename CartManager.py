@@ -1,63 +1,138 @@
+import hashlib
+from datetime import datetime, timezone
+
+import Config
 from ElasticsearchManager import ElasticsearchManager
-from Vectorizer import Vectorizer
 
 
 class CartManager:
-    """Manages interactions with the Elasticsearch index for the shopping cart."""
+    """
+    Manages interactions with the Elasticsearch index for shopping carts.
+
+    Every session has its own cart. A cart item is stored under an id derived from the session and the book, and
+    routed by session, so adding, removing and clearing are single idempotent writes and reading a cart only
+    touches one shard. Cart writes wait for an index refresh before returning, so the cart read right after a
+    write reflects it.
+    """
 
-    def __init__(self):
+    DEFAULT_SESSION = "default"
+
+    def __init__(self, es_manager=None):
         """
         Initialize a CartManager object.
+
+        :param es_manager: The Elasticsearch manager to use, or None to create one.
+        :type es_manager: ElasticsearchManager
         """
-        self.es_manager = ElasticsearchManager()
-        self.vectorize = Vectorizer()
-        self.index = "cart"
+        self.es_manager = es_manager or ElasticsearchManager()
+        self.index = ElasticsearchManager.CART_INDEX_NAME
 
-    def add(self, title):
+    @staticmethod
+    def book_key(title):
         """
-        Add a book to the shopping cart.
+        Identify a book in a cart by its normalized title.
 
-        :param title: The title of the book to add.
+        :param title: The title of the book.
+        :type title: str
+
+        :return: The title, case-folded with whitespace collapsed.
+        :rtype: str
+        """
+        return " ".join(title.casefold().split())
+
+    @classmethod
+    def item_id(cls, session_id, title):
+        """
+        Build the id of a cart item.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        :param title: The title of the book.
         :type title: str
+
+        :return: A hex digest of the session and the book key.
+        :rtype: str
+        """
+        return hashlib.sha1(f"{session_id}\0{cls.book_key(title)}".encode("utf-8")).hexdigest()
+
+    @classmethod
+    def item(cls, session_id, title):
         """
-        document = {
+        Build the document stored for a cart item.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        :param title: The title of the book.
+        :type title: str
+
+        :return: The cart item document.
+        :rtype: dict
+        """
+        return {
+            "session_id": session_id,
+            "book_key": cls.book_key(title),
             "title": title,
-            "vector": self.vectorize.vectorize(title).tolist()
+            "added_at": datetime.now(timezone.utc).isoformat()
         }
-        self.es_manager.index(self.index, document)
 
-    def remove(self, title):
+    def add(self, title, session_id=DEFAULT_SESSION):
         """
-        Remove a book from the shopping cart.
+        Add a book to the shopping cart. Adding a book already in the cart leaves a single item.
+
+        :param title: The title of the book to add.
+        :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        self.es_manager.put(self.index, self.item_id(session_id, title), self.item(session_id, title),
+                            routing=session_id, refresh="wait_for")
+
+    def remove(self, title, session_id=DEFAULT_SESSION):
+        """
+        Remove a book from the shopping cart. Removing a book not in the cart does nothing.
 
         :param title: The title of the book to remove.
         :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
         """
-        self.es_manager.delete(index_name=self.index, title=title)
+        self.es_manager.delete_by_id(self.index, self.item_id(session_id, title), routing=session_id,
+                                     refresh="wait_for")
 
-    def get_cart(self):
+    def get_cart(self, session_id=DEFAULT_SESSION):
         """
-        Retrieve all items from the shopping cart.
+        Retrieve all items from the shopping cart, oldest first.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
 
         :return: A list of items in the shopping cart.
         :rtype: list
         """
-        return self.es_manager.get_all(index_name=self.index)
+        return self.es_manager.get_by_term(self.index, "session_id", session_id, routing=session_id,
+                                           size=Config.CART_MAX_ITEMS, sort=[{"added_at": "asc"}])
 
-    def search_cart(self, query):
+    def iter_cart(self, session_id=DEFAULT_SESSION, page_size=None):
         """
-        Search for items in the shopping cart based on a query.
+        Iterate over every item in the shopping cart, oldest first, without the CART_MAX_ITEMS limit.
 
-        :param query: The query string to search for.
-        :type query: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        :param page_size: The number of items fetched per request, or None for the default.
+        :type page_size: int
 
-        :return: A list of items matching the query in the shopping cart.
-        :rtype: list
+        :return: A generator of items in the shopping cart.
+        :rtype: generator
         """
-        return self.es_manager.search(index_name=self.index, query=query)
+        hits = self.es_manager.iter_all(self.index, query={"term": {"session_id": session_id}}, page_size=page_size,
+                                        sort=[{"added_at": "asc"}], routing=session_id)
+        return (hit["_source"] for hit in hits)
 
-    def clear(self):
+    def clear(self, session_id=DEFAULT_SESSION):
         """
         Clear all items from the shopping cart.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
         """
-        return self.es_manager.clear(index_name=self.index)
+        self.es_manager.delete_by_term(self.index, "session_id", session_id, routing=session_id, refresh=True)
@@ -1,28 +1,87 @@
+import contextvars
+import functools
 import os
 import re
 import time
-import openai
+from concurrent.futures import ThreadPoolExecutor
 
+import Config
+import Telemetry
 from dotenv import load_dotenv
+from ActionParser import ActionParser
 from CartManager import CartManager
+from LRUCache import LRUCache
+from ConversationMemory import ConversationMemory
+from SemanticCache import SemanticCache
 from ElasticsearchManager import ElasticsearchManager
+from IntentRouter import IntentRouter
 
 # Load environment variables from .env file
 load_dotenv()
 
 
+def default_llm():
+    """
+    Import the ``openai`` module and configure it with the OPENAI_API_KEY environment variable.
+
+    It is imported on first use rather than with this module, which keeps importing the chatbot cheap.
+
+    :return: The ``openai`` module.
+    :rtype: module
+    """
+    import openai
+
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    return openai
+
+
 class Chatbot:
     """A chatbot capable of handling user queries and managing a shopping cart."""
 
-    def __init__(self):
+    CART_ACTIONS = ("Add_to_Cart", "Remove_from_Cart", "Clear_Cart")
+
+    def __init__(self, es_manager=None, cart_manager=None, router=None, response_cache=None, llm=None):
         """
         Initialize a Chatbot object by reading the OpenAI API key from a YAML file.
+
+        :param es_manager: The Elasticsearch manager to use, or None to create one.
+        :type es_manager: ElasticsearchManager
+        :param cart_manager: The cart manager to use, or None to create one.
+        :type cart_manager: CartManager
+        :param router: The local intent router to use, or None to create one if ROUTER_ENABLED is set.
+        :type router: IntentRouter
+        :param response_cache: The semantic response cache to use, or None to create one if SEMANTIC_CACHE_ENABLED
+                               is set.
+        :type response_cache: SemanticCache
+        :param llm: The client chat completions are requested from, or None for the ``openai`` module, imported
+                    on first use.
+        :type llm: module
         """
-        self.es = ElasticsearchManager()
-        self.cart_manager = CartManager()
-        openai.api_key = os.getenv("OPENAI_API_KEY")
+        self.es = es_manager or ElasticsearchManager()
+        self.cart_manager = cart_manager or CartManager(self.es)
+        # Last cart read from Elasticsearch per session; re-read only after an action changes it
+        self.carts = LRUCache(max_size=Config.CART_CACHE_SESSIONS)
+        # Runs actions while a streamed response is still arriving
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.memory = ConversationMemory()
+        if response_cache is None and Config.SEMANTIC_CACHE_ENABLED:
+            response_cache = SemanticCache()
+        self.response_cache = response_cache
+        if router is None and Config.ROUTER_ENABLED:
+            router = IntentRouter(functools.partial(self.es.match_values, ElasticsearchManager.BOOKS_INDEX_NAME))
+        self.router = router
+        self._llm = llm
 
-    def handle_query(self, messages, query):
+    @property
+    def llm(self):
+        """
+        The client chat completions are requested from.
+        """
+        if self._llm is None:
+            self._llm = default_llm()
+        return self._llm
+
+    def handle_query(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
         """
         Handle a user query.
 
@@ -30,75 +89,273 @@ class Chatbot:
         :type messages: list
         :param query: The user's query.
         :type query: str
+        :param session_id: The session of the conversation, which owns the cart.
+        :type session_id: str
+        :param report: A dict to fill in with details of the turn, or None. ``turn`` is set to the spans of the
+                       turn, as described by Telemetry.Turn.breakdown, and, if the LLM is asked, ``prompt`` to the
+                       size of the prompt, as reported by ConversationMemory.fit.
+        :type report: dict
 
         :return: Updated list of messages, response, and shopping cart items.
         :rtype: tuple
         """
-        query_lower = query.lower()
-        messages, response = self.generate_response(messages, query_lower)
-        action, title, author, genre, response = self.extract_action(response)
+        with Telemetry.record_turn() as turn, Telemetry.span("chat.turn"):
+            query_lower = query.lower()
+            routed = self.route(messages, query_lower)
+            if routed is None:
+                messages, response = self.generate_response(messages, query_lower, report=report)
+                routed = self.extract_action(response)
+            result = self._complete_turn(messages, session_id, *routed)
+        if report is not None:
+            report["turn"] = turn.breakdown()
+        return result
 
+    def _complete_turn(self, messages, session_id, action, title, author, genre, response):
+        """
+        Carry out the action of a turn and read the cart if needed.
+
+        :return: Updated list of messages, response, and shopping cart items.
+        :rtype: tuple
+        """
+        search_response = self.dispatch_action(action, title, author, genre, session_id)
         if action == "Search":
-            books = self.es.search_book(title=title, author=author, genre=genre)
-            num_books = len(books)
-
-            if num_books > 1:
-                # Format the book details into a string, each on a new line
-                books_details = "\n".join(
-                    [f"{idx + 1}. Title: {book['title']}, Author: {book['author']}, Genre: {book['genre']}"
-                     for idx, book in enumerate(books)])
-                response += f"\nI found multiple books:\n{books_details}\n\nWhich one do you mean?"
-            elif num_books == 1:
-                book = books[0]  # Get the single book found
-                response += f"\nI found the book: Title: {book['title']}, Author: {book['author']}, Genre: {book['genre']}. Would you like to add it to the cart?"
-            else:
-                response += "\nI couldn't find any books matching your criteria."
+            response += search_response
+            # Ensure the response is part of the conversation history
+            messages.append({"role": "assistant", "content": response})
+
+        return messages, response, self._refresh_cart(session_id, [action])
+
+    @Telemetry.traced("chat.route")
+    def route(self, messages, query):
+        """
+        Answer a query with the local intent router, if it recognizes it.
+
+        A routed turn is recorded in ``messages`` with the same action tag the LLM would have produced.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param query: The user's query, lower-cased.
+        :type query: str
 
+        :return: Action, book title, author, genre and response text, or None if the LLM should answer.
+        :rtype: tuple
+        """
+        if self.router is None:
+            return None
+        routed = self.router.route(query)
+        Telemetry.annotate(routed=routed is not None)
+        if routed is None:
+            return None
+        messages.append({"role": "user", "content": query})
+        messages.append({"role": "assistant",
+                         "content": f"{routed[-1]} {IntentRouter.format_action_tag(*routed[:-1])}"})
+        return routed
+
+    def handle_query_stream(self, messages, query, session_id=CartManager.DEFAULT_SESSION, report=None):
+        """
+        Handle a user query, yielding the response as it is generated.
+
+        Action tags are stripped from the streamed text, and each action is dispatched in the background as soon as
+        its tag closes, while the rest of the response is still streaming. Searches run concurrently, while cart
+        actions run one at a time in the order of their tags, so e.g. a clear followed by an add keeps the added
+        book. Search results are yielded once the response is complete. ``messages`` is updated in place, and
+        :meth:`get_cart` returns the updated cart afterwards without another round trip.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param query: The user's query.
+        :type query: str
+        :param session_id: The session of the conversation, which owns the cart.
+        :type session_id: str
+        :param report: A dict to fill in with details of the turn, or None. ``turn`` is set to the spans of the
+                       turn, as described by Telemetry.Turn.breakdown, and, if the LLM is asked, ``prompt`` to the
+                       size of the prompt, as reported by ConversationMemory.fit.
+        :type report: dict
+
+        :return: A generator of response text chunks.
+        :rtype: generator
+        """
+        with Telemetry.record_turn() as turn:
+            with Telemetry.span("chat.turn", current=False):
+                yield from self._stream_turn(messages, query, session_id, report)
+            if report is not None:
+                report["turn"] = turn.breakdown()
+
+    def _stream_turn(self, messages, query, session_id, report):
+        """
+        Carry out a turn for :meth:`handle_query_stream`.
+        """
+        query_lower = query.lower()
+        routed = self.route(messages, query_lower)
+        if routed is not None:
+            messages, response, carts = self._complete_turn(messages, session_id, *routed)
+            yield response
+            return
+
+        parser = ActionParser()
+        dispatched = []
+        # The latest cart action; cart actions run one after the other, in the order of their tags
+        last_cart_action = None
+        response = ""
+        for chunk in self.stream_response(messages, query_lower, report=report):
+            text, actions = parser.feed(chunk)
+            for action in actions:
+                previous = last_cart_action if action[0] in self.CART_ACTIONS else None
+                # Run in a copy of this context, so the action's spans are recorded with the turn
+                future = self.executor.submit(contextvars.copy_context().run, self._dispatch_after, previous,
+                                              *action, session_id)
+                if action[0] in self.CART_ACTIONS:
+                    last_cart_action = future
+                dispatched.append((action[0], future))
+            if text:
+                response += text
+                yield text
+        text = parser.close()
+        if text:
+            response += text
+            yield text
+
+        searched = False
+        for action, future in dispatched:
+            search_response = future.result()
+            if action == "Search":
+                searched = True
+                response += search_response
+                yield search_response
+        if searched:
             # Ensure the response is part of the conversation history
             messages.append({"role": "assistant", "content": response})
+
+        self._refresh_cart(session_id, [action for action, future in dispatched])
+
+    def _dispatch_after(self, previous, action, title, author, genre, session_id):
+        """
+        Carry out an action once the future of the previous one, if any, is done. See :meth:`dispatch_action`.
+        """
+        if previous is not None:
+            previous.result()
+        return self.dispatch_action(action, title, author, genre, session_id)
+
+    @Telemetry.traced("chat.dispatch_action")
+    def dispatch_action(self, action, title, author, genre, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Carry out an action extracted from a response.
+
+        :param action: The action name, e.g. "Search" or "Add_to_Cart".
+        :type action: str
+        :param title: The book title of the action.
+        :type title: str
+        :param author: The author of the action.
+        :type author: str
+        :param genre: The genre of the action.
+        :type genre: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
+
+        :return: Text to append to the response; empty for anything but a search.
+        :rtype: str
+        """
+        Telemetry.annotate(action=action)
+        if action == "Search":
+            books = self.es.search_book(title=title, author=author, genre=genre)
+            return self.format_search_results(books)
         elif action == "Add_to_Cart":
-            self.add_to_cart(title)
+            self.add_to_cart(title, session_id)
         elif action == "Remove_from_Cart":
-            self.remove_from_cart(title)
+            self.remove_from_cart(title, session_id)
         elif action == "Clear_Cart":
-            self.remove_all()
+            self.remove_all(session_id)
+        return ""
+
+    @staticmethod
+    def format_search_results(books):
+        """
+        Describe the books found by a search.
+
+        :param books: The books found.
+        :type books: list
 
-        time.sleep(1)
-        carts = self.cart_manager.get_cart()
+        :return: Text to append to the response.
+        :rtype: str
+        """
+        num_books = len(books)
+
+        if num_books > 1:
+            # Format the book details into a string, each on a new line
+            books_details = "\n".join(
+                [f"{idx + 1}. Title: {book['title']}, Author: {book['author']}, Genre: {book['genre']}"
+                 for idx, book in enumerate(books)])
+            return f"\nI found multiple books:\n{books_details}\n\nWhich one do you mean?"
+        elif num_books == 1:
+            book = books[0]  # Get the single book found
+            return f"\nI found the book: Title: {book['title']}, Author: {book['author']}, Genre: {book['genre']}. Would you like to add it to the cart?"
+        else:
+            return "\nI couldn't find any books matching your criteria."
+
+    def get_cart(self, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Return the cart of a session, reading it only if it is not known yet.
 
-        return messages, response, carts
+        :param session_id: The session owning the cart.
+        :type session_id: str
 
-    def add_to_cart(self, title):
+        :return: A list of items in the shopping cart.
+        :rtype: list
+        """
+        return self._refresh_cart(session_id, [])
+
+    def _refresh_cart(self, session_id, actions):
+        """
+        Re-read the cart of a session if it has not been read yet or one of the actions changed it.
+
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        :param actions: The actions dispatched this turn.
+        :type actions: list
+
+        :return: The cart of the session.
+        :rtype: list
+        """
+        carts = self.carts.get(session_id)
+        if carts is None or any(action in self.CART_ACTIONS for action in actions):
+            # Cart writes wait for a refresh, so this read already sees them
+            carts = self.cart_manager.get_cart(session_id)
+            self.carts.put(session_id, carts)
+        return carts
+
+    def add_to_cart(self, title, session_id=CartManager.DEFAULT_SESSION):
         """
         Add an item to the shopping cart.
 
         :param title: The title of the item to add.
         :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
         """
-        search_results = self.cart_manager.search_cart(title)
-        if search_results:
-            return f"Item {title} already in our database."
+        self.cart_manager.add(title, session_id)
 
-        self.cart_manager.add(title)
-
-    def remove_from_cart(self, title):
+    def remove_from_cart(self, title, session_id=CartManager.DEFAULT_SESSION):
         """
         Remove an item from the shopping cart.
 
         :param title: The title of the item to remove.
         :type title: str
+        :param session_id: The session owning the cart.
+        :type session_id: str
         """
-        search_results = self.cart_manager.search_cart(title)
-        if not search_results:
-            return f"Item {title} not found in our database."
+        self.cart_manager.remove(title, session_id)
 
-        self.cart_manager.remove(title)
+    def remove_all(self, session_id=CartManager.DEFAULT_SESSION):
+        """
+        Remove all items from the shopping cart.
 
-    def remove_all(self):
-        """Remove all items from the shopping cart."""
-        self.cart_manager.clear()
+        :param session_id: The session owning the cart.
+        :type session_id: str
+        """
+        self.cart_manager.clear(session_id)
 
-    def generate_response(self, messages, user_query, temperature=0.7):
+    @Telemetry.traced("chat.generate_response")
+    def generate_response(self, messages, user_query, temperature=0.7, report=None):
         """
         Generate a response to a user query.
 
@@ -108,22 +365,138 @@ class Chatbot:
         :type user_query: str
         :param temperature: Controls the randomness of the response.
         :type temperature: float
+        :param report: A dict whose ``prompt`` is set to the size of the prompt if the LLM is asked, or None.
+        :type report: dict
 
         :return: Updated list of messages and the generated response.
         :rtype: tuple
         """
         messages.append({"role": "user", "content": user_query})
+        # Taken before the messages are compacted, so that the response is stored under the key it is looked up by
+        fingerprint = self._fingerprint(messages)
+        ai_response = self._cached_response(fingerprint, user_query)
+        Telemetry.annotate(cache_hit=ai_response is not None)
+        if ai_response is None:
+            prompt_report = self.memory.fit(messages, self.summarize)
+            if report is not None:
+                report["prompt"] = prompt_report
 
-        completion = openai.ChatCompletion.create(model="gpt-4",
-                                                  messages=messages,
-                                                  temperature=temperature)
+            started = time.perf_counter()
+            with Telemetry.span("openai.chat_completion", model="gpt-4",
+                                prompt_tokens=prompt_report["prompt_tokens"]) as record:
+                completion = self.llm.ChatCompletion.create(model="gpt-4",
+                                                            messages=messages,
+                                                            temperature=temperature)
 
-        ai_response = completion.choices[0].message.content
+                ai_response = completion.choices[0].message.content
+                record.set(completion_tokens=self.memory.count_text(ai_response))
+            self._store_response(fingerprint, user_query, ai_response, time.perf_counter() - started)
         messages.append({"role": "assistant", "content": ai_response})
 
         return messages, ai_response
 
-    def extract_action(self, text):
+    @Telemetry.traced("chat.stream_response")
+    def stream_response(self, messages, user_query, temperature=0.7, report=None):
+        """
+        Generate a response to a user query, yielding it as it arrives.
+
+        The user query is appended to ``messages`` before the request, and the full response after the last chunk.
+
+        :param messages: List of messages exchanged in the conversation.
+        :type messages: list
+        :param user_query: The user's query.
+        :type user_query: str
+        :param temperature: Controls the randomness of the response.
+        :type temperature: float
+        :param report: A dict whose ``prompt`` is set to the size of the prompt if the LLM is asked, or None.
+        :type report: dict
+
+        :return: A generator of response text chunks.
+        :rtype: generator
+        """
+        messages.append({"role": "user", "content": user_query})
+        # Taken before the messages are compacted, so that the response is stored under the key it is looked up by
+        fingerprint = self._fingerprint(messages)
+        ai_response = self._cached_response(fingerprint, user_query)
+        if ai_response is not None:
+            messages.append({"role": "assistant", "content": ai_response})
+            yield ai_response
+            return
+        prompt_report = self.memory.fit(messages, self.summarize)
+        if report is not None:
+            report["prompt"] = prompt_report
+
+        started = time.perf_counter()
+        # Kept open across yields, so not the current span
+        with Telemetry.span("openai.chat_completion", current=False, model="gpt-4", stream=True,
+                            prompt_tokens=prompt_report["prompt_tokens"]) as record:
+            completion = self.llm.ChatCompletion.create(model="gpt-4",
+                                                        messages=messages,
+                                                        temperature=temperature,
+                                                        stream=True)
+
+            chunks = []
+            for chunk in completion:
+                content = chunk.choices[0].delta.get("content")
+                if content:
+                    if not chunks:
+                        record.set(first_token_ms=round((time.perf_counter() - started) * 1000.0, 2))
+                    chunks.append(content)
+                    yield content
+            ai_response = "".join(chunks)
+            record.set(completion_tokens=self.memory.count_text(ai_response))
+        self._store_response(fingerprint, user_query, ai_response, time.perf_counter() - started)
+        messages.append({"role": "assistant", "content": ai_response})
+
+    def _fingerprint(self, messages):
+        """
+        Identify the conversation of the latest query for the response cache: every message before it.
+
+        :return: The fingerprint, or None without a response cache.
+        :rtype: str
+        """
+        if self.response_cache is None:
+            return None
+        return SemanticCache.fingerprint(messages[:-1])
+
+    def _cached_response(self, fingerprint, user_query):
+        """
+        Look up a cached response to a query similar to ``user_query``, asked in the same conversation.
+
+        :return: The cached response, or None.
+        :rtype: str
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.lookup(user_query, fingerprint)
+
+    def _store_response(self, fingerprint, user_query, ai_response, latency):
+        """
+        Offer a fresh LLM response to the response cache.
+        """
+        if self.response_cache is not None:
+            self.response_cache.store(user_query, fingerprint, ai_response, latency)
+
+    @Telemetry.traced("chat.summarize")
+    def summarize(self, request):
+        """
+        Fold old conversation turns into the rolling summary.
+
+        :param request: The summarization request built by ConversationMemory.
+        :type request: list
+
+        :return: The new summary.
+        :rtype: str
+        """
+        completion = self.llm.ChatCompletion.create(model=Config.SUMMARY_MODEL,
+                                                    messages=request,
+                                                    temperature=0,
+                                                    max_tokens=self.memory.summary_max_tokens)
+        return completion.choices[0].message.content
+
+    @staticmethod
+    @Telemetry.traced("chat.extract_action")
+    def extract_action(text):
         """
         Extract action and book title from text.
 
@@ -0,0 +1,143 @@
+"""
+Runtime settings for BookWise Bot.
+
+Every setting can be overridden with an environment variable of the same name, either exported in the shell or
+listed in the ``.env`` file.
+"""
+
+import os
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+
+def _int(name, default):
+    return int(os.getenv(name, default))
+
+
+def _float(name, default):
+    return float(os.getenv(name, default))
+
+
+def _bool(name, default):
+    return os.getenv(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+# Elasticsearch connection
+ES_HOSTS = os.getenv("ES_HOSTS", "https://localhost:9200").split(",")
+ES_USERNAME = os.getenv("ES_USERNAME", "elastic")
+ES_PASSWORD = os.getenv("ES_PASSWORD", "vozLjbIOWbriPTQnU8Mg")
+ES_VERIFY_CERTS = _bool("ES_VERIFY_CERTS", False)
+ES_REQUEST_TIMEOUT = _float("ES_REQUEST_TIMEOUT", 10)
+ES_MAX_RETRIES = _int("ES_MAX_RETRIES", 3)
+ES_RETRY_ON_TIMEOUT = _bool("ES_RETRY_ON_TIMEOUT", True)
+ES_CONNECTIONS_PER_NODE = _int("ES_CONNECTIONS_PER_NODE", 10)
+# Seconds a failed node is left out of rotation, doubling on each further failure up to the maximum
+ES_BACKOFF_FACTOR = _float("ES_BACKOFF_FACTOR", 1.0)
+ES_MAX_BACKOFF = _float("ES_MAX_BACKOFF", 30.0)
+
+
+# Catalog ingestion
+INGEST_BATCH_SIZE = _int("INGEST_BATCH_SIZE", 256)
+INGEST_CONCURRENCY = _int("INGEST_CONCURRENCY", 4)
+INGEST_REFRESH_INTERVAL = os.getenv("INGEST_REFRESH_INTERVAL", "-1")
+# Worker processes embedding catalog rows; 0 embeds in the loading process
+INGEST_WORKERS = _int("INGEST_WORKERS", 0)
+# Batches embedded or waiting to be indexed at once, per worker
+INGEST_PENDING_PER_WORKER = _int("INGEST_PENDING_PER_WORKER", 2)
+# Largest fraction of the books under stable ids a catalog sync deletes; a sync that would delete more deletes none
+# of them. Books under the random ids of older releases are always replaced.
+SYNC_MAX_DELETE_FRACTION = _float("SYNC_MAX_DELETE_FRACTION", 0.1)
+
+# Embedding cache
+EMBEDDING_CACHE_SIZE = _int("EMBEDDING_CACHE_SIZE", 10000)
+# Set to an empty string to keep embeddings in memory only
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite3")
+
+# Embedding model inference: "torch", "torch-int8", "onnx" or "onnx-int8", see Vectorizer.BACKENDS
+VECTORIZER_BACKEND = os.getenv("VECTORIZER_BACKEND", "torch")
+# Threads used by the inference backend; 0 keeps the library default
+VECTORIZER_THREADS = _int("VECTORIZER_THREADS", 0)
+# Directory the ONNX exports of the model are written to and loaded from
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+
+# Vector search over the books index
+VECTOR_SIMILARITY = os.getenv("VECTOR_SIMILARITY", "cosine")
+HNSW_M = _int("HNSW_M", 16)
+HNSW_EF_CONSTRUCTION = _int("HNSW_EF_CONSTRUCTION", 100)
+# "int8_hnsw" keeps a scalar-quantized copy of the vectors for the HNSW graph; "hnsw" searches the float vectors
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "int8_hnsw")
+# Keep vectors in the stored _source of books. Takes effect when the books index is created. Without them, _source
+# is much smaller, but rebuilding the local vector index or the neighbour table from Elasticsearch has to re-embed
+# every book with the current VECTORIZER_BACKEND, which must be asked for explicitly (reembed, --reembed). That
+# costs one model pass per book unless EMBEDDING_CACHE_PATH still holds the embeddings of that backend, and gives
+# vectors that differ slightly from the indexed ones if the books were embedded with another backend.
+SOURCE_VECTORS = _bool("SOURCE_VECTORS", False)
+KNN_NUM_CANDIDATES = _int("KNN_NUM_CANDIDATES", 100)
+
+# Local vector index used by BookManager.recommend_books; empty to always search Elasticsearch
+LOCAL_VECTOR_INDEX_PATH = os.getenv("LOCAL_VECTOR_INDEX_PATH", "")
+# Path prefix of the precomputed similar-books table, see NeighbourTable.py; empty to search on every call
+NEIGHBOUR_TABLE_PATH = os.getenv("NEIGHBOUR_TABLE_PATH", "")
+NEIGHBOUR_TABLE_K = _int("NEIGHBOUR_TABLE_K", 10)
+
+# Show chat responses token by token as they are generated
+STREAM_RESPONSES = _bool("STREAM_RESPONSES", True)
+
+# Serve the app with the asyncio chatbot running on a background event loop
+ASYNC_CHATBOT = _bool("ASYNC_CHATBOT", False)
+
+# Conversation memory
+CONVERSATION_TOKEN_BUDGET = _int("CONVERSATION_TOKEN_BUDGET", 3000)
+CONVERSATION_MIN_RECENT_MESSAGES = _int("CONVERSATION_MIN_RECENT_MESSAGES", 4)
+SUMMARY_MAX_TOKENS = _int("SUMMARY_MAX_TOKENS", 300)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+
+# Semantic cache of LLM responses
+SEMANTIC_CACHE_ENABLED = _bool("SEMANTIC_CACHE_ENABLED", True)
+SEMANTIC_CACHE_THRESHOLD = _float("SEMANTIC_CACHE_THRESHOLD", 0.92)
+SEMANTIC_CACHE_TTL = _int("SEMANTIC_CACHE_TTL", 3600)
+SEMANTIC_CACHE_SIZE = _int("SEMANTIC_CACHE_SIZE", 1000)
+
+# Local intent router answering simple commands without the LLM
+ROUTER_ENABLED = _bool("ROUTER_ENABLED", True)
+ROUTER_MATCH_THRESHOLD = _float("ROUTER_MATCH_THRESHOLD", 0.85)
+# Distinct catalog values a mentioned title, author or genre is resolved among, found by a match query
+ROUTER_CANDIDATES = _int("ROUTER_CANDIDATES", 20)
+
+# Cache of search_book results, cleared whenever the books index is written through this process
+SEARCH_CACHE_SIZE = _int("SEARCH_CACHE_SIZE", 1024)
+SEARCH_CACHE_TTL = _int("SEARCH_CACHE_TTL", 60)
+
+# "hybrid" fuses BM25 and kNN results when search_book finds no strict match; "lexical" uses BM25 only
+SEARCH_MODE = os.getenv("SEARCH_MODE", "hybrid")
+HYBRID_WINDOW = _int("HYBRID_WINDOW", 20)
+HYBRID_SIZE = _int("HYBRID_SIZE", 5)
+# Lowest similarity of a kNN fallback hit, in the VECTOR_SIMILARITY metric; for cosine, between -1 and 1
+HYBRID_MIN_SIMILARITY = _float("HYBRID_MIN_SIMILARITY", 0.5)
+RRF_RANK_CONSTANT = _int("RRF_RANK_CONSTANT", 60)
+
+# Shopping carts
+CART_MAX_ITEMS = _int("CART_MAX_ITEMS", 100)
+CART_CACHE_SESSIONS = _int("CART_CACHE_SESSIONS", 10000)
+
+# Paging through whole indices with a point in time
+PAGE_SIZE = _int("PAGE_SIZE", 1000)
+PIT_KEEP_ALIVE = os.getenv("PIT_KEEP_ALIVE", "1m")
+
+# Instrumentation: port serving Prometheus metrics at /metrics (0 disables it), OpenTelemetry traces if the
+# opentelemetry package is installed, and the per-turn timing breakdown in the app sidebar
+METRICS_PORT = _int("METRICS_PORT", 0)
+# Address the metrics server listens on; an empty string listens on every interface
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+OTEL_TRACING = _bool("OTEL_TRACING", False)
+DEBUG_SIDEBAR = _bool("DEBUG_SIDEBAR", False)
+
+# Load the model and connect to Elasticsearch on a background thread when the app starts, see Warmup.py;
+# failed steps are retried after the interval, in seconds
+WARMUP_ENABLED = _bool("WARMUP_ENABLED", True)
+WARMUP_RETRY_INTERVAL = _float("WARMUP_RETRY_INTERVAL", 5.0)
+# Port the app serves /ready and /metrics on if METRICS_PORT is 0; 0 serves neither
+WARMUP_READY_PORT = _int("WARMUP_READY_PORT", 0)
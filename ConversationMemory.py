@@ -0,0 +1,189 @@
+import Config
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - token counts fall back to an estimate
+    tiktoken = None
+
+
+class ConversationMemory:
+    """
+    Keeps the messages sent to the LLM within a token budget.
+
+    The first system message (the prompt) is pinned. Recent turns are kept verbatim for as long as they fit the
+    budget, and older turns are folded into a single rolling summary message placed right after the prompt.
+    The memory itself holds no conversation state: it compacts the message list it is given in place, so one
+    instance can serve every session.
+    """
+
+    SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+    # Token overheads of the chat format, see the OpenAI cookbook on counting tokens
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_REPLY = 3
+
+    def __init__(self, model="gpt-4", budget=Config.CONVERSATION_TOKEN_BUDGET,
+                 min_recent=Config.CONVERSATION_MIN_RECENT_MESSAGES, summary_max_tokens=Config.SUMMARY_MAX_TOKENS):
+        """
+        Initialize a ConversationMemory object.
+
+        :param model: The chat model whose tokenizer is used for counting.
+        :type model: str
+        :param budget: The maximum number of prompt tokens sent per request.
+        :type budget: int
+        :param min_recent: The number of latest messages that are never summarized, even over budget.
+        :type min_recent: int
+        :param summary_max_tokens: The length the rolling summary is asked to stay under.
+        :type summary_max_tokens: int
+        """
+        self.budget = budget
+        self.min_recent = min_recent
+        self.summary_max_tokens = summary_max_tokens
+        self.model = model
+        self._encoding = None
+
+    @property
+    def encoding(self):
+        """
+        The tiktoken encoding of the model, loaded on first use, or None if tiktoken is not installed or the
+        encoding cannot be loaded.
+        """
+        if self._encoding is None:
+            # False remembers a failed load, so it is not retried on every count
+            self._encoding = self._load_encoding() or False
+        return self._encoding or None
+
+    def _load_encoding(self):
+        if tiktoken is None:
+            return None
+        try:
+            try:
+                return tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # tiktoken downloads the encoding the first time it is used, which fails offline
+            return None
+
+    def count_text(self, text):
+        """
+        Count the tokens of a text.
+
+        :param text: The text to count.
+        :type text: str
+
+        :return: The number of tokens, estimated at four characters per token without a tiktoken encoding.
+        :rtype: int
+        """
+        encoding = self.encoding
+        if encoding is None:
+            return (len(text) + 3) // 4
+        return len(encoding.encode(text))
+
+    def count_tokens(self, messages):
+        """
+        Count the prompt tokens a list of chat messages costs.
+
+        :param messages: The chat messages.
+        :type messages: list
+
+        :return: The number of prompt tokens.
+        :rtype: int
+        """
+        return sum(self.TOKENS_PER_MESSAGE + self.count_text(message["content"]) for message in messages) \
+            + self.TOKENS_PER_REPLY
+
+    def fit(self, messages, summarize=None):
+        """
+        Compact ``messages`` in place so that it fits the token budget.
+
+        :param messages: The conversation, starting with the system prompt.
+        :type messages: list
+        :param summarize: A callable taking the request built by :meth:`summary_request` and returning the new
+                          summary, or None to drop old turns without summarizing them.
+        :type summarize: callable
+
+        :return: A report with the ``prompt_tokens`` of the compacted conversation, the number of ``messages`` in
+                 it and the number of messages ``summarized`` this turn.
+        :rtype: dict
+        """
+        pinned, summary, turns, evicted = self._split(messages)
+        if evicted and summarize is not None:
+            summary = summarize(self.summary_request(summary, evicted))
+        return self._assemble(messages, pinned, summary, turns, evicted)
+
+    async def afit(self, messages, summarize=None):
+        """
+        Compact ``messages`` in place so that it fits the token budget, awaiting an async ``summarize``.
+
+        See :meth:`fit`.
+        """
+        pinned, summary, turns, evicted = self._split(messages)
+        if evicted and summarize is not None:
+            summary = await summarize(self.summary_request(summary, evicted))
+        return self._assemble(messages, pinned, summary, turns, evicted)
+
+    def summary_request(self, summary, evicted):
+        """
+        Build the chat messages asking the LLM to fold evicted turns into the rolling summary.
+
+        :param summary: The current summary, or an empty string.
+        :type summary: str
+        :param evicted: The messages leaving the window.
+        :type evicted: list
+
+        :return: Chat messages for the summarization request.
+        :rtype: list
+        """
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in evicted)
+        return [
+            {"role": "system",
+             "content": "You maintain a running summary of a conversation between a bookstore chatbot and a "
+                        "customer. Merge the new messages into the current summary. Keep book titles, authors, "
+                        "genres and cart changes; drop pleasantries. Answer with the summary only, in at most "
+                        f"{self.summary_max_tokens} tokens."},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"}
+        ]
+
+    def _split(self, messages):
+        """
+        Split a conversation into the pinned prompt, the current summary, the turns to keep and the turns to evict.
+        """
+        pinned = messages[0] if messages and messages[0]["role"] == "system" else None
+        rest = messages[1:] if pinned else list(messages)
+
+        summary = ""
+        if rest and rest[0]["role"] == "system" and rest[0]["content"].startswith(self.SUMMARY_PREFIX):
+            summary = rest[0]["content"][len(self.SUMMARY_PREFIX):]
+            rest = rest[1:]
+        # Sessions from before the prompt was pinned may hold extra copies of it
+        turns = [message for message in rest if not (pinned and message == pinned)]
+
+        fixed = [pinned] if pinned else []
+        if summary:
+            fixed.append(self._summary_message(summary))
+        # Reserve room for the summary the evicted turns will produce
+        reserve = self.summary_max_tokens if summary else 0
+        evicted = []
+        while len(turns) > self.min_recent and self.count_tokens(fixed + turns) + reserve > self.budget:
+            evicted.append(turns.pop(0))
+            reserve = self.summary_max_tokens
+        return pinned, summary, turns, evicted
+
+    def _assemble(self, messages, pinned, summary, turns, evicted):
+        """
+        Replace the contents of ``messages`` with the compacted conversation and report on it.
+        """
+        compacted = [pinned] if pinned else []
+        if summary:
+            compacted.append(self._summary_message(summary))
+        compacted.extend(turns)
+        messages[:] = compacted
+        return {
+            "prompt_tokens": self.count_tokens(messages),
+            "messages": len(messages),
+            "summarized": len(evicted),
+        }
+
+    def _summary_message(self, summary):
+        return {"role": "system", "content": self.SUMMARY_PREFIX + summary}
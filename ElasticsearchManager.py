@@ -1,41 +1,180 @@
-from elasticsearch import Elasticsearch
+import threading
 
+import Config
+import Telemetry
+from LRUCache import LRUCache
+from Vectorizer import Vectorizer
 
+_client = None
+_client_lock = threading.Lock()
+
+
+class SearchError(Exception):
+    """One of the searches of an ``_msearch`` request failed."""
+
+    def __init__(self, search, status, error):
+        """
+        Initialize a SearchError object.
+
+        :param search: The name of the failed search.
+        :type search: str
+        :param status: The HTTP status of the failed search.
+        :type status: int
+        :param error: The error returned for the search.
+        :type error: dict or str
+        """
+        self.search = search
+        self.status = status
+        self.error = error
+        reason = error.get("reason", error.get("type")) if isinstance(error, dict) else error
+        super().__init__(f"The {search} search failed with status {status}: {reason}")
+
+
+def get_client():
+    """
+    Return the Elasticsearch client shared by the process, creating it on first use.
+
+    The client keeps a pool of keep-alive connections per node, so every manager reuses the same TLS sessions.
+    Timeouts, retries and the backoff applied to failing nodes come from the ES_* settings. If orjson is installed,
+    request bodies are encoded with it, which writes float32 vectors with their shortest exact representation.
+
+    :return: The shared Elasticsearch client.
+    :rtype: Elasticsearch
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                # Imported on first use, so that importing this module stays cheap
+                from elasticsearch import Elasticsearch
+
+                _client = Elasticsearch(
+                    hosts=Config.ES_HOSTS,
+                    basic_auth=(Config.ES_USERNAME, Config.ES_PASSWORD),
+                    verify_certs=Config.ES_VERIFY_CERTS,
+                    request_timeout=Config.ES_REQUEST_TIMEOUT,
+                    max_retries=Config.ES_MAX_RETRIES,
+                    retry_on_timeout=Config.ES_RETRY_ON_TIMEOUT,
+                    retry_on_status=(429, 502, 503, 504),
+                    connections_per_node=Config.ES_CONNECTIONS_PER_NODE,
+                    dead_node_backoff_factor=Config.ES_BACKOFF_FACTOR,
+                    max_dead_node_backoff=Config.ES_MAX_BACKOFF,
+                    **serializer_options()
+                )
+    return _client
+
+
+def serializer_options():
+    """
+    Return the client options selecting the orjson serializer, or no options if orjson is not installed.
+
+    :return: Keyword arguments for the Elasticsearch client.
+    :rtype: dict
+    """
+    try:
+        from elasticsearch.serializer import OrjsonSerializer
+    except ImportError:  # pragma: no cover - the client then encodes with the standard json module
+        return {}
+    return {"serializer": OrjsonSerializer()}
+
+
+@Telemetry.instrument("elasticsearch")
 class ElasticsearchManager:
-    """Manages interactions with Elasticsearch indices for books and the shopping cart."""
+    """
+    Manages interactions with Elasticsearch indices for books and the shopping cart.
+
+    Every public method runs in a Telemetry span named ``elasticsearch.<method>``.
+    """
 
     BOOKS_INDEX_NAME = "books"
-    CART_INDEX_NAME = "cart"
+    CART_INDEX_NAME = "carts"
 
-    def __init__(self, dimension=384):
+    # Names of the searches of a search_book _msearch request, in order
+    SEARCH_BOOK_SEARCHES = ("strict", "lexical fallback", "kNN fallback")
+
+    # search_book results by normalized (title, author, genre), shared by every manager in the process
+    search_cache = LRUCache(max_size=Config.SEARCH_CACHE_SIZE, ttl=Config.SEARCH_CACHE_TTL)
+
+    _bootstrapped = set()
+    _bootstrap_lock = threading.Lock()
+
+    def __init__(self, dimension=384, es=None):
         """
         Initialize an ElasticsearchManager object.
 
+        The books and cart indices are created the first time a manager is constructed for a given client and
+        dimension; later managers skip the round trips.
+
         :param dimension: The dimension of the dense vectors.
         :type dimension: int
+        :param es: The Elasticsearch client to use, or None for the client shared by the process.
+        :type es: Elasticsearch
         """
-        self.es = Elasticsearch(hosts="https://localhost:9200", basic_auth=["elastic", "vozLjbIOWbriPTQnU8Mg"],
-                                verify_certs=False)
+        self.es = es or get_client()
         self.dimension = dimension
-        # Create indices
-        self._create_index(self.BOOKS_INDEX_NAME, {
-            "mappings": {
-                "properties": {
-                    "title": {"type": "text"},
-                    "author": {"type": "text"},
-                    "genre": {"type": "text"},
-                    "vector": {"type": "dense_vector", "dims": self.dimension}
+        self.vectorizer = Vectorizer()
+        key = (id(self.es), dimension)
+        if key not in self._bootstrapped:
+            with self._bootstrap_lock:
+                if key not in self._bootstrapped:
+                    self._create_indices()
+                    self._bootstrapped.add(key)
+
+    def _create_indices(self):
+        """
+        Create the books and cart indices if they do not exist yet.
+        """
+        for index_name, mapping in self.index_mappings(self.dimension).items():
+            self._create_index(index_name, mapping)
+
+    @classmethod
+    def index_mappings(cls, dimension):
+        """
+        Build the mappings of the books and cart indices.
+
+        Book vectors are indexed as VECTOR_INDEX_TYPE, scalar-quantized to int8 by default, and left out of the
+        stored ``_source`` unless SOURCE_VECTORS is set, so searches never ship them back.
+
+        :param dimension: The dimension of the dense vectors.
+        :type dimension: int
+
+        :return: A dictionary from index name to mapping.
+        :rtype: dict
+        """
+        return {
+            cls.BOOKS_INDEX_NAME: {
+                "mappings": {
+                    "_source": {"excludes": [] if Config.SOURCE_VECTORS else ["vector"]},
+                    "properties": {
+                        "title": {"type": "text"},
+                        "author": {"type": "text"},
+                        "genre": {"type": "text"},
+                        "content_hash": {"type": "keyword"},
+                        "vector": {
+                            "type": "dense_vector",
+                            "dims": dimension,
+                            "index": True,
+                            "similarity": Config.VECTOR_SIMILARITY,
+                            "index_options": {
+                                "type": Config.VECTOR_INDEX_TYPE,
+                                "m": Config.HNSW_M,
+                                "ef_construction": Config.HNSW_EF_CONSTRUCTION
+                            }
+                        }
+                    }
                 }
-            }
-        })
-        self._create_index(self.CART_INDEX_NAME, {
-            "mappings": {
-                "properties": {
-                    "title": {"type": "text"},
-                    "vector": {"type": "dense_vector", "dims": self.dimension}
+            },
+            cls.CART_INDEX_NAME: {
+                "mappings": {
+                    "properties": {
+                        "session_id": {"type": "keyword"},
+                        "book_key": {"type": "keyword"},
+                        "title": {"type": "text"},
+                        "added_at": {"type": "date"}
+                    }
                 }
             }
-        })
+        }
 
     def _create_index(self, index_name, mapping):
         """
@@ -48,7 +187,7 @@ class ElasticsearchManager:
         """
         self.es.indices.create(index=index_name, body=mapping, ignore=400)
 
-    def index(self, index_name, document):
+    def index(self, index_name, document, refresh=None):
         """
         Index a document into the specified Elasticsearch index.
 
@@ -56,8 +195,209 @@ class ElasticsearchManager:
         :type index_name: str
         :param document: The document to be indexed.
         :type document: dict
+        :param refresh: "wait_for" to return only once the document is visible to search, or None not to wait.
+        :type refresh: str
+
+        :return: Response of the index operation, including the ``_id`` of the new document.
+        :rtype: dict
+        """
+        response = self.es.index(index=index_name, body=document, refresh=refresh)
+        self.invalidate_search_cache(index_name)
+        return response
+
+    def put(self, index_name, document_id, document, routing=None, refresh=None):
+        """
+        Create or overwrite the document with the given id in the specified Elasticsearch index.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param document_id: The id of the document.
+        :type document_id: str
+        :param document: The document to be stored.
+        :type document: dict
+        :param routing: The routing value placing the document on a shard, or None to route by id.
+        :type routing: str
+        :param refresh: "wait_for" to return only once the document is visible to search, or None not to wait.
+        :type refresh: str
+
+        :return: Response of the index operation.
+        :rtype: dict
+        """
+        response = self.es.index(index=index_name, id=document_id, document=document, routing=routing,
+                                 refresh=refresh)
+        self.invalidate_search_cache(index_name)
+        return response
+
+    def delete_by_id(self, index_name, document_id, routing=None, refresh=None):
+        """
+        Delete the document with the given id from the specified Elasticsearch index, if it exists.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param document_id: The id of the document.
+        :type document_id: str
+        :param routing: The routing value the document was stored with.
+        :type routing: str
+        :param refresh: "wait_for" to return only once the deletion is visible to search, or None not to wait.
+        :type refresh: str
+
+        :return: Response of the delete operation; its ``result`` is "not_found" if there was no such document.
+        :rtype: dict
+        """
+        response = self.es.options(ignore_status=404).delete(index=index_name, id=document_id, routing=routing,
+                                                              refresh=refresh)
+        self.invalidate_search_cache(index_name)
+        return response
+
+    def get_by_term(self, index_name, field, value, routing=None, size=100, sort=None):
+        """
+        Retrieve the documents of the specified Elasticsearch index whose keyword field equals a value.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param field: The keyword field to filter on.
+        :type field: str
+        :param value: The value the field must equal.
+        :type value: str
+        :param routing: The routing value of the documents, so only their shard is searched.
+        :type routing: str
+        :param size: The maximum number of documents returned.
+        :type size: int
+        :param sort: The sort order, or None for index order.
+        :type sort: list
+
+        :return: List of matching documents.
+        :rtype: list
+        """
+        response = self.es.search(index=index_name, query={"term": {field: value}}, routing=routing, size=size,
+                                  sort=sort)
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    def delete_by_term(self, index_name, field, value, routing=None, refresh=False):
+        """
+        Delete the documents of the specified Elasticsearch index whose keyword field equals a value.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param field: The keyword field to filter on.
+        :type field: str
+        :param value: The value the field must equal.
+        :type value: str
+        :param routing: The routing value of the documents, so only their shard is searched.
+        :type routing: str
+        :param refresh: Whether to refresh the index so the deletions are visible to search on return.
+        :type refresh: bool
+        """
+        self.es.delete_by_query(index=index_name, query={"term": {field: value}}, routing=routing,
+                                wait_for_completion=True, refresh=refresh)
+        self.invalidate_search_cache(index_name)
+
+    def bulk_index(self, index_name, documents, chunk_size=500, thread_count=1):
+        """
+        Index documents into the specified Elasticsearch index through the ``_bulk`` API.
+
+        Documents are consumed lazily, so ``documents`` may be a generator over a catalog that does not fit in memory.
+
+        :param index_name: The name of the index to index the documents into.
+        :type index_name: str
+        :param documents: The documents to be indexed.
+        :type documents: iterable
+        :param chunk_size: The number of documents sent per ``_bulk`` request.
+        :type chunk_size: int
+        :param thread_count: The number of ``_bulk`` requests in flight at once.
+        :type thread_count: int
+
+        :return: A generator of ``(ok, item)`` results, one per document, in input order.
+        :rtype: generator
+        """
+        actions = ({"_source": document} for document in documents)
+        return self.bulk(index_name, actions, chunk_size=chunk_size, thread_count=thread_count)
+
+    def bulk(self, index_name, actions, chunk_size=500, thread_count=1):
+        """
+        Send write actions for the specified Elasticsearch index through the ``_bulk`` API.
+
+        Each action is a dict in the form of the bulk helpers, e.g. ``{"_id": id, "_source": document}`` to create
+        or overwrite a document, or ``{"_op_type": "delete", "_id": id}`` to delete one. Actions are consumed
+        lazily.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param actions: The write actions.
+        :type actions: iterable
+        :param chunk_size: The number of actions sent per ``_bulk`` request.
+        :type chunk_size: int
+        :param thread_count: The number of ``_bulk`` requests in flight at once.
+        :type thread_count: int
+
+        :return: A generator of ``(ok, item)`` results, one per action, in input order. Each item is keyed by the
+                 operation, e.g. ``{"index": {"_id": ..., "result": "created"}}``.
+        :rtype: generator
+        """
+        from elasticsearch import helpers
+
+        actions = (dict(action, _index=index_name) for action in actions)
+        if thread_count > 1:
+            results = helpers.parallel_bulk(self.es, actions, thread_count=thread_count, chunk_size=chunk_size,
+                                            queue_size=thread_count)
+        else:
+            results = helpers.streaming_bulk(self.es, actions, chunk_size=chunk_size)
+        return self._invalidating(index_name, results)
+
+    def _invalidating(self, index_name, results):
+        """
+        Pass bulk results through, invalidating cached searches of the index as documents are acknowledged.
+        """
+        try:
+            for ok, item in results:
+                self.invalidate_search_cache(index_name)
+                yield ok, item
+        finally:
+            self.invalidate_search_cache(index_name)
+
+    @classmethod
+    def invalidate_search_cache(cls, index_name):
+        """
+        Drop cached search results after a write to the specified index.
+
+        :param index_name: The name of the index written to.
+        :type index_name: str
+        """
+        if index_name == cls.BOOKS_INDEX_NAME:
+            cls.search_cache.clear()
+
+    def get_refresh_interval(self, index_name):
+        """
+        Get the refresh interval of the specified Elasticsearch index.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+
+        :return: The refresh interval, or None if the index uses the cluster default.
+        :rtype: str
+        """
+        response = self.es.indices.get_settings(index=index_name, name="index.refresh_interval")
+        return response[index_name]["settings"].get("index", {}).get("refresh_interval")
+
+    def set_refresh_interval(self, index_name, interval):
+        """
+        Set the refresh interval of the specified Elasticsearch index.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param interval: The refresh interval, "-1" to disable refreshes, or None to restore the default.
+        :type interval: str
+        """
+        self.es.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": interval}})
+
+    def refresh(self, index_name):
+        """
+        Make all documents indexed so far in the specified Elasticsearch index visible to search.
+
+        :param index_name: The name of the index.
+        :type index_name: str
         """
-        self.es.index(index=index_name, body=document)
+        self.es.indices.refresh(index=index_name)
 
     def search(self, index_name, query):
         """
@@ -74,20 +414,121 @@ class ElasticsearchManager:
         response = self.es.search(index=index_name, query={"multi_match": {"query": query, "fields": ["title"]}})
         return [hit["_source"] for hit in response["hits"]["hits"]]
 
-    def get_all(self, index_name):
+    def match_values(self, index_name, field, text, size=Config.ROUTER_CANDIDATES):
         """
-        Retrieve all documents from the specified Elasticsearch index.
+        Find the distinct values of a text field that best match a text, e.g. the authors a user may have meant.
+
+        One ``match`` query, which tolerates misspellings, reads the field of the ``size`` best matching documents.
 
         :param index_name: The name of the index.
         :type index_name: str
+        :param field: The text field.
+        :type field: str
+        :param text: The text to match.
+        :type text: str
+        :param size: The maximum number of documents read, and so of values returned.
+        :type size: int
+
+        :return: The distinct values of the field, best match first.
+        :rtype: list
+        """
+        query = {"match": {field: {"query": text, "fuzziness": "AUTO"}}}
+        response = self.es.search(index=index_name, query=query, size=size, source=[field])
+        return self.distinct_values(response["hits"]["hits"], field)
+
+    @staticmethod
+    def distinct_values(hits, field):
+        """
+        Collect the distinct, non-empty values of a field from hits, in hit order.
 
-        :return: List of all documents in the index.
+        :return: The values.
         :rtype: list
         """
-        response = self.es.search(index=index_name, body={"query": {"match_all": {}}, "size": 50})
-        return [doc["_source"] for doc in response["hits"]["hits"]]
+        return list(dict.fromkeys(hit["_source"][field] for hit in hits if hit["_source"].get(field)))
 
-    def delete(self, index_name, title):
+    def get_all(self, index_name, source=None, size=50):
+        """
+        Retrieve the first documents of the specified Elasticsearch index, at most ``size`` of them.
+
+        The documents are returned as one list, so the number is capped; use :meth:`iter_all` to go through a
+        whole index in bounded memory.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param source: The ``_source`` fields to return, as for :meth:`iter_all`; None leaves out the vector.
+        :type source: list or dict
+        :param size: The maximum number of documents returned, at most ``index.max_result_window``.
+        :type size: int
+
+        :return: List of documents in the index.
+        :rtype: list
+        """
+        if source is None:
+            source = {"excludes": ["vector"]}
+        response = self.es.search(index=index_name, query={"match_all": {}}, size=size, source=source)
+        return [hit["_source"] for hit in response["hits"]["hits"]]
+
+    def iter_all(self, index_name, query=None, page_size=None, source=True, sort=None, routing=None):
+        """
+        Iterate over the documents of the specified Elasticsearch index, one page at a time.
+
+        Pages are read from a point in time with ``search_after``, so the iteration sees a consistent snapshot of
+        the index, is not limited by ``index.max_result_window`` and holds at most one page in memory.
+
+        :param index_name: The name of the index.
+        :type index_name: str
+        :param query: The query the documents must match, or None for every document.
+        :type query: dict
+        :param page_size: The number of documents fetched per request, or None for the default.
+        :type page_size: int
+        :param source: The ``_source`` fields to return: True for all, a list of fields, or a dict with
+                       ``includes`` and ``excludes``.
+        :type source: bool or list or dict
+        :param sort: The sort order, or None for index order. Ties are broken in index order.
+        :type sort: list
+        :param routing: The routing value of the documents, so only their shard is searched.
+        :type routing: str
+
+        :return: A generator of hits, each with ``_id`` and ``_source``.
+        :rtype: generator
+        """
+        pit_id = self.es.open_point_in_time(index=index_name, keep_alive=Config.PIT_KEEP_ALIVE,
+                                            routing=routing)["id"]
+        search_after = None
+        try:
+            while True:
+                response = self.es.search(**self.page_request(pit_id, query, page_size, source, sort,
+                                                              search_after))
+                hits = response["hits"]["hits"]
+                yield from hits
+                if len(hits) < (page_size or Config.PAGE_SIZE):
+                    return
+                pit_id = response.get("pit_id", pit_id)
+                search_after = hits[-1]["sort"]
+        finally:
+            self.es.close_point_in_time(id=pit_id)
+
+    @staticmethod
+    def page_request(pit_id, query, page_size, source, sort, search_after):
+        """
+        Build the parameters of a search for one page of a point in time.
+
+        :return: Keyword arguments of the ``search`` API.
+        :rtype: dict
+        """
+        request = {
+            "pit": {"id": pit_id, "keep_alive": Config.PIT_KEEP_ALIVE},
+            "query": query or {"match_all": {}},
+            "size": page_size or Config.PAGE_SIZE,
+            "source": source,
+            "sort": list(sort or []) + [{"_shard_doc": "asc"}],
+            "track_total_hits": False,
+        }
+        if search_after is not None:
+            request["search_after"] = search_after
+        return request
+
+    def delete(self, index_name, title, refresh=None):
         """
         Delete a document from the specified Elasticsearch index based on its title.
 
@@ -95,6 +536,8 @@ class ElasticsearchManager:
         :type index_name: str
         :param title: The title of the document to delete.
         :type title: str
+        :param refresh: "wait_for" to return only once the deletion is visible to search, or None not to wait.
+        :type refresh: str
 
         :return: Response indicating the status of the delete operation.
         :rtype: dict or str
@@ -103,17 +546,20 @@ class ElasticsearchManager:
         search_resp = self.es.search(index=index_name, body=query, size=1)
         if search_resp['hits']['hits']:
             document_id = search_resp['hits']['hits'][0]['_id']
-            delete_resp = self.es.delete(index=index_name, id=document_id)
+            delete_resp = self.es.delete(index=index_name, id=document_id, refresh=refresh)
+            self.invalidate_search_cache(index_name)
             return delete_resp
         else:
             return "Document not found."
 
-    def clear(self, index_name):
+    def clear(self, index_name, refresh=False):
         """
         Clear all documents from the specified Elasticsearch index.
 
         :param index_name: The name of the index.
         :type index_name: str
+        :param refresh: Whether to refresh the index so the deletions are visible to search on return.
+        :type refresh: bool
         """
         response = self.es.delete_by_query(
             index=index_name,
@@ -123,14 +569,24 @@ class ElasticsearchManager:
                 }
             },
             # Add this to wait until the operation is complete before continuing
-            wait_for_completion=True
+            wait_for_completion=True,
+            refresh=refresh
         )
+        self.invalidate_search_cache(index_name)
 
-    def search_book(self, title, author, genre):
+    def search_book(self, title, author, genre, hybrid=None):
         """
         Enhanced search method that tries alternative search parameters if the initial search yields no results.
         It first attempts to find books matching the provided genre, title, or author. If no results are found, it
-        then searches other fields for the provided keywords.
+        falls back to the books closest to the keywords: in hybrid mode, BM25 matches of the keywords against any
+        field fused by reciprocal rank with a kNN search on their embedding, so misspellings and vague genres still
+        find something; in lexical mode, the BM25 matches alone. kNN hits less similar than HYBRID_MIN_SIMILARITY
+        are dropped, so keywords unlike every book still find nothing.
+
+        In hybrid mode the keywords are embedded first, through the embedding cache, and the strict, BM25 and kNN
+        searches are sent in one ``_msearch`` round trip; the fallback hits are ignored when the strict search
+        finds something. Vectors are left out of the returned documents, and results are cached until the books
+        index is next written.
 
         :param title: The title of the book, or None.
         :type title: str
@@ -138,9 +594,152 @@ class ElasticsearchManager:
         :type author: str
         :param genre: The genre of the book, or None.
         :type genre: str
+        :param hybrid: Whether to use hybrid retrieval for the fallback, or None to follow the SEARCH_MODE setting.
+        :type hybrid: bool
 
         :return: List of documents matching the query, with fallback search in other fields if necessary.
         :rtype: list
+
+        :raises SearchError: If one of the searches failed. Failures are not cached.
+        """
+        hybrid = Config.SEARCH_MODE == "hybrid" if hybrid is None else hybrid
+        query, fallback_query = self.search_book_queries(title, author, genre)
+        if query is None:
+            return []
+
+        key = self.search_book_key(title, author, genre, hybrid)
+        books = self.search_cache.get(key)
+        Telemetry.annotate(cache_hit=books is not None)
+        if books is None:
+            query_vector = self.vectorizer.vectorize(fallback_query["multi_match"]["query"]) if hybrid else None
+            searches = self.search_book_msearch(query, fallback_query, query_vector)
+            books = self.search_book_results(self.es.msearch(searches=searches)["responses"])
+            self.search_cache.put(key, books)
+        return books
+
+    @staticmethod
+    def search_book_key(title, author, genre, hybrid):
+        """
+        Build the key :meth:`search_book` results are cached under.
+
+        :param title: The title of the book, or None.
+        :type title: str
+        :param author: The author of the book, or None.
+        :type author: str
+        :param genre: The genre of the book, or None.
+        :type genre: str
+        :param hybrid: Whether the search is hybrid.
+        :type hybrid: bool
+
+        :return: The normalized title, author and genre, and the search mode.
+        :rtype: tuple
+        """
+        fields = tuple(" ".join(value.lower().split()) if value not in [None, "None", ""] else None
+                       for value in (title, author, genre))
+        return fields + (hybrid,)
+
+    @classmethod
+    def search_book_msearch(cls, query, fallback_query, query_vector=None):
+        """
+        Build the ``_msearch`` searches used by :meth:`search_book`: the initial and the fallback BM25 search, and
+        in hybrid mode the kNN search fused with the latter.
+
+        :param query: The initial query.
+        :type query: dict
+        :param fallback_query: The fallback BM25 query.
+        :type fallback_query: dict
+        :param query_vector: The embedding of the keywords, or None for no kNN search.
+        :type query_vector: numpy.ndarray
+
+        :return: The header and body of each search, flattened into one list.
+        :rtype: list
+        """
+        hybrid = query_vector is not None
+        fallback_size = Config.HYBRID_WINDOW if hybrid else 50
+        searches = [
+            {"index": cls.BOOKS_INDEX_NAME},
+            {"query": query, "size": 50, "_source": {"excludes": ["vector"]}},
+            {"index": cls.BOOKS_INDEX_NAME},
+            {"query": fallback_query, "size": fallback_size, "_source": {"excludes": ["vector"]}},
+        ]
+        if hybrid:
+            searches += [
+                {"index": cls.BOOKS_INDEX_NAME},
+                {
+                    "knn": {
+                        "field": "vector",
+                        "query_vector": query_vector,
+                        "k": Config.HYBRID_WINDOW,
+                        "num_candidates": max(Config.KNN_NUM_CANDIDATES, Config.HYBRID_WINDOW),
+                        "similarity": Config.HYBRID_MIN_SIMILARITY
+                    },
+                    "size": Config.HYBRID_WINDOW,
+                    "_source": {"excludes": ["vector"]}
+                },
+            ]
+        return searches
+
+    @classmethod
+    def search_book_results(cls, responses):
+        """
+        Pick the documents of the initial search, or else of the fallback searches.
+
+        :param responses: The ``responses`` of the ``_msearch`` request built by :meth:`search_book_msearch`.
+        :type responses: list
+
+        :return: List of documents.
+        :rtype: list
+
+        :raises SearchError: If one of the searches failed.
+        """
+        for search, response in zip(cls.SEARCH_BOOK_SEARCHES, responses):
+            if "error" in response:
+                raise SearchError(f"search_book {search}", response.get("status"), response["error"])
+        hit_lists = [response["hits"]["hits"] for response in responses]
+        if hit_lists[0]:
+            return [hit["_source"] for hit in hit_lists[0]]
+        if len(hit_lists) == 2:
+            return [hit["_source"] for hit in hit_lists[1]]
+        return cls.reciprocal_rank_fusion(hit_lists[1:])[:Config.HYBRID_SIZE]
+
+    @staticmethod
+    def reciprocal_rank_fusion(hit_lists, rank_constant=Config.RRF_RANK_CONSTANT):
+        """
+        Merge ranked hit lists, scoring each document by the sum of ``1 / (rank_constant + rank)`` over the lists.
+
+        :param hit_lists: Lists of hits, each best first.
+        :type hit_lists: list
+        :param rank_constant: Dampens the advantage of top ranks; 60 is the usual choice.
+        :type rank_constant: int
+
+        :return: The documents of all lists, best fused score first.
+        :rtype: list
+        """
+        scores = {}
+        sources = {}
+        for hits in hit_lists:
+            for rank, hit in enumerate(hits, start=1):
+                scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + 1.0 / (rank_constant + rank)
+                sources[hit["_id"]] = hit["_source"]
+        return [sources[doc_id] for doc_id in sorted(scores, key=scores.get, reverse=True)]
+
+    @staticmethod
+    def search_book_queries(title, author, genre):
+        """
+        Build the queries used by :meth:`search_book`.
+
+        The initial query requires every provided field to match; the fallback query matches all provided keywords
+        against any of the fields.
+
+        :param title: The title of the book, or None.
+        :type title: str
+        :param author: The author of the book, or None.
+        :type author: str
+        :param genre: The genre of the book, or None.
+        :type genre: str
+
+        :return: The initial and the fallback query, each None if no field was provided.
+        :rtype: tuple
         """
 
         # Normalize input to avoid "None" and None
@@ -162,55 +761,64 @@ class ElasticsearchManager:
         if genre:
             query_conditions.append({"match": {"genre": genre}})
 
-        # Execute the initial search
-        if query_conditions:
-            query = {"bool": {"must": query_conditions}}
-            response = self.es.search(index=self.BOOKS_INDEX_NAME, body={"query": query, "size": 50})
-            if response["hits"]["hits"]:
-                return [hit["_source"] for hit in response["hits"]["hits"]]
+        if not query_conditions:
+            return None, None
 
-        # Fallback search if no results found in the initial query
+        query = {"bool": {"must": query_conditions}}
         fallback_keywords = [kw for kw in [title, author, genre] if kw is not None]
-        if fallback_keywords:
-            fallback_query = {
-                "multi_match": {
-                    "query": " ".join(fallback_keywords),
-                    "fields": ["title", "author", "genre"],
-                    "type": "best_fields"
-                }
+        fallback_query = {
+            "multi_match": {
+                "query": " ".join(fallback_keywords),
+                "fields": ["title", "author", "genre"],
+                "type": "best_fields"
             }
-            response = self.es.search(index=self.BOOKS_INDEX_NAME, body={"query": fallback_query, "size": 50})
-            return [hit["_source"] for hit in response["hits"]["hits"]]
-
-        return []
+        }
+        return query, fallback_query
 
-    def search_vector(self, index_name, query_vector, size=5):
+    def search_vector(self, index_name, query_vector, size=5, num_candidates=None, exact=False):
         """
-        Perform a vector similarity search in the specified Elasticsearch index using a book object.
+        Perform a vector similarity search in the specified Elasticsearch index.
 
-        This method takes a book object, utilizes its vector representation, and performs a vector
-        similarity search in the specified Elasticsearch index to find similar books based on
-        vector similarity scores.
+        By default this runs an approximate kNN search over the HNSW graph of the ``vector`` field. With ``exact``
+        set, the ``num_candidates`` candidates of that search are rescored by a ``script_score`` query with the
+        exact cosine similarity of their float vectors, undoing the error of the quantized HNSW copy, in one
+        request. Either way hits are scored ``(1 + cosine) / 2``, between 0 and 1.
 
         Parameters:
         - index_name (str): The name of the Elasticsearch index to search.
-        - book (Book): The book object whose vector representation will be used for the similarity search.
-        - size (int): The number of similar books to return. Defaults to 5.
+        - query_vector (numpy.ndarray): The vector to find similar documents to.
+        - size (int): The number of similar documents to return. Defaults to 5.
+        - num_candidates (int): The number of candidates each shard considers; higher values trade latency for
+                                recall. Defaults to the KNN_NUM_CANDIDATES setting.
+        - exact (bool): Whether to rescore the kNN candidates with their exact cosine similarity. Defaults to
+                        False.
 
         Returns:
-        - list: A list of Elasticsearch hits representing documents that are similar to the given book,
-                based on vector similarity. Each hit is a dictionary containing document details.
-        """
-        # Elasticsearch script_score query for computing similarity
-        query = {
-            "script_score": {
-                "query": {"match_all": {}},
-                "script": {
-                    "source": "cosineSimilarity(params.query_vector, 'vector') + 1.0",
-                    "params": {"query_vector": query_vector}
+        - list: A list of Elasticsearch hits representing documents that are similar to the query vector,
+                most similar first. Each hit is a dictionary containing document details.
+        """
+        num_candidates = max(num_candidates or Config.KNN_NUM_CANDIDATES, size)
+        if exact:
+            # The knn query yields num_candidates approximate candidates per shard, which the script rescores
+            query = {
+                "script_score": {
+                    "query": {
+                        "knn": {"field": "vector", "query_vector": query_vector, "num_candidates": num_candidates}
+                    },
+                    "script": {
+                        "source": "(cosineSimilarity(params.query_vector, 'vector') + 1.0) / 2.0",
+                        "params": {"query_vector": query_vector}
+                    }
                 }
             }
+            response = self.es.search(index=index_name, query=query, size=size)
+            return response["hits"]["hits"]
+
+        knn = {
+            "field": "vector",
+            "query_vector": query_vector,
+            "k": size,
+            "num_candidates": num_candidates
         }
-
-        response = self.es.search(index=index_name, body={"query": query}, size=size)
+        response = self.es.search(index=index_name, knn=knn, size=size)
         return response["hits"]["hits"]
@@ -0,0 +1,136 @@
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+
+import numpy as np
+
+from LRUCache import LRUCache
+
+
+class EmbeddingCache:
+    """
+    Caches text embeddings in an in-memory LRU tier backed by an optional SQLite file.
+
+    Entries are keyed by model name plus normalized text, so vectors from different models never mix.
+    """
+
+    # SQLite limits the number of parameters in a single statement
+    _QUERY_CHUNK = 500
+
+    def __init__(self, path=None, max_size=10000):
+        """
+        Initialize an EmbeddingCache object.
+
+        :param path: The path of the SQLite file for the persistent tier, or None to keep entries in memory only.
+        :type path: str
+        :param max_size: The number of embeddings kept in the in-memory tier.
+        :type max_size: int
+        """
+        self.memory = LRUCache(max_size=max_size)
+        self.path = path
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def normalize(text):
+        """
+        Normalize text so that trivially different spellings share a cache entry.
+
+        :param text: The text to normalize.
+        :type text: str
+
+        :return: The text in NFKC form with runs of whitespace collapsed to single spaces.
+        :rtype: str
+        """
+        return " ".join(unicodedata.normalize("NFKC", text).split())
+
+    @staticmethod
+    def key(model_name, text):
+        """
+        Build the cache key for a model and an already normalized text.
+
+        :param model_name: The name of the model that produced the embedding.
+        :type model_name: str
+        :param text: The normalized text.
+        :type text: str
+
+        :return: A hex digest identifying the pair.
+        :rtype: str
+        """
+        return hashlib.sha1(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Look up embeddings for many keys, promoting persistent hits into the in-memory tier.
+
+        :param keys: The keys to look up.
+        :type keys: list
+
+        :return: A dictionary from each key found to its float32 embedding.
+        :rtype: dict
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            vector = self.memory.get(key)
+            if vector is None:
+                missing.append(key)
+            else:
+                found[key] = vector
+        memory_hits = len(found)
+
+        if self._db is not None and missing:
+            with self._lock:
+                for start in range(0, len(missing), self._QUERY_CHUNK):
+                    chunk = missing[start:start + self._QUERY_CHUNK]
+                    rows = self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self.memory.put(key, vector)
+                        found[key] = vector
+
+        self.memory_hits += memory_hits
+        self.disk_hits += len(found) - memory_hits
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        """
+        Store embeddings in both tiers.
+
+        :param items: A dictionary from key to embedding.
+        :type items: dict
+        """
+        items = {key: np.asarray(vector, dtype=np.float32) for key, vector in items.items()}
+        for key, vector in items.items():
+            self.memory.put(key, vector)
+        if self._db is not None and items:
+            with self._lock:
+                self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                     [(key, vector.tobytes()) for key, vector in items.items()])
+                self._db.commit()
+
+    def stats(self):
+        """
+        Report cache hit and miss counters.
+
+        :return: A dictionary with ``memory_hits``, ``disk_hits``, ``misses`` and ``hit_rate``.
+        :rtype: dict
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
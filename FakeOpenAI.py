@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+
+class _Record(dict):
+    """A dict whose keys can also be read as attributes, like the objects returned by the openai client."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class _ChatCompletion:
+    def __init__(self, client):
+        self._client = client
+
+    def create(self, model, messages, stream=False, **kwargs):
+        self._client.calls += 1
+        time.sleep(self._client.latency)
+        text = self._client.reply(messages)
+        if stream:
+            return (self._client.chunk(piece) for piece in self._client.split(text))
+        return self._client.completion(text)
+
+    async def acreate(self, model, messages, stream=False, **kwargs):
+        self._client.calls += 1
+        await asyncio.sleep(self._client.latency)
+        text = self._client.reply(messages)
+        if stream:
+            return self._achunks(text)
+        return self._client.completion(text)
+
+    async def _achunks(self, text):
+        for piece in self._client.split(text):
+            yield self._client.chunk(piece)
+
+
+class FakeOpenAI:
+    """
+    A stand-in for the ``openai`` module that answers chat completions offline.
+
+    It provides ``ChatCompletion.create`` and ``ChatCompletion.acreate``, streamed or not, returning objects shaped
+    like those of the openai 0.x client. Replies come from a function of the request messages, after a fixed
+    latency standing in for the model's time to first token, so the rest of a chat turn can be timed on its own.
+    """
+
+    def __init__(self, reply=None, latency=0.0, chunk_size=16):
+        """
+        Initialize a FakeOpenAI object.
+
+        :param reply: A function from the request messages to the reply text, or None to always greet the user.
+        :type reply: callable
+        :param latency: The seconds every request waits before answering.
+        :type latency: float
+        :param chunk_size: The number of characters per streamed chunk.
+        :type chunk_size: int
+        """
+        self.reply = reply or (lambda messages: "Hello! How can I help you today?")
+        self.latency = latency
+        self.chunk_size = chunk_size
+        # Number of requests answered so far
+        self.calls = 0
+        self.ChatCompletion = _ChatCompletion(self)
+
+    def split(self, text):
+        return [text[start:start + self.chunk_size] for start in range(0, len(text), self.chunk_size)]
+
+    @staticmethod
+    def completion(text):
+        message = _Record(role="assistant", content=text)
+        return _Record(choices=[_Record(index=0, message=message, finish_reason="stop")])
+
+    @staticmethod
+    def chunk(text):
+        return _Record(choices=[_Record(index=0, delta=_Record(content=text), finish_reason=None)])
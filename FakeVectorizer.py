@@ -0,0 +1,44 @@
+import hashlib
+
+import numpy as np
+
+from EmbeddingCache import EmbeddingCache
+
+
+class FakeVectorizer:
+    """
+    A stand-in for :class:`Vectorizer` that embeds text without a model.
+
+    Every normalized text is mapped to a random unit vector seeded by its hash, so equal texts get equal vectors
+    and different texts get nearly orthogonal ones. It is meant for timing the code around the model offline,
+    not for judging search quality.
+    """
+
+    def __init__(self, dimension=384, model_name="fake"):
+        """
+        Initialize a FakeVectorizer object.
+
+        :param dimension: The dimension of the vectors.
+        :type dimension: int
+        :param model_name: The name reported in place of a model name.
+        :type model_name: str
+        """
+        self.dimension = dimension
+        self.model_name = model_name
+
+    def vectorize(self, text):
+        """
+        Embed a single text. See :meth:`Vectorizer.vectorize`.
+        """
+        return self.vectorize_batch([text])[0]
+
+    def vectorize_batch(self, texts):
+        """
+        Embed many texts. See :meth:`Vectorizer.vectorize_batch`.
+        """
+        vectors = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            digest = hashlib.sha1(EmbeddingCache.normalize(text).encode("utf-8")).digest()
+            rng = np.random.default_rng(int.from_bytes(digest[:8], "little"))
+            vectors[row] = rng.standard_normal(self.dimension, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
@@ -5,11 +5,16 @@ The Book class represents a book entity with attributes such as title, author, a
 
 The BookManager class manages interactions with the Elasticsearch index for books, providing methods to index a book, retrieve all books, and search for books based on a query.
 
-The script iterates through a list of titles, authors, and genres, creates Book instances for each book, and indexes them using the BookManager.
+The script syncs the lists of titles, authors, and genres into the index through a single BookManager. Books are stored under ids derived from their title and author, so running it again only embeds and writes the books that were added or changed, and deletes those that were removed. Use Ingest.py to load a larger catalog from a file.
+
+Like ``Ingest.py --sync``, it refuses to delete more than SYNC_MAX_DELETE_FRACTION of the books unless run with
+``--allow-deletes``.
 
 """
 
-from Book import Book
+import argparse
+
+import Config
 from BookManager import BookManager
 
 # List of titles
@@ -84,16 +89,19 @@ genres = [
     "Computer Science"
 ]
 
-for i in range(len(titles)):
-    title = titles[i]
-    author = authors[i]
-    genre = genres[i]
-
-    # Create a book instance
-    book = Book(title=title, author=author, genre=genre)
+parser = argparse.ArgumentParser(description="Sync the sample catalog into the books index.")
+parser.add_argument("--allow-deletes", action="store_true",
+                    help="let the sync delete more than SYNC_MAX_DELETE_FRACTION of the books")
+args = parser.parse_args()
 
-    # Create a book manager instance
-    bookmanager = BookManager()
+# Create a single book manager instance
+bookmanager = BookManager()
 
-    # Index the book
-    bookmanager.index_book(book)
+# Embed and index the new and changed books, and delete the removed ones
+summary = bookmanager.sync_catalog(zip(titles, authors, genres), batch_size=len(titles),
+                                   max_delete_fraction=1.0 if args.allow_deletes else Config.SYNC_MAX_DELETE_FRACTION)
+print(f"Added {summary['added']}, updated {summary['updated']}, deleted {summary['deleted']} and left "
+      f"{summary['unchanged']} books unchanged.")
+if summary["delete_refused"]:
+    print(f"Refused to delete {summary['delete_refused']} books missing from the catalog; rerun with "
+          f"--allow-deletes if they should go.")
@@ -0,0 +1,374 @@
+import heapq
+import itertools
+import math
+import re
+import threading
+
+import numpy as np
+
+import Config
+import Telemetry
+from ElasticsearchManager import ElasticsearchManager
+from Vectorizer import Vectorizer
+
+
+class _MemoryIndex:
+    """The documents of one index, an inverted index over their text and a matrix of their vectors."""
+
+    def __init__(self, dimension):
+        self.docs = {}
+        self.postings = {}
+        self.matrix = np.zeros((0, dimension), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.rows = {}
+        self.ids = []
+        self.refresh_interval = None
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"\w+", str(text).lower())
+
+    def put(self, doc_id, document):
+        created = doc_id not in self.docs
+        if not created:
+            self.remove(doc_id)
+        document = dict(document)
+        vector = document.pop("vector", None)
+        self.docs[doc_id] = document
+        for field, value in document.items():
+            if isinstance(value, str):
+                field_postings = self.postings.setdefault(field, {})
+                for token in set(self.tokenize(value)):
+                    field_postings.setdefault(token, set()).add(doc_id)
+        if vector is not None:
+            self._set_vector(doc_id, vector)
+        return created
+
+    def remove(self, doc_id):
+        document = self.docs.pop(doc_id, None)
+        if document is None:
+            return False
+        for field, value in document.items():
+            if isinstance(value, str):
+                for token in set(self.tokenize(value)):
+                    self.postings[field][token].discard(doc_id)
+        row = self.rows.pop(doc_id, None)
+        if row is not None:
+            self.ids[row] = None
+            self.matrix[row] = 0.0
+            self.norms[row] = 0.0
+        return True
+
+    def _set_vector(self, doc_id, vector):
+        row = self.rows.get(doc_id)
+        if row is None:
+            row = len(self.ids)
+            if row >= self.matrix.shape[0]:
+                capacity = max(2 * row, 1024)
+                self.matrix = np.resize(self.matrix, (capacity, self.matrix.shape[1]))
+                self.norms = np.resize(self.norms, capacity)
+            self.ids.append(doc_id)
+            self.rows[doc_id] = row
+        self.matrix[row] = np.asarray(vector, dtype=np.float32)
+        self.norms[row] = np.linalg.norm(self.matrix[row])
+
+    def match(self, field, text):
+        """Score documents by the summed IDF of the tokens of ``text`` found in ``field``."""
+        field_postings = self.postings.get(field, {})
+        count = len(self.docs)
+        scores = {}
+        for token in set(self.tokenize(text)):
+            doc_ids = field_postings.get(token)
+            if not doc_ids:
+                continue
+            idf = math.log(1.0 + (count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            for doc_id in doc_ids:
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf
+        return scores
+
+    def nearest(self, query_vector, k):
+        """Find the ``k`` documents with the most similar vectors, scored like Elasticsearch's cosine kNN."""
+        count = len(self.ids)
+        k = min(k, len(self.rows))
+        if k == 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        norms = self.norms[:count]
+        scores = (self.matrix[:count] @ query) / np.maximum(norms, 1e-12)
+        scores[norms == 0.0] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float((1.0 + scores[row]) / 2.0)) for row in top]
+
+    def source(self, doc_id, spec=True):
+        """Project the ``_source`` of a document like the ``_source`` search parameter."""
+        if spec is False:
+            return {}
+        includes, excludes = None, ()
+        if isinstance(spec, (list, tuple)):
+            includes = spec
+        elif isinstance(spec, dict):
+            includes = spec.get("includes")
+            excludes = spec.get("excludes", ())
+        document = self.docs[doc_id]
+        fields = list(document) + (["vector"] if doc_id in self.rows and Config.SOURCE_VECTORS else [])
+        return {
+            field: self.matrix[self.rows[doc_id]].tolist() if field == "vector" else document[field]
+            for field in fields
+            if (includes is None or field in includes) and field not in excludes
+        }
+
+
+@Telemetry.instrument("elasticsearch")
+class InMemoryElasticsearchManager(ElasticsearchManager):
+    """
+    A stand-in for :class:`ElasticsearchManager` that keeps every index in process memory.
+
+    It answers the queries built in this repo (``match_all``, ``match``, ``multi_match``, ``bool`` with ``must``,
+    ``term`` and kNN) closely enough to run the code around Elasticsearch offline, e.g. in Benchmark.py. Text
+    fields are matched token by token through an inverted index and scored by the summed IDF of the matched
+    tokens; vector searches are always exact. Unlike the real manager, ``search_book`` results are not cached, so
+    every call measures the search itself. Spans are named like those of the real manager.
+    """
+
+    def __init__(self, dimension=384, vectorizer=None):
+        """
+        Initialize an InMemoryElasticsearchManager object with empty indices.
+
+        :param dimension: The dimension of the vectors.
+        :type dimension: int
+        :param vectorizer: The vectorizer hybrid searches embed their keywords with, or None for a Vectorizer.
+        :type vectorizer: Vectorizer
+        """
+        self.dimension = dimension
+        self.vectorizer = vectorizer or Vectorizer()
+        self._indices = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def _index(self, index_name):
+        index = self._indices.get(index_name)
+        if index is None:
+            index = self._indices[index_name] = _MemoryIndex(self.dimension)
+        return index
+
+    def _next_id(self):
+        return format(next(self._ids), "x")
+
+    def _evaluate(self, index, query):
+        """
+        Score the documents matching a query.
+
+        :return: The scores of the matching documents, by id.
+        :rtype: dict
+        """
+        if not query or "match_all" in query:
+            return dict.fromkeys(index.docs, 1.0)
+        if "term" in query:
+            (field, value), = query["term"].items()
+            if isinstance(value, dict):
+                value = value["value"]
+            return {doc_id: 1.0 for doc_id, document in index.docs.items() if document.get(field) == value}
+        if "match" in query:
+            (field, text), = query["match"].items()
+            if isinstance(text, dict):
+                text = text["query"]
+            return index.match(field, text)
+        if "multi_match" in query:
+            scores = {}
+            for field in query["multi_match"]["fields"]:
+                for doc_id, score in index.match(field.split("^")[0], query["multi_match"]["query"]).items():
+                    scores[doc_id] = max(scores.get(doc_id, 0.0), score)
+            return scores
+        if "bool" in query:
+            clauses = query["bool"].get("must", [])
+            if isinstance(clauses, dict):
+                clauses = [clauses]
+            if not clauses:
+                return dict.fromkeys(index.docs, 1.0)
+            scores = self._evaluate(index, clauses[0])
+            for clause in clauses[1:]:
+                clause_scores = self._evaluate(index, clause)
+                scores = {doc_id: score + clause_scores[doc_id] for doc_id, score in scores.items()
+                          if doc_id in clause_scores}
+            return scores
+        raise ValueError(f"Unsupported query: {query}")
+
+    def _search(self, index_name, query=None, size=10, source=True, sort=None):
+        """
+        Run a query, returning hits shaped like those of the search API.
+
+        Without ``sort``, hits are ordered by score. With it, documents whose sort keys compare equal keep the order
+        they matched in, which for ``match_all`` and ``term`` queries is index order.
+        """
+        with self._lock:
+            index = self._index(index_name)
+            scores = self._evaluate(index, query)
+            if sort is None:
+                doc_ids = heapq.nlargest(size, scores, key=scores.get)
+            else:
+                doc_ids = list(scores)
+                for clause in reversed(sort):
+                    (field, order), = clause.items()
+                    if isinstance(order, dict):
+                        order = order.get("order", "asc")
+                    doc_ids.sort(key=lambda doc_id: index.docs[doc_id].get(field), reverse=order == "desc")
+            return [{"_id": doc_id, "_score": scores[doc_id], "_source": index.source(doc_id, source)}
+                    for doc_id in doc_ids[:size]]
+
+    def _knn(self, index_name, query_vector, k, source=True):
+        with self._lock:
+            index = self._index(index_name)
+            return [{"_id": doc_id, "_score": score, "_source": index.source(doc_id, source)}
+                    for doc_id, score in index.nearest(query_vector, k)]
+
+    def index(self, index_name, document, refresh=None):
+        """
+        Index a document under a new id. See :meth:`ElasticsearchManager.index`.
+        """
+        with self._lock:
+            doc_id = self._next_id()
+            self._index(index_name).put(doc_id, document)
+        return {"_index": index_name, "_id": doc_id, "result": "created"}
+
+    def put(self, index_name, document_id, document, routing=None, refresh=None):
+        """
+        Create or overwrite the document with the given id. See :meth:`ElasticsearchManager.put`.
+        """
+        with self._lock:
+            created = self._index(index_name).put(document_id, document)
+        return {"_index": index_name, "_id": document_id, "result": "created" if created else "updated"}
+
+    def delete_by_id(self, index_name, document_id, routing=None, refresh=None):
+        """
+        Delete the document with the given id, if it exists. See :meth:`ElasticsearchManager.delete_by_id`.
+        """
+        with self._lock:
+            deleted = self._index(index_name).remove(document_id)
+        return {"_index": index_name, "_id": document_id, "result": "deleted" if deleted else "not_found"}
+
+    def get_by_term(self, index_name, field, value, routing=None, size=100, sort=None):
+        """
+        Retrieve the documents whose keyword field equals a value. See :meth:`ElasticsearchManager.get_by_term`.
+        """
+        hits = self._search(index_name, query={"term": {field: value}}, size=size, sort=sort)
+        return [hit["_source"] for hit in hits]
+
+    def delete_by_term(self, index_name, field, value, routing=None, refresh=False):
+        """
+        Delete the documents whose keyword field equals a value. See :meth:`ElasticsearchManager.delete_by_term`.
+        """
+        with self._lock:
+            index = self._index(index_name)
+            for doc_id in list(self._evaluate(index, {"term": {field: value}})):
+                index.remove(doc_id)
+
+    def bulk(self, index_name, actions, chunk_size=500, thread_count=1):
+        """
+        Apply write actions in order. See :meth:`ElasticsearchManager.bulk`.
+        """
+        for action in actions:
+            op_type = action.get("_op_type", "index")
+            if op_type == "delete":
+                response = self.delete_by_id(index_name, action["_id"])
+                yield response["result"] == "deleted", {"delete": response}
+            elif "_id" in action:
+                yield True, {op_type: self.put(index_name, action["_id"], action["_source"])}
+            else:
+                yield True, {op_type: self.index(index_name, action["_source"])}
+
+    def get_refresh_interval(self, index_name):
+        """
+        Get the refresh interval of the specified index. See :meth:`ElasticsearchManager.get_refresh_interval`.
+        """
+        return self._index(index_name).refresh_interval
+
+    def set_refresh_interval(self, index_name, interval):
+        """
+        Set the refresh interval of the specified index. It has no effect, as writes are visible immediately.
+        """
+        self._index(index_name).refresh_interval = interval
+
+    def refresh(self, index_name):
+        """
+        Do nothing, as writes are visible immediately.
+        """
+
+    def search(self, index_name, query):
+        """
+        Search documents by title. See :meth:`ElasticsearchManager.search`.
+        """
+        hits = self._search(index_name, query={"multi_match": {"query": query, "fields": ["title"]}})
+        return [hit["_source"] for hit in hits]
+
+    def match_values(self, index_name, field, text, size=Config.ROUTER_CANDIDATES):
+        """
+        Find the distinct values of a text field that best match a text. See :meth:`ElasticsearchManager.match_values`.
+
+        Misspellings are not tolerated.
+        """
+        hits = self._search(index_name, query={"match": {field: text}}, size=size, source=[field])
+        return self.distinct_values(hits, field)
+
+    def get_all(self, index_name, source=None, size=50):
+        """
+        Retrieve the first documents of the specified index. See :meth:`ElasticsearchManager.get_all`.
+        """
+        hits = self._search(index_name, size=size, source={"excludes": ["vector"]} if source is None else source)
+        return [hit["_source"] for hit in hits]
+
+    def iter_all(self, index_name, query=None, page_size=None, source=True, sort=None, routing=None):
+        """
+        Iterate over the documents of the specified index. See :meth:`ElasticsearchManager.iter_all`.
+
+        Hits are ordered by ``sort``, then index order, and are read up front rather than from a point in time.
+        """
+        # iter_all sorts by index order by default, not by score
+        yield from self._search(index_name, query=query, size=len(self._index(index_name).docs), source=source,
+                                sort=sort or [])
+
+    def delete(self, index_name, title, refresh=None):
+        """
+        Delete the best match for a title. See :meth:`ElasticsearchManager.delete`.
+        """
+        hits = self._search(index_name, query={"match": {"title": title}}, size=1, source=False)
+        if not hits:
+            return "Document not found."
+        return self.delete_by_id(index_name, hits[0]["_id"])
+
+    def clear(self, index_name, refresh=False):
+        """
+        Delete every document of the specified index. See :meth:`ElasticsearchManager.clear`.
+        """
+        with self._lock:
+            self._indices.pop(index_name, None)
+
+    def search_book(self, title, author, genre, hybrid=None):
+        """
+        Search for books like :meth:`ElasticsearchManager.search_book`, without caching the results.
+        """
+        hybrid = Config.SEARCH_MODE == "hybrid" if hybrid is None else hybrid
+        query, fallback_query = self.search_book_queries(title, author, genre)
+        if query is None:
+            return []
+
+        excludes = {"excludes": ["vector"]}
+        window = Config.HYBRID_WINDOW if hybrid else 50
+        hit_lists = [self._search(self.BOOKS_INDEX_NAME, query=query, size=50, source=excludes),
+                     self._search(self.BOOKS_INDEX_NAME, query=fallback_query, size=window, source=excludes)]
+        if hybrid:
+            query_vector = self.vectorizer.vectorize(fallback_query["multi_match"]["query"])
+            # Hits are scored (1 + cosine) / 2, like Elasticsearch's cosine kNN
+            min_score = (1.0 + Config.HYBRID_MIN_SIMILARITY) / 2.0
+            hit_lists.append([hit for hit in self._knn(self.BOOKS_INDEX_NAME, query_vector, window, source=excludes)
+                              if hit["_score"] >= min_score])
+        return self.search_book_results([{"hits": {"hits": hits}} for hits in hit_lists])
+
+    def search_vector(self, index_name, query_vector, size=5, num_candidates=None, exact=False):
+        """
+        Find the documents with the most similar vectors. See :meth:`ElasticsearchManager.search_vector`.
+
+        The search is always exact, so ``num_candidates`` and ``exact`` are ignored.
+        """
+        return self._knn(index_name, query_vector, size)
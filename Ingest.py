@@ -0,0 +1,367 @@
+"""
+This script streams a book catalog from a CSV or JSONL file into the Elasticsearch books index.
+
+Rows are read lazily, vectorized in fixed-size batches and sent through the ``_bulk`` API, so memory use does not
+depend on the catalog size. Refreshes of the books index are paused while loading. Progress is written to a
+checkpoint file after every acknowledged batch, so an interrupted run picks up where it stopped.
+
+With ``--workers``, rows are embedded by a pool of worker processes. Each loads the model once and hands back float32
+arrays through shared memory. Meanwhile, the loading process turns earlier batches into ``_bulk`` requests. Only a
+bounded number of batches are embedded or waiting to be indexed at once, so a slow cluster stalls the workers
+instead of filling memory.
+
+Each row needs ``title``, ``author`` and ``genre`` fields; CSV files must have a header row.
+
+Usage::
+
+    python Ingest.py catalog.csv --batch-size 256 --concurrency 4 --checkpoint catalog.checkpoint
+    python Ingest.py catalog.csv --workers 16 --concurrency 8
+    python Ingest.py catalog.csv --sync --summary sync-summary.json
+
+Books are indexed under ids derived from their title and author, so loading a catalog again overwrites books
+instead of duplicating them. With ``--sync``, the whole catalog is compared with the index instead. Only new and
+changed rows are embedded and written, books no longer in the catalog are deleted, and a summary of the changes is
+written. A sync deletes nothing if the catalog is empty or more than SYNC_MAX_DELETE_FRACTION of the books would be
+deleted, unless ``--allow-deletes`` is given.
+"""
+
+import argparse
+import copy
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import Config
+from Book import Book
+from BookManager import BookManager
+from Vectorizer import Vectorizer
+
+
+def read_catalog(path, skip=0):
+    """
+    Read catalog rows from a CSV or JSONL file.
+
+    :param path: The path of the catalog. Files ending in ``.jsonl`` or ``.ndjson`` are read as JSON lines,
+                 anything else as CSV.
+    :type path: str
+    :param skip: The number of leading rows to skip.
+    :type skip: int
+
+    :return: A generator of ``(title, author, genre)`` tuples.
+    :rtype: generator
+    """
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith((".jsonl", ".ndjson")):
+            records = (json.loads(line) for line in file if line.strip())
+        else:
+            records = csv.DictReader(file)
+        for record in itertools.islice(records, skip, None):
+            yield record["title"], record["author"], record["genre"]
+
+
+def batched(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items.
+
+    :param iterable: The items to split.
+    :type iterable: iterable
+    :param size: The maximum number of items per list.
+    :type size: int
+
+    :return: A generator of lists.
+    :rtype: generator
+    """
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def vectorize_books(rows, batch_size, vectorizer=None):
+    """
+    Turn catalog rows into Book objects, vectorizing ``batch_size`` rows per forward pass.
+
+    :param rows: The ``(title, author, genre)`` rows.
+    :type rows: iterable
+    :param batch_size: The number of rows vectorized together.
+    :type batch_size: int
+    :param vectorizer: The vectorizer to use, or None for the shared default.
+    :type vectorizer: Vectorizer
+
+    :return: A generator of Book objects, in input order.
+    :rtype: generator
+    """
+    vectorizer = vectorizer or Vectorizer()
+    for batch in batched(rows, batch_size):
+        vectors = vectorizer.vectorize_batch([Book.combined_info(*row) for row in batch])
+        for (title, author, genre), vector in zip(batch, vectors):
+            yield Book(title=title, author=author, genre=genre, vector=vector)
+
+
+_worker_vectorizer = None
+
+
+def _start_worker(vectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+
+def _embed_batch(texts):
+    """
+    Embed texts in a worker process and place the vectors in a new shared memory block.
+
+    :return: The name of the block and the shape of the float32 array in it.
+    :rtype: tuple
+    """
+    vectors = np.asarray(_worker_vectorizer.vectorize_batch(texts), dtype=np.float32)
+    block = shared_memory.SharedMemory(create=True, size=max(vectors.nbytes, 1))
+    try:
+        np.ndarray(vectors.shape, dtype=np.float32, buffer=block.buf)[...] = vectors
+    finally:
+        block.close()
+    return block.name, vectors.shape
+
+
+def _take_vectors(name, shape):
+    """
+    Copy the vectors out of a block made by :func:`_embed_batch` and free the block.
+    """
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=np.float32, buffer=block.buf).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+
+def vectorize_books_parallel(rows, batch_size, workers, max_pending=None, vectorizer=None):
+    """
+    Turn catalog rows into Book objects, vectorizing batches of rows in worker processes.
+
+    Batches are submitted ahead of the consumer until ``max_pending`` are embedded or being embedded. The next batch
+    is submitted only after the consumer has taken the oldest one, so a slow consumer throttles the workers.
+
+    :param rows: The ``(title, author, genre)`` rows.
+    :type rows: iterable
+    :param batch_size: The number of rows vectorized together.
+    :type batch_size: int
+    :param workers: The number of worker processes.
+    :type workers: int
+    :param max_pending: The number of batches submitted but not yet consumed, or None for INGEST_PENDING_PER_WORKER
+                        per worker.
+    :type max_pending: int
+    :param vectorizer: The vectorizer each worker gets a copy of, or None for the default. Unless it sets a thread
+                       count, the cores are split between the workers.
+    :type vectorizer: Vectorizer
+
+    :return: A generator of Book objects, in input order.
+    :rtype: generator
+    """
+    vectorizer = vectorizer or Vectorizer(batch_size=batch_size)
+    if getattr(vectorizer, "threads", None) == 0:
+        # Without a set thread count, every worker would start a thread per core
+        vectorizer = copy.copy(vectorizer)
+        vectorizer.threads = max(1, (os.cpu_count() or 1) // workers)
+    max_pending = max_pending or workers * Config.INGEST_PENDING_PER_WORKER
+    # Worker processes are spawned rather than forked, as forking a process with model threads running is unsafe
+    context = multiprocessing.get_context("spawn")
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_start_worker,
+                             initargs=(vectorizer,)) as pool:
+        try:
+            batches = batched(rows, batch_size)
+            while True:
+                for batch in itertools.islice(batches, max_pending - len(pending)):
+                    pending.append((batch, pool.submit(_embed_batch, [Book.combined_info(*row) for row in batch])))
+                if not pending:
+                    break
+                batch, future = pending.popleft()
+                vectors = _take_vectors(*future.result())
+                for (title, author, genre), vector in zip(batch, vectors):
+                    yield Book(title=title, author=author, genre=genre, vector=vector)
+        finally:
+            # Free the blocks of batches that were embedded but never consumed
+            for batch, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    _take_vectors(*future.result())
+
+
+def load_checkpoint(path, source):
+    """
+    Read the number of rows of ``source`` already indexed.
+
+    :param path: The path of the checkpoint file, or None.
+    :type path: str
+    :param source: The path of the catalog being ingested.
+    :type source: str
+
+    :return: The number of rows to skip.
+    :rtype: int
+    """
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    if checkpoint.get("source") != os.path.abspath(source):
+        return 0
+    return checkpoint["rows"]
+
+
+def save_checkpoint(path, source, rows):
+    """
+    Record that the first ``rows`` rows of ``source`` are indexed.
+
+    :param path: The path of the checkpoint file.
+    :type path: str
+    :param source: The path of the catalog being ingested.
+    :type source: str
+    :param rows: The number of rows indexed.
+    :type rows: int
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"source": os.path.abspath(source), "rows": rows}, file)
+    os.replace(tmp_path, path)
+
+
+def ingest(path, batch_size=Config.INGEST_BATCH_SIZE, concurrency=Config.INGEST_CONCURRENCY,
+           refresh_interval=Config.INGEST_REFRESH_INTERVAL, checkpoint=None, book_manager=None, vectorizer=None,
+           workers=Config.INGEST_WORKERS):
+    """
+    Stream a catalog file into the books index.
+
+    :param path: The path of the catalog.
+    :type path: str
+    :param batch_size: The number of books vectorized and sent per ``_bulk`` request.
+    :type batch_size: int
+    :param concurrency: The number of ``_bulk`` requests in flight at once.
+    :type concurrency: int
+    :param refresh_interval: The refresh interval of the books index while loading.
+    :type refresh_interval: str
+    :param checkpoint: The path of the checkpoint file, or None to always start from the first row.
+    :type checkpoint: str
+    :param book_manager: The book manager to index through, or None to create one.
+    :type book_manager: BookManager
+    :param vectorizer: The vectorizer to use, or None for the shared default.
+    :type vectorizer: Vectorizer
+    :param workers: The number of worker processes embedding rows, or 0 to embed them in this process.
+    :type workers: int
+
+    :return: The number of books indexed by this run.
+    :rtype: int
+    """
+    book_manager = book_manager or BookManager()
+    done = load_checkpoint(checkpoint, path)
+    rows = read_catalog(path, skip=done)
+    if workers > 0:
+        books = vectorize_books_parallel(rows, batch_size, workers, vectorizer=vectorizer)
+    else:
+        books = vectorize_books(rows, batch_size, vectorizer=vectorizer)
+
+    previous_interval = book_manager.get_refresh_interval()
+    book_manager.set_refresh_interval(refresh_interval)
+    indexed = 0
+    try:
+        for ok, item in book_manager.index_books(books, chunk_size=batch_size, thread_count=concurrency):
+            indexed += 1
+            if checkpoint and indexed % batch_size == 0:
+                save_checkpoint(checkpoint, path, done + indexed)
+    finally:
+        book_manager.set_refresh_interval(previous_interval)
+        if checkpoint:
+            save_checkpoint(checkpoint, path, done + indexed)
+    book_manager.refresh()
+    return indexed
+
+
+def sync(path, batch_size=Config.INGEST_BATCH_SIZE, concurrency=Config.INGEST_CONCURRENCY,
+         refresh_interval=Config.INGEST_REFRESH_INTERVAL, summary_path=None, book_manager=None, vectorizer=None,
+         workers=Config.INGEST_WORKERS, max_delete_fraction=Config.SYNC_MAX_DELETE_FRACTION):
+    """
+    Make the books index match a catalog file, embedding and writing only the books that changed.
+
+    :param path: The path of the catalog.
+    :type path: str
+    :param batch_size: The number of books vectorized and sent per ``_bulk`` request.
+    :type batch_size: int
+    :param concurrency: The number of ``_bulk`` requests in flight at once.
+    :type concurrency: int
+    :param refresh_interval: The refresh interval of the books index while writing.
+    :type refresh_interval: str
+    :param summary_path: A file to write the summary of the changes to, or None not to write one.
+    :type summary_path: str
+    :param book_manager: The book manager to index through, or None to create one.
+    :type book_manager: BookManager
+    :param vectorizer: The vectorizer to use, or None for the shared default.
+    :type vectorizer: Vectorizer
+    :param workers: The number of worker processes embedding rows, or 0 to embed them in this process.
+    :type workers: int
+    :param max_delete_fraction: The largest fraction of the indexed books deleted, see
+                                :meth:`BookManager.sync_catalog`.
+    :type max_delete_fraction: float
+
+    :return: The summary of the changes, see :meth:`BookManager.sync_catalog`.
+    :rtype: dict
+    """
+    book_manager = book_manager or BookManager()
+
+    def books(rows, size):
+        if workers > 0:
+            return vectorize_books_parallel(rows, size, workers, vectorizer=vectorizer)
+        return vectorize_books(rows, size, vectorizer=vectorizer)
+
+    previous_interval = book_manager.get_refresh_interval()
+    book_manager.set_refresh_interval(refresh_interval)
+    try:
+        summary = book_manager.sync_catalog(read_catalog(path), batch_size=batch_size, thread_count=concurrency,
+                                            vectorize_books=books, summary_path=summary_path,
+                                            max_delete_fraction=max_delete_fraction)
+    finally:
+        book_manager.set_refresh_interval(previous_interval)
+    book_manager.refresh()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a CSV or JSONL book catalog into Elasticsearch.")
+    parser.add_argument("path", help="catalog file with title, author and genre fields")
+    parser.add_argument("--batch-size", type=int, default=Config.INGEST_BATCH_SIZE,
+                        help="books vectorized and sent per _bulk request")
+    parser.add_argument("--concurrency", type=int, default=Config.INGEST_CONCURRENCY,
+                        help="_bulk requests in flight at once")
+    parser.add_argument("--workers", type=int, default=Config.INGEST_WORKERS,
+                        help="worker processes embedding rows, 0 to embed them in this process")
+    parser.add_argument("--refresh-interval", default=Config.INGEST_REFRESH_INTERVAL,
+                        help="refresh interval of the books index while loading")
+    parser.add_argument("--checkpoint", help="file recording progress, used to resume an interrupted run")
+    parser.add_argument("--sync", action="store_true",
+                        help="write only new and changed books and delete books missing from the catalog")
+    parser.add_argument("--summary", help="file to write the summary of a --sync run to, as JSON")
+    parser.add_argument("--allow-deletes", action="store_true",
+                        help="let a --sync run delete more than SYNC_MAX_DELETE_FRACTION of the books")
+    args = parser.parse_args()
+
+    if args.sync:
+        summary = sync(args.path, batch_size=args.batch_size, concurrency=args.concurrency,
+                       refresh_interval=args.refresh_interval, summary_path=args.summary, workers=args.workers,
+                       max_delete_fraction=1.0 if args.allow_deletes else Config.SYNC_MAX_DELETE_FRACTION)
+        print(f"Added {summary['added']}, updated {summary['updated']}, deleted {summary['deleted']} and left "
+              f"{summary['unchanged']} books unchanged.")
+        if summary["delete_refused"]:
+            print(f"Refused to delete {summary['delete_refused']} books missing from the catalog; check the "
+                  f"catalog and rerun with --allow-deletes if they should go.")
+        return
+
+    indexed = ingest(args.path, batch_size=args.batch_size, concurrency=args.concurrency,
+                     refresh_interval=args.refresh_interval, checkpoint=args.checkpoint, workers=args.workers)
+    print(f"Indexed {indexed} books.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+import re
+
+import numpy as np
+
+import Config
+from Vectorizer import Vectorizer
+
+
+class IntentRouter:
+    """
+    Recognizes simple commands locally so they can be answered without a round trip to the LLM.
+
+    A query is first matched against a small set of regular-expression grammars for cart commands and searches.
+    The title, author or genre it mentions is then resolved to a catalog value: a match query against the books
+    index finds a few candidate values, and the mention is resolved to the closest of them by Vectorizer
+    embeddings. The catalog is never loaded as a whole. Only queries whose grammar matches and whose slot resolves
+    above the similarity threshold are routed; everything else is left to the LLM, including slots that refer back
+    to the conversation, such as "it" or "the first one", which only the LLM can resolve.
+    """
+
+    _CART = r"(?:my |the )?(?:shopping )?(?:cart|basket)"
+    _POLITE = r"(?:(?:please|can you|could you|would you)\s+)*"
+    _END = r"(?:\s+please)?[\s.!?]*$"
+
+    GRAMMARS = [
+        ("Clear_Cart", None, re.compile(rf"^{_POLITE}(?:clear|empty|reset)\s+{_CART}{_END}")),
+        ("Remove_from_Cart", "title",
+         re.compile(rf"^{_POLITE}(?:remove|delete|take)\s+(?P<slot>.+?)\s+(?:out\s+)?(?:from|of)\s+{_CART}{_END}")),
+        ("Add_to_Cart", "title",
+         re.compile(rf"^{_POLITE}(?:add|put)\s+(?P<slot>.+?)\s+(?:to|in|into)\s+{_CART}{_END}")),
+        ("Search", "author",
+         re.compile(rf"^{_POLITE}(?:show|find|list|search|give)(?: me)?(?: for)?(?: (?:all|any|the|some))?"
+                    rf" books? (?:written )?by (?P<slot>.+?){_END}")),
+        ("Search", "author", re.compile(rf"^(?:do you have|have you got) (?:any )?books? by (?P<slot>.+?){_END}")),
+        ("Search", "genre",
+         re.compile(rf"^{_POLITE}(?:show|find|list)(?: me)?(?: (?:all|any|some|the))? (?P<slot>.+?) books?{_END}")),
+        ("Search", "title", re.compile(rf"^(?:do you have|have you got|do you sell) (?P<slot>.+?){_END}")),
+    ]
+
+    # Slots made only of these words, or shorter than MIN_SLOT_LENGTH, are references, not catalog values
+    REFERENCE_WORDS = frozenset({
+        "a", "an", "the", "it", "its", "this", "that", "these", "those", "them", "they", "him", "her", "one", "ones",
+        "both", "all", "each", "every", "another", "other", "same", "of", "first", "second", "third", "last",
+        "book", "books", "title", "titles", "novel",
+    })
+    MIN_SLOT_LENGTH = 3
+
+    RESPONSES = {
+        "Clear_Cart": "I've cleared your cart.",
+        "Remove_from_Cart": "I've removed '{title}' from your cart.",
+        "Add_to_Cart": "I've added '{title}' to your cart.",
+        "Search": "Let me look that up for you.",
+    }
+
+    def __init__(self, find_values, vectorizer=None, threshold=Config.ROUTER_MATCH_THRESHOLD,
+                 candidates=Config.ROUTER_CANDIDATES):
+        """
+        Initialize an IntentRouter object.
+
+        :param find_values: A callable taking a field, a text and a number of values, and returning up to that
+                            many distinct catalog values of the field that best match the text, e.g.
+                            :meth:`ElasticsearchManager.match_values` bound to the books index.
+        :type find_values: callable
+        :param vectorizer: The vectorizer used to embed slots and catalog values, or None for the shared default.
+        :type vectorizer: Vectorizer
+        :param threshold: The cosine similarity a slot needs to a catalog value to be routed.
+        :type threshold: float
+        :param candidates: The number of catalog values a slot is resolved among.
+        :type candidates: int
+        """
+        self.find_values = find_values
+        self.vectorizer = vectorizer or Vectorizer()
+        self.threshold = threshold
+        self.candidates = candidates
+
+    def _embed(self, texts):
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        vectors = self.vectorizer.vectorize_batch([text.lower() for text in texts])
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def is_reference(self, text):
+        """
+        Tell whether a slot refers to something said earlier rather than naming a title, author or genre.
+
+        :param text: The text of the slot.
+        :type text: str
+
+        :return: True if the slot is too short or made only of pronouns and filler words.
+        :rtype: bool
+        """
+        words = re.findall(r"\w+", text.lower())
+        return len(text) < self.MIN_SLOT_LENGTH or all(word in self.REFERENCE_WORDS for word in words)
+
+    def resolve(self, field, text):
+        """
+        Find the catalog value of a field closest to a text, among the candidate values matching it.
+
+        :param field: "title", "author" or "genre".
+        :type field: str
+        :param text: The text mentioned by the user.
+        :type text: str
+
+        :return: The catalog value, or None if nothing is similar enough.
+        :rtype: str
+        """
+        values = self.find_values(field, text, self.candidates)
+        if not values:
+            return None
+        for value in values:
+            if value.lower() == text:
+                return value
+        # A name or word that occurs in exactly one candidate value, e.g. "tolkien"
+        partial = [value for value in values if re.search(rf"\b{re.escape(text)}\b", value.lower())]
+        if len(partial) == 1:
+            return partial[0]
+        scores = self._embed(values) @ self._embed([text])[0]
+        best = int(np.argmax(scores))
+        return values[best] if scores[best] >= self.threshold else None
+
+    def route(self, query):
+        """
+        Classify a query locally.
+
+        :param query: The user's query.
+        :type query: str
+
+        :return: The action, book title, author, genre and response text, in the shape returned by
+                 :meth:`Chatbot.extract_action`, or None if the query should go to the LLM.
+        :rtype: tuple
+        """
+        query = " ".join(query.lower().split())
+        for action, field, grammar in self.GRAMMARS:
+            match = grammar.match(query)
+            if not match:
+                continue
+            slots = {"title": "None", "author": "None", "genre": "None"}
+            if field:
+                slot = match.group("slot").strip(" '\"")
+                if self.is_reference(slot):
+                    return None
+                value = self.resolve(field, slot)
+                if value is None:
+                    return None
+                slots[field] = value
+            response = self.RESPONSES[action].format(**slots)
+            return action, slots["title"], slots["author"], slots["genre"], response
+        return None
+
+    @staticmethod
+    def format_action_tag(action, title, author, genre):
+        """
+        Format an action the way the LLM is prompted to, so routed turns read like LLM turns in the history.
+
+        :param action: The action name.
+        :type action: str
+        :param title: The book title of the action.
+        :type title: str
+        :param author: The author of the action.
+        :type author: str
+        :param genre: The genre of the action.
+        :type genre: str
+
+        :return: The action tag.
+        :rtype: str
+        """
+        return f"[ACTION: {action}; BOOK_TITLE: {title}; AUTHOR: {author}; GENRE: {genre}]"
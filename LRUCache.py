@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache with an optional time to live per entry."""
+
+    _MISSING = object()
+
+    def __init__(self, max_size=1024, ttl=None):
+        """
+        Initialize an LRUCache object.
+
+        :param max_size: The maximum number of entries kept before the least recently used one is evicted.
+        :type max_size: int
+        :param ttl: The number of seconds an entry stays valid, or None to keep entries until evicted.
+        :type ttl: float
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value stored under a key and mark it as recently used.
+
+        :param key: The key to look up.
+        :type key: hashable
+        :param default: The value returned if the key is missing or expired.
+
+        :return: The cached value, or ``default``.
+        """
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is self._MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Store a value under a key, evicting the least recently used entry if the cache is full.
+
+        :param key: The key to store the value under.
+        :type key: hashable
+        :param value: The value to store.
+        """
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove a key from the cache.
+
+        :param key: The key to remove.
+        :type key: hashable
+        :param default: The value returned if the key is missing.
+
+        :return: The removed value, or ``default``.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, self._MISSING)
+        return default if entry is self._MISSING else entry[0]
+
+    def items(self):
+        """
+        Return a snapshot of the unexpired entries, least recently used first.
+
+        :return: A list of ``(key, value)`` pairs.
+        :rtype: list
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [(key, value) for key, (value, expires_at) in self._entries.items()
+                    if expires_at is None or expires_at >= now]
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+
+import numpy as np
+
+
+class LocalVectorIndex:
+    """
+    An in-process copy of the book vectors for exact similarity search without Elasticsearch.
+
+    Vectors are L2-normalized and stored as rows of a float32 matrix in a memory-mapped file, so cosine similarity
+    against the whole catalog is a single matrix-vector product. Document ids and sources are kept in an
+    append-only JSON lines file next to it. Removed documents leave an unused row behind until the next
+    :meth:`sync`.
+    """
+
+    def __init__(self, path, dimension=384, initial_capacity=1024):
+        """
+        Initialize a LocalVectorIndex object, opening the files at ``path`` if they exist.
+
+        :param path: The path prefix of the index files; ``.f32`` and ``.jsonl`` are appended to it.
+        :type path: str
+        :param dimension: The dimension of the vectors.
+        :type dimension: int
+        :param initial_capacity: The number of rows allocated when the index is created.
+        :type initial_capacity: int
+        """
+        self.path = path
+        self.dimension = dimension
+        self.initial_capacity = initial_capacity
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def _matrix_path(self):
+        return self.path + ".f32"
+
+    @property
+    def _meta_path(self):
+        return self.path + ".jsonl"
+
+    def _load(self):
+        """Open the index files, creating empty ones if they do not exist."""
+        self.ids = []
+        self.sources = []
+        self._rows = {}
+        self._removed = set()
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as file:
+                for line in file:
+                    entry = json.loads(line)
+                    if entry["_id"] is None:
+                        self._clear_meta(entry["row"])
+                    else:
+                        self._set_meta(entry["row"], entry["_id"], entry["_source"])
+        if not os.path.exists(self._matrix_path):
+            self._resize_file(self.initial_capacity)
+        self._open_matrix()
+
+    def _open_matrix(self):
+        capacity = os.path.getsize(self._matrix_path) // (4 * self.dimension)
+        self._matrix = np.memmap(self._matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimension))
+
+    def _resize_file(self, capacity):
+        with open(self._matrix_path, "ab") as file:
+            file.truncate(capacity * self.dimension * 4)
+
+    def _set_meta(self, row, doc_id, source):
+        if row == len(self.ids):
+            self.ids.append(doc_id)
+            self.sources.append(source)
+        else:
+            self.ids[row] = doc_id
+            self.sources[row] = source
+        self._rows[doc_id] = row
+
+    def _clear_meta(self, row):
+        self._rows.pop(self.ids[row], None)
+        self.ids[row] = None
+        self.sources[row] = None
+        self._removed.add(row)
+
+    def __len__(self):
+        return len(self.ids) - len(self._removed)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def add(self, doc_id, source, vector):
+        """
+        Add a document to the index, or replace it if its id is already present.
+
+        :param doc_id: The Elasticsearch id of the document.
+        :type doc_id: str
+        :param source: The document fields returned with search hits; the vector is dropped from it.
+        :type source: dict
+        :param vector: The vector of the document.
+        :type vector: numpy.ndarray
+        """
+        self.add_many([(doc_id, source, vector)])
+
+    def add_many(self, documents):
+        """
+        Add several documents to the index, replacing those whose id is already present.
+
+        :param documents: ``(doc_id, source, vector)`` tuples. May be a generator.
+        :type documents: iterable
+        """
+        with self._lock, open(self._meta_path, "a", encoding="utf-8") as file:
+            for doc_id, source, vector in documents:
+                source = {key: value for key, value in source.items() if key != "vector"}
+                row = self._rows.get(doc_id, len(self.ids))
+                if row >= self._matrix.shape[0]:
+                    self._matrix.flush()
+                    del self._matrix
+                    self._resize_file(max(2 * row, self.initial_capacity))
+                    self._open_matrix()
+                self._matrix[row] = self._normalize(vector)
+                file.write(json.dumps({"row": row, "_id": doc_id, "_source": source}) + "\n")
+                self._set_meta(row, doc_id, source)
+            self._matrix.flush()
+
+    def remove_many(self, doc_ids):
+        """
+        Remove documents from the index. Ids not in the index are ignored.
+
+        :param doc_ids: The Elasticsearch ids of the documents.
+        :type doc_ids: iterable
+        """
+        with self._lock, open(self._meta_path, "a", encoding="utf-8") as file:
+            for doc_id in doc_ids:
+                row = self._rows.get(doc_id)
+                if row is None:
+                    continue
+                self._matrix[row] = 0.0
+                file.write(json.dumps({"row": row, "_id": None, "_source": None}) + "\n")
+                self._clear_meta(row)
+            self._matrix.flush()
+
+    def sync(self, hits):
+        """
+        Replace the contents of the index with the given Elasticsearch hits.
+
+        :param hits: Hits with ``_id`` and a ``_source`` holding a ``vector`` field, e.g. from scanning the books
+                     index.
+        :type hits: iterable
+        """
+        with self._lock:
+            self._matrix.flush()
+            del self._matrix
+            for file_path in (self._matrix_path, self._meta_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            self._load()
+        self.add_many((hit["_id"], hit["_source"], hit["_source"]["vector"]) for hit in hits)
+
+    def search(self, query_vector, k=5):
+        """
+        Find the documents most similar to a vector.
+
+        :param query_vector: The vector to find similar documents to.
+        :type query_vector: numpy.ndarray
+        :param k: The number of documents to return.
+        :type k: int
+
+        :return: Hits shaped like Elasticsearch kNN hits, most similar first.
+        :rtype: list
+        """
+        return self.search_batch([query_vector], k=k)[0]
+
+    def search_batch(self, query_vectors, k=5):
+        """
+        Find the documents most similar to each of several vectors with one matrix product.
+
+        Scores follow Elasticsearch's kNN cosine scoring, ``(1 + cosine) / 2``, so they can be compared with
+        scores from :meth:`ElasticsearchManager.search_vector`.
+
+        :param query_vectors: The vectors to find similar documents to.
+        :type query_vectors: list
+        :param k: The number of documents to return per vector.
+        :type k: int
+
+        :return: One list of hits per query vector, most similar first.
+        :rtype: list
+        """
+        queries = self._normalize(np.atleast_2d(query_vectors))
+        with self._lock:
+            count = len(self.ids)
+            scores = queries @ self._matrix[:count].T
+            if self._removed:
+                scores[:, sorted(self._removed)] = -np.inf
+            k = min(k, count - len(self._removed))
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        return [
+            [{"_id": self.ids[row], "_score": float((1.0 + score) / 2.0), "_source": self.sources[row]}
+             for row, score in zip(rows, row_scores)]
+            for rows, row_scores in zip(top, top_scores)
+        ]
@@ -0,0 +1,302 @@
+"""
+This script precomputes the most similar books of every book in the books index into a NeighbourTable.
+
+Recommendations for a book are then a keyed lookup instead of a similarity search. BookManager keeps the table
+up to date as books are indexed or deleted; run the script again to rebuild it from scratch, e.g. after many
+deletions. Vectors are read from Elasticsearch, which only keeps them with SOURCE_VECTORS; otherwise pass
+``--reembed`` to recompute every vector with the current vectorizer.
+
+Usage::
+
+    python NeighbourTable.py --k 20 --block-size 4096
+"""
+
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+import Config
+
+
+class NeighbourTable:
+    """
+    The ``k`` most similar books of every book, by cosine similarity, stored in side files.
+
+    The table is computed by blocked matrix multiplication over L2-normalized float32 vectors. Every block of books
+    is multiplied with every block of the catalog, and a running top ``k`` is kept per book, so memory use is
+    bounded by ``block_size`` squared rather than the catalog size squared. A book is never its own neighbour.
+
+    The files sit next to each other at ``path``:
+
+    * ``.neighbours.npy``: an int32 ``(books, k)`` matrix of neighbour rows, most similar first, -1 for none.
+    * ``.scores.npy``: the matching float32 cosine similarities.
+    * ``.vectors.npy``: the normalized vectors, memory-mapped and only read to update the table.
+    * ``.jsonl``: the id and source of the book in each row.
+
+    Adding books updates the table exactly: new books are compared with the whole catalog, and existing books with
+    the new ones. The arrays in memory are allocated with spare rows, doubling when full, so that adding a batch
+    does not copy the whole table. Removed books are skipped in lookups but not replaced, so lists shrink until the
+    next rebuild.
+    """
+
+    def __init__(self, path, k=10, block_size=4096):
+        """
+        Initialize a NeighbourTable object, opening the files at ``path`` if they exist.
+
+        :param path: The path prefix of the table files.
+        :type path: str
+        :param k: The number of neighbours kept per book. A table already on disk keeps its own until rebuilt.
+        :type k: int
+        :param block_size: The number of books multiplied at once, in each dimension of the similarity matrix.
+        :type block_size: int
+        """
+        self.path = path
+        self.k = self._build_k = k
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._load()
+
+    def _file(self, suffix):
+        return self.path + suffix
+
+    def _load(self):
+        """Open the table files, or start an empty table if they do not exist."""
+        self.ids = []
+        self.sources = []
+        self._rows = {}
+        self._neighbours = np.full((0, self.k), -1, dtype=np.int32)
+        self._scores = np.full((0, self.k), -np.inf, dtype=np.float32)
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._removed = np.zeros(0, dtype=bool)
+        if not os.path.exists(self._file(".jsonl")):
+            return
+        with open(self._file(".jsonl"), encoding="utf-8") as file:
+            for row, line in enumerate(file):
+                entry = json.loads(line)
+                self.ids.append(entry["_id"])
+                self.sources.append(entry["_source"])
+                if entry["_id"] is not None:
+                    self._rows[entry["_id"]] = row
+        self._neighbours = np.load(self._file(".neighbours.npy"))
+        self._scores = np.load(self._file(".scores.npy"))
+        # Read-only until the first addition copies it into a larger array
+        self._vectors = np.load(self._file(".vectors.npy"), mmap_mode="r")
+        self._removed = np.array([doc_id is None for doc_id in self.ids], dtype=bool)
+        self.k = self._neighbours.shape[1]
+
+    def save(self):
+        """
+        Write the table to its files, each under a temporary name first, so readers never see a partial file.
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            count = len(self.ids)
+            arrays = {".neighbours.npy": self._neighbours[:count], ".scores.npy": self._scores[:count],
+                      ".vectors.npy": np.asarray(self._vectors[:count])}
+            for suffix, array in arrays.items():
+                with open(self._file(suffix) + ".tmp", "wb") as file:
+                    np.save(file, array)
+                os.replace(self._file(suffix) + ".tmp", self._file(suffix))
+            with open(self._file(".jsonl") + ".tmp", "w", encoding="utf-8") as file:
+                for doc_id, source in zip(self.ids, self.sources):
+                    file.write(json.dumps({"_id": doc_id, "_source": source}) + "\n")
+            os.replace(self._file(".jsonl") + ".tmp", self._file(".jsonl"))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _merge(self, best_rows, best_scores, scores, first_column):
+        """
+        Merge a block of similarities, whose columns are rows ``first_column`` onwards, into running top-k lists.
+        """
+        columns = np.broadcast_to(np.arange(first_column, first_column + scores.shape[1], dtype=np.int32),
+                                  scores.shape)
+        rows = np.concatenate([best_rows, columns], axis=1)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        top = np.argpartition(-scores, self.k - 1, axis=1)[:, :self.k]
+        return np.take_along_axis(rows, top, axis=1), np.take_along_axis(scores, top, axis=1)
+
+    def _top_k(self, queries, query_rows, best_rows, best_scores, first_column, removed):
+        """
+        Fold the similarities of ``queries`` to every vector from row ``first_column`` on into their top-k lists.
+
+        :param queries: Normalized vectors of shape ``(queries, dimension)``.
+        :param query_rows: The rows of the queries, whose similarity to themselves is left out.
+        :param best_rows: The current neighbour rows of the queries.
+        :param best_scores: The current neighbour similarities of the queries.
+        :param first_column: The first row to compare with.
+        :param removed: A boolean mask of the removed rows.
+
+        :return: The updated neighbour rows and similarities, most similar first.
+        :rtype: tuple
+        """
+        for start in range(first_column, len(self.ids), self.block_size):
+            end = min(start + self.block_size, len(self.ids))
+            scores = queries @ np.asarray(self._vectors[start:end]).T
+            scores[:, removed[start:end]] = -np.inf
+            own = (query_rows >= start) & (query_rows < end)
+            scores[np.flatnonzero(own), query_rows[own] - start] = -np.inf
+            best_rows, best_scores = self._merge(best_rows, best_scores, scores, start)
+        order = np.argsort(-best_scores, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows[np.isneginf(best_scores)] = -1
+        return best_rows, best_scores
+
+    def build(self, documents):
+        """
+        Replace the table with the neighbours of the given documents among themselves.
+
+        :param documents: ``(doc_id, source, vector)`` tuples, e.g. every book of the books index. May be a
+                          generator.
+        :type documents: iterable
+        """
+        with self._lock:
+            self.ids, self.sources, vectors = [], [], []
+            for doc_id, source, vector in documents:
+                self.ids.append(doc_id)
+                self.sources.append({key: value for key, value in source.items() if key != "vector"})
+                vectors.append(vector)
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+            count = len(self.ids)
+            dimension = len(vectors[0]) if vectors else 0
+            self.k = self._build_k
+            self._vectors = self._normalize(vectors).reshape(count, dimension)
+            self._neighbours = np.full((count, self.k), -1, dtype=np.int32)
+            self._scores = np.full((count, self.k), -np.inf, dtype=np.float32)
+            self._removed = np.zeros(count, dtype=bool)
+            self._update_rows(0, count, first_column=0)
+
+    def _reserve(self, count):
+        """
+        Make room for ``count`` rows, moving the used rows to arrays of twice the capacity when they are full.
+        """
+        capacity = len(self._neighbours)
+        if count <= capacity:
+            return
+        capacity = max(count, 2 * capacity)
+        used = len(self.ids)
+        vectors = np.zeros((capacity, self._vectors.shape[1]), dtype=np.float32)
+        vectors[:used] = self._vectors[:used]
+        neighbours = np.full((capacity, self.k), -1, dtype=np.int32)
+        neighbours[:used] = self._neighbours[:used]
+        scores = np.full((capacity, self.k), -np.inf, dtype=np.float32)
+        scores[:used] = self._scores[:used]
+        removed = np.zeros(capacity, dtype=bool)
+        removed[:used] = self._removed[:used]
+        self._vectors, self._neighbours, self._scores, self._removed = vectors, neighbours, scores, removed
+
+    def _update_rows(self, first_row, end_row, first_column):
+        """
+        Fold the similarities to rows ``first_column`` onwards into the lists of rows ``first_row`` to ``end_row``.
+        """
+        for start in range(first_row, end_row, self.block_size):
+            end = min(start + self.block_size, end_row)
+            self._neighbours[start:end], self._scores[start:end] = self._top_k(
+                np.asarray(self._vectors[start:end]), np.arange(start, end), self._neighbours[start:end],
+                self._scores[start:end], first_column, self._removed)
+
+    def add_many(self, documents):
+        """
+        Add documents to the table, replacing those whose id is already present, and update the neighbours of
+        every book they are now among.
+
+        :param documents: ``(doc_id, source, vector)`` tuples.
+        :type documents: iterable
+        """
+        documents = list(documents)
+        if not documents:
+            return
+        if not self.ids:
+            self.build(documents)
+            return
+        self.remove_many(doc_id for doc_id, source, vector in documents)
+        with self._lock:
+            first_new = len(self.ids)
+            self._reserve(first_new + len(documents))
+            self._vectors[first_new:first_new + len(documents)] = self._normalize(
+                [vector for doc_id, source, vector in documents])
+            for doc_id, source, vector in documents:
+                self.ids.append(doc_id)
+                self.sources.append({key: value for key, value in source.items() if key != "vector"})
+            # Existing books only need comparing with the new ones; new books with everything
+            self._update_rows(0, first_new, first_column=first_new)
+            self._update_rows(first_new, len(self.ids), first_column=0)
+            # Only now can lookups find the new rows, whose neighbour lists are complete
+            for row, (doc_id, source, vector) in enumerate(documents, start=first_new):
+                self._rows[doc_id] = row
+
+    def remove_many(self, doc_ids):
+        """
+        Remove documents from the table. Ids not in the table are ignored.
+
+        :param doc_ids: The ids of the documents.
+        :type doc_ids: iterable
+        """
+        with self._lock:
+            for doc_id in doc_ids:
+                row = self._rows.pop(doc_id, None)
+                if row is not None:
+                    self.ids[row] = None
+                    self.sources[row] = None
+                    self._removed[row] = True
+
+    def lookup(self, doc_id, size=None):
+        """
+        Return the precomputed neighbours of a document.
+
+        :param doc_id: The id of the document.
+        :type doc_id: str
+        :param size: The number of neighbours to return, at most ``k``, or None for all of them.
+        :type size: int
+
+        :return: Hits shaped like Elasticsearch kNN hits, most similar first, or None if the document is not in
+                 the table.
+        :rtype: list
+        """
+        row = self._rows.get(doc_id)
+        if row is None:
+            return None
+        hits = []
+        for neighbour, score in zip(self._neighbours[row], self._scores[row]):
+            if neighbour >= 0 and self.ids[neighbour] is not None:
+                hits.append({"_id": self.ids[neighbour], "_score": float((1.0 + score) / 2.0),
+                             "_source": self.sources[neighbour]})
+                if size is not None and len(hits) == size:
+                    break
+        return hits
+
+
+def main():
+    from BookManager import BookManager
+
+    parser = argparse.ArgumentParser(description="Precompute the most similar books of every book.")
+    parser.add_argument("--path", default=Config.NEIGHBOUR_TABLE_PATH or "neighbours",
+                        help="path prefix of the table files")
+    parser.add_argument("--k", type=int, default=Config.NEIGHBOUR_TABLE_K, help="neighbours kept per book")
+    parser.add_argument("--block-size", type=int, default=4096, help="books multiplied at once")
+    parser.add_argument("--reembed", action="store_true",
+                        help="recompute the vectors of every book if Elasticsearch does not keep them "
+                             "(SOURCE_VECTORS unset)")
+    args = parser.parse_args()
+
+    table = NeighbourTable(args.path, k=args.k, block_size=args.block_size)
+    book_manager = BookManager(neighbour_table=table)
+    book_manager.build_neighbour_table(reembed=args.reembed)
+    print(f"Precomputed {args.k} neighbours for {len(table)} books.")
+
+
+if __name__ == "__main__":
+    main()
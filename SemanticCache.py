@@ -0,0 +1,176 @@
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+import Config
+from ActionParser import ActionParser
+from LRUCache import LRUCache
+from Vectorizer import Vectorizer
+
+
+class SemanticCache:
+    """
+    Reuses LLM responses for queries that mean the same as an earlier one.
+
+    Queries are embedded with the shared Vectorizer and matched against cached queries by cosine similarity.
+    Entries expire after a time to live, and the least recently used are evicted first.
+    Entries only match queries asked after the same messages, system prompt included. A reply to a follow-up such
+    as "yes" or "the second one" is therefore never reused in another conversation, and editing ``prompt.txt``
+    invalidates every entry. Entries are grouped by the fingerprint of those messages, so a lookup scores only the
+    group of its conversation, with one matrix product. Only responses without an action or with a Search action are cached, since cart
+    actions and LAST_BOOK replies depend on the rest of the conversation.
+    """
+
+    CACHEABLE_ACTIONS = ("", "Search")
+
+    def __init__(self, vectorizer=None, threshold=Config.SEMANTIC_CACHE_THRESHOLD, ttl=Config.SEMANTIC_CACHE_TTL,
+                 max_size=Config.SEMANTIC_CACHE_SIZE):
+        """
+        Initialize a SemanticCache object.
+
+        :param vectorizer: The vectorizer used to embed queries, or None for the shared default.
+        :type vectorizer: Vectorizer
+        :param threshold: The cosine similarity above which a cached query counts as the same.
+        :type threshold: float
+        :param ttl: The number of seconds a response stays cached.
+        :type ttl: float
+        :param max_size: The maximum number of cached responses.
+        :type max_size: int
+        """
+        self.vectorizer = vectorizer or Vectorizer()
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        # Per fingerprint, an immutable group of queries, their stacked vectors, responses and expiry times
+        self.entries = LRUCache(max_size=max_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self._total_llm_latency = 0.0
+        self._llm_calls = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(messages):
+        """
+        Identify the conversation a query is asked in.
+
+        :param messages: The messages preceding the query, starting with the system prompt.
+        :type messages: list
+
+        :return: A hex digest of the roles and contents of the messages.
+        :rtype: str
+        """
+        conversation = json.dumps([[message["role"], message["content"]] for message in messages])
+        return hashlib.sha1(conversation.encode("utf-8")).hexdigest()
+
+    def _embed(self, query):
+        vector = np.asarray(self.vectorizer.vectorize(query), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def lookup(self, query, fingerprint):
+        """
+        Find the cached response of a query similar to ``query``, asked in the same conversation.
+
+        :param query: The user's query.
+        :type query: str
+        :param fingerprint: The :meth:`fingerprint` of the messages preceding the query.
+        :type fingerprint: str
+
+        :return: The cached response, including its action tag, or None.
+        :rtype: str
+        """
+        group = self.entries.get(fingerprint)
+        response = None
+        if group is not None:
+            scores = group["vectors"] @ self._embed(query)
+            scores[group["expires_at"] < time.monotonic()] = -np.inf
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                response = group["responses"][best]
+
+        with self._lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self._llm_calls:
+                self.latency_saved += self._total_llm_latency / self._llm_calls
+        return response
+
+    def store(self, query, fingerprint, response, latency):
+        """
+        Cache the response to a query, unless its action depends on the rest of the conversation.
+
+        :param query: The user's query.
+        :type query: str
+        :param fingerprint: The :meth:`fingerprint` of the messages preceding the query, taken before they were
+                            compacted for the request.
+        :type fingerprint: str
+        :param response: The raw LLM response, including its action tag.
+        :type response: str
+        :param latency: The number of seconds the LLM took to respond.
+        :type latency: float
+        """
+        with self._lock:
+            self._total_llm_latency += latency
+            self._llm_calls += 1
+        actions = [match[0] for match in ActionParser.TAG_PATTERN.findall(response)]
+        if any(action not in self.CACHEABLE_ACTIONS for action in actions):
+            return
+        key = " ".join(query.split())
+        vector = self._embed(query)
+        with self._lock:
+            now = time.monotonic()
+            group = self.entries.get(fingerprint)
+            rows = []
+            if group is not None:
+                rows = [row for row, (cached, expires_at) in enumerate(zip(group["queries"], group["expires_at"]))
+                        if cached != key and expires_at >= now]
+                # Oldest first, so a full group drops its oldest responses
+                rows = rows[max(len(rows) - self.max_size + 1, 0):]
+            queries = [group["queries"][row] for row in rows] + [key]
+            vectors = [group["vectors"][row] for row in rows] + [vector]
+            responses = [group["responses"][row] for row in rows] + [response]
+            expires_at = [group["expires_at"][row] for row in rows] + [now + self.ttl]
+            self.entries.put(fingerprint, {"queries": queries, "vectors": np.stack(vectors), "responses": responses,
+                                           "expires_at": np.array(expires_at)})
+            self._evict(fingerprint)
+
+    def _evict(self, fingerprint):
+        """
+        Drop the least recently used groups, other than that of ``fingerprint``, while the cache holds more than
+        ``max_size`` responses.
+        """
+        groups = self.entries.items()
+        size = sum(len(group["queries"]) for key, group in groups)
+        for key, group in groups:
+            if size <= self.max_size:
+                break
+            if key != fingerprint:
+                self.entries.pop(key)
+                size -= len(group["queries"])
+
+    def invalidate(self):
+        """Drop every cached response."""
+        self.entries.clear()
+
+    def stats(self):
+        """
+        Report cache effectiveness.
+
+        :return: A dictionary with ``hits``, ``misses``, ``hit_rate``, ``entries`` and ``latency_saved``, the
+                 estimated seconds of LLM time avoided.
+        :rtype: dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": sum(len(group["queries"]) for key, group in self.entries.items()),
+            "latency_saved": self.latency_saved,
+        }
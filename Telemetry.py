@@ -0,0 +1,418 @@
+"""
+Timing spans and metrics for BookWise Bot's hot paths.
+
+Code under measurement runs inside a :func:`span`, or a method wrapped by :func:`traced` or :func:`instrument`.
+Every finished span is recorded in three places:
+
+* the process-wide metrics. :func:`metrics_text` renders them in the Prometheus text format, and
+  :func:`start_metrics_server` serves them over HTTP;
+* an OpenTelemetry trace, if the ``opentelemetry`` package is installed and OTEL_TRACING is set;
+* the :class:`Turn` being recorded, if any. This gives the per-turn timing breakdown shown by the app.
+
+The metrics server also answers readiness probes at ``/ready``, see :func:`set_readiness_check`.
+
+Spans carry attributes, such as token counts, numbers of texts or hits, and whether a cache was hit. Attributes
+listed in COUNTED_ATTRIBUTES are also summed into counters.
+"""
+
+import contextlib
+import contextvars
+import functools
+import http.server
+import inspect
+import json
+import logging
+import threading
+import time
+
+import Config
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # pragma: no cover - spans are then only kept as metrics
+    otel_trace = None
+
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Numeric span attributes summed into a ``bookwise_<attribute>_total`` counter per span name
+COUNTED_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "texts", "cache_hits", "encoded", "results")
+
+_current_span = contextvars.ContextVar("telemetry_span", default=None)
+_current_turn = contextvars.ContextVar("telemetry_turn", default=None)
+_tracer = otel_trace.get_tracer("bookwise") if otel_trace is not None and Config.OTEL_TRACING else None
+
+
+class Span:
+    """A timed operation with attributes describing it."""
+
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.attributes = attributes
+        self.depth = parent.depth + 1 if parent is not None else 0
+        self.started = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        """
+        Add attributes to the span.
+        """
+        self.attributes.update(attributes)
+
+
+class Turn:
+    """The spans finished while handling one chat turn."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self):
+        """
+        Describe the spans of the turn, in the order they started.
+
+        :return: One dictionary per span, with its name, depth, duration in milliseconds and attributes.
+        :rtype: list
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.started)
+        return [dict({"span": span.name, "depth": span.depth, "ms": round(span.duration * 1000.0, 2)},
+                     **span.attributes, **({"error": span.error} if span.error else {}))
+                for span in spans]
+
+
+class MetricsRegistry:
+    """Thread-safe histograms of span durations and counters of span attributes."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._durations = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, span):
+        """
+        Record a finished span.
+
+        :param span: The span to record.
+        :type span: Span
+        """
+        with self._lock:
+            histogram = self._durations.get(span.name)
+            if histogram is None:
+                histogram = self._durations[span.name] = {"buckets": [0] * len(self.buckets), "sum": 0.0,
+                                                          "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += span.duration
+            histogram["count"] += 1
+
+            if span.error:
+                self._increment("span_errors", (("span", span.name),), 1)
+            cache_hit = span.attributes.get("cache_hit")
+            if cache_hit is not None:
+                result = "hit" if cache_hit else "miss"
+                self._increment("cache_lookups", (("span", span.name), ("result", result)), 1)
+            for attribute in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._increment(attribute, (("span", span.name),), value)
+
+    def _increment(self, name, labels, value):
+        counter = self._counters.setdefault(name, {})
+        counter[labels] = counter.get(labels, 0) + value
+
+    def render(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        :return: The metrics text.
+        :rtype: str
+        """
+        lines = ["# HELP bookwise_span_duration_seconds Duration of instrumented operations.",
+                 "# TYPE bookwise_span_duration_seconds histogram"]
+        with self._lock:
+            for name, histogram in sorted(self._durations.items()):
+                label = _labels((("span", name),))
+                for bound, count in zip(self.buckets + ("+Inf",), histogram["buckets"] + [histogram["count"]]):
+                    lines.append(f"bookwise_span_duration_seconds_bucket{_labels((('span', name), ('le', bound)))} "
+                                 f"{count}")
+                lines.append(f"bookwise_span_duration_seconds_sum{label} {histogram['sum']}")
+                lines.append(f"bookwise_span_duration_seconds_count{label} {histogram['count']}")
+            for name, counter in sorted(self._counters.items()):
+                lines.append(f"# TYPE bookwise_{name}_total counter")
+                for labels, value in sorted(counter.items()):
+                    lines.append(f"bookwise_{name}_total{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+            self._counters.clear()
+
+
+def _labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+registry = MetricsRegistry()
+
+
+@contextlib.contextmanager
+def span(name, current=True, **attributes):
+    """
+    Time the enclosed block as a span.
+
+    :param name: The name of the span, e.g. ``"elasticsearch.search_book"``.
+    :type name: str
+    :param current: Whether spans opened inside the block are its children, and :func:`annotate` applies to it.
+                    Spans kept open across a ``yield`` must not be current, as the consumer runs in between.
+    :type current: bool
+    :param attributes: Initial attributes of the span.
+
+    :return: A context manager yielding the :class:`Span`.
+    :rtype: contextlib.AbstractContextManager
+    """
+    record = Span(name, attributes, parent=_current_span.get())
+    token = _current_span.set(record) if current else None
+    otel_scope = None
+    otel_span = None
+    if _tracer is not None:
+        if current:
+            otel_scope = _tracer.start_as_current_span(name)
+            otel_span = otel_scope.__enter__()
+        else:
+            otel_span = _tracer.start_span(name)
+    try:
+        yield record
+    except Exception as error:
+        record.error = type(error).__name__
+        raise
+    finally:
+        record.duration = time.perf_counter() - record.started
+        if token is not None:
+            _current_span.reset(token)
+        if otel_span is not None:
+            otel_span.set_attributes({key: value for key, value in record.attributes.items()
+                                      if isinstance(value, (str, bool, int, float))})
+            if record.error:
+                otel_span.set_attribute("error.type", record.error)
+            if otel_scope is not None:
+                otel_scope.__exit__(None, None, None)
+            else:
+                otel_span.end()
+        registry.observe(record)
+        turn = _current_turn.get()
+        if turn is not None:
+            turn.add(record)
+
+
+def annotate(**attributes):
+    """
+    Add attributes to the current span, if there is one.
+    """
+    record = _current_span.get()
+    if record is not None:
+        record.set(**attributes)
+
+
+def _annotate_result(record, result):
+    if isinstance(result, list) and "results" not in record.attributes:
+        record.set(results=len(result))
+
+
+def traced(name):
+    """
+    Decorate a function so every call runs in a span.
+
+    Generator functions are timed until the generator is exhausted or closed, and so are calls of other functions
+    returning a generator, in a second ``<name>.iterate`` span. Coroutine functions and async generator functions
+    are supported too. The length of a list result is recorded as the ``results`` attribute.
+
+    :param name: The name of the span.
+    :type name: str
+
+    :return: The decorator.
+    :rtype: callable
+    """
+
+    def decorator(function):
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def async_generator_wrapper(*args, **kwargs):
+                with span(name, current=False):
+                    async for item in function(*args, **kwargs):
+                        yield item
+            return async_generator_wrapper
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def coroutine_wrapper(*args, **kwargs):
+                with span(name) as record:
+                    result = await function(*args, **kwargs)
+                    _annotate_result(record, result)
+                    return result
+            return coroutine_wrapper
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                return _traced_generator(name, function(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name) as record:
+                result = function(*args, **kwargs)
+                _annotate_result(record, result)
+            if inspect.isgenerator(result):
+                return _traced_generator(name + ".iterate", result)
+            return result
+        return wrapper
+
+    return decorator
+
+
+def _traced_generator(name, generator):
+    with span(name, current=False) as record:
+        count = 0
+        for item in generator:
+            count += 1
+            yield item
+        record.set(results=count)
+
+
+def instrument(prefix):
+    """
+    Decorate a class so that every public method it defines is :func:`traced` as ``<prefix>.<method>``.
+
+    Static methods, class methods and properties are left alone.
+
+    :param prefix: The prefix of the span names.
+    :type prefix: str
+
+    :return: The class decorator.
+    :rtype: callable
+    """
+
+    def decorator(cls):
+        for attribute, value in list(vars(cls).items()):
+            if not attribute.startswith("_") and inspect.isfunction(value):
+                setattr(cls, attribute, traced(f"{prefix}.{attribute}")(value))
+        return cls
+
+    return decorator
+
+
+@contextlib.contextmanager
+def record_turn():
+    """
+    Collect the spans finished inside the block, including those in threads and tasks started from it with a copy
+    of its context.
+
+    :return: A context manager yielding the :class:`Turn`.
+    :rtype: contextlib.AbstractContextManager
+    """
+    turn = Turn()
+    token = _current_turn.set(turn)
+    try:
+        yield turn
+    finally:
+        try:
+            _current_turn.reset(token)
+        except ValueError:
+            # A generator closed from another context; its own context is discarded with it
+            pass
+
+
+def metrics_text():
+    """
+    Render the process-wide metrics in the Prometheus text exposition format.
+
+    :return: The metrics text.
+    :rtype: str
+    """
+    return registry.render()
+
+
+_readiness_check = None
+
+
+def set_readiness_check(check):
+    """
+    Set the function answering readiness probes at ``/ready`` on the metrics server.
+
+    Until one is set, the process is reported ready.
+
+    :param check: A function returning a JSON-serializable dict whose ``ready`` entry says whether the process can
+                  serve traffic; ``/ready`` answers 200 if it does and 503 otherwise, with the dict as the body.
+    :type check: callable
+    """
+    global _readiness_check
+    _readiness_check = check
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/ready":
+            status = _readiness_check() if _readiness_check is not None else {"ready": True}
+            self._send(200 if status["ready"] else 503, json.dumps(status).encode("utf-8"), "application/json")
+        elif path == "/metrics":
+            self._send(200, metrics_text().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self.send_error(404)
+
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_started = False
+_server_lock = threading.Lock()
+_logger = logging.getLogger(__name__)
+
+
+def start_metrics_server(port=Config.METRICS_PORT, host=Config.METRICS_HOST):
+    """
+    Serve the metrics at ``/metrics`` and the readiness check at ``/ready`` from a background thread, once per
+    process.
+
+    If the server cannot listen, e.g. because the port is taken, the error is logged and the process runs without
+    it; later calls do not try again.
+
+    :param port: The port to listen on.
+    :type port: int
+    :param host: The address to listen on; an empty string listens on every interface.
+    :type host: str
+
+    :return: The running server, or None if it could not be started.
+    :rtype: http.server.ThreadingHTTPServer
+    """
+    global _server, _server_started
+    with _server_lock:
+        if not _server_started:
+            _server_started = True
+            try:
+                _server = http.server.ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as error:
+                _logger.error("Could not serve metrics on %s:%s: %s", host, port, error)
+            else:
+                threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server
@@ -1,13 +1,332 @@
-from transformers import AutoTokenizer, AutoModel
-import torch
+import os
+import threading
+
+import numpy as np
+
+import Config
+import Telemetry
+from EmbeddingCache import EmbeddingCache
 
 
 class Vectorizer:
-    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2"):
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModel.from_pretrained(model_name)
+    """
+    Embeds text with a sentence-transformers model.
+
+    The tokenizer and model are loaded lazily on first use and shared by every Vectorizer in the process,
+    so constructing a Vectorizer is cheap. Embeddings are cached by model name and normalized text, so text that
+    was embedded before skips the model entirely.
+
+    The model runs on one of several CPU inference backends, chosen by VECTORIZER_BACKEND:
+
+    * ``torch``: the full-precision PyTorch model, which the other backends are measured against.
+    * ``torch-int8``: the PyTorch model with its linear layers dynamically quantized to int8.
+    * ``onnx``: the model exported to ONNX and run by ONNX Runtime.
+    * ``onnx-int8``: the ONNX export with its weights dynamically quantized to int8.
+
+    ONNX exports are written to ONNX_MODEL_DIR the first time they are needed, which takes torch; later processes
+    load them with ONNX Runtime alone. Each backend's embeddings stay within its :attr:`MIN_COSINE` of the
+    ``torch`` ones, as :meth:`agreement` measures, and are cached apart from those of the other backends.
+    """
+
+    BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+    # Lowest cosine similarity to the ``torch`` embedding of the same text tolerated for each backend
+    MIN_COSINE = {"torch": 1.0, "torch-int8": 0.97, "onnx": 0.9999, "onnx-int8": 0.97}
+
+    _models = {}
+    _lock = threading.Lock()
+    _default_cache = None
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", batch_size=32, max_length=512,
+                 cache=None, backend=None, threads=None):
+        """
+        Initialize a Vectorizer object.
+
+        :param model_name: The Hugging Face name of the model to embed with.
+        :type model_name: str
+        :param batch_size: The number of texts encoded per forward pass.
+        :type batch_size: int
+        :param max_length: The maximum number of tokens per text.
+        :type max_length: int
+        :param cache: The embedding cache to use, or None for the cache shared by the process.
+        :type cache: EmbeddingCache
+        :param backend: The inference backend, one of :attr:`BACKENDS`, or None for the VECTORIZER_BACKEND setting.
+        :type backend: str
+        :param threads: The number of threads inference runs on, 0 for the library default, or None for the
+                        VECTORIZER_THREADS setting. It takes effect when the model is first loaded.
+        :type threads: int
+        """
+        backend = backend or Config.VECTORIZER_BACKEND
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown vectorizer backend {backend!r}, expected one of {', '.join(self.BACKENDS)}")
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.cache = cache or self.default_cache()
+        self.backend = backend
+        self.threads = Config.VECTORIZER_THREADS if threads is None else threads
+
+    def __getstate__(self):
+        # The cache holds a database connection; an unpickled copy, e.g. in a worker process, uses its own default
+        state = self.__dict__.copy()
+        state["cache"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cache = self.default_cache()
+
+    @classmethod
+    def default_cache(cls):
+        """
+        Return the embedding cache shared by the process, creating it from the settings on first use.
+
+        :return: The shared embedding cache.
+        :rtype: EmbeddingCache
+        """
+        if cls._default_cache is None:
+            with cls._lock:
+                if cls._default_cache is None:
+                    cls._default_cache = EmbeddingCache(path=Config.EMBEDDING_CACHE_PATH or None,
+                                                        max_size=Config.EMBEDDING_CACHE_SIZE)
+        return cls._default_cache
+
+    @property
+    def cache_namespace(self):
+        """
+        The name embeddings are cached under: the model name, suffixed with the backend unless it is ``torch``.
+        """
+        if self.backend == "torch":
+            return self.model_name
+        return f"{self.model_name}#{self.backend}"
+
+    def _load(self):
+        """
+        Return the shared tokenizer and model for this model name and backend, loading them on first use.
+
+        :return: The tokenizer, and the PyTorch model or ONNX Runtime session.
+        :rtype: tuple
+        """
+        key = (self.model_name, self.backend)
+        loaded = self._models.get(key)
+        if loaded is None:
+            with self._lock:
+                loaded = self._models.get(key)
+                if loaded is None:
+                    with Telemetry.span("vectorizer.load", backend=self.backend):
+                        from transformers import AutoTokenizer
+
+                        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                        if self.backend.startswith("onnx"):
+                            model = self._load_onnx(tokenizer)
+                        else:
+                            model = self._load_torch()
+                    loaded = (tokenizer, model)
+                    self._models[key] = loaded
+        return loaded
+
+    def _load_torch(self):
+        import torch
+        from transformers import AutoModel
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        model = AutoModel.from_pretrained(self.model_name)
+        model.eval()
+        if self.backend == "torch-int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def _load_onnx(self, tokenizer):
+        import onnxruntime
+
+        path = self.onnx_path(self.backend)
+        if not os.path.exists(path):
+            self._export_onnx(tokenizer)
+        options = onnxruntime.SessionOptions()
+        if self.threads:
+            options.intra_op_num_threads = self.threads
+        return onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def onnx_path(self, backend):
+        """
+        Return the path of the model's ONNX export for an ONNX backend.
+
+        :param backend: ``onnx`` or ``onnx-int8``.
+        :type backend: str
+
+        :return: The path of the export in ONNX_MODEL_DIR.
+        :rtype: str
+        """
+        suffix = "-int8" if backend == "onnx-int8" else ""
+        return os.path.join(Config.ONNX_MODEL_DIR, self.model_name.replace("/", "--") + suffix + ".onnx")
+
+    def _export_onnx(self, tokenizer):
+        """
+        Export the model to ONNX, and quantize the export for the ``onnx-int8`` backend.
+
+        Each file is written under a temporary name and then renamed, so that a process never loads a partial export.
+        """
+        import torch
+        from transformers import AutoModel
+
+        os.makedirs(Config.ONNX_MODEL_DIR, exist_ok=True)
+        path = self.onnx_path("onnx")
+        if not os.path.exists(path):
+            model = AutoModel.from_pretrained(self.model_name)
+            model.eval()
+            inputs = tokenizer(["An example sentence."], return_tensors="pt")
+            names = list(inputs.keys())
+            axes = {name: {0: "batch", 1: "tokens"} for name in names + ["last_hidden_state"]}
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with torch.inference_mode():
+                torch.onnx.export(model, (dict(inputs),), temporary, input_names=names,
+                                  output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=14)
+            os.replace(temporary, path)
+
+        if self.backend == "onnx-int8":
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantized = self.onnx_path("onnx-int8")
+            temporary = f"{quantized}.{os.getpid()}.tmp"
+            quantize_dynamic(path, temporary, weight_type=QuantType.QInt8)
+            os.replace(temporary, quantized)
+
+    @property
+    def tokenizer(self):
+        return self._load()[0]
+
+    @property
+    def model(self):
+        return self._load()[1]
+
+    @property
+    def dimension(self):
+        """
+        The dimension of the embeddings.
+        """
+        model = self.model
+        if self.backend.startswith("onnx"):
+            return model.get_outputs()[0].shape[-1]
+        return model.config.hidden_size
+
+    def warm_up(self):
+        """
+        Load the model and run it once on short and long inputs, bypassing the cache.
+
+        The first inference pays one-time costs such as graph optimization, kernel selection and growing the
+        memory pools; warming up moves them out of the first request.
+        """
+        with Telemetry.span("vectorizer.warm_up", backend=self.backend):
+            self._encode(["warm up", " ".join(["warm up"] * 64)])
 
     def vectorize(self, text):
-        inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
-        outputs = self.model(**inputs)
-        return torch.mean(outputs.last_hidden_state, dim=1).detach().numpy()[0]
+        """
+        Embed a single text.
+
+        :param text: The text to embed.
+        :type text: str
+
+        :return: The embedding of the text.
+        :rtype: numpy.ndarray
+        """
+        return self.vectorize_batch([text])[0]
+
+    @Telemetry.traced("vectorizer.vectorize_batch")
+    def vectorize_batch(self, texts):
+        """
+        Embed many texts, encoding only those missing from the cache.
+
+        :param texts: The texts to embed.
+        :type texts: list
+
+        :return: A ``(len(texts), dimension)`` float32 array of embeddings, in input order.
+        :rtype: numpy.ndarray
+        """
+        texts = [EmbeddingCache.normalize(text) for text in texts]
+        keys = [EmbeddingCache.key(self.cache_namespace, text) for text in texts]
+        vectors = self.cache.get_many(list(dict.fromkeys(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+        Telemetry.annotate(texts=len(texts), cache_hits=len(vectors), encoded=len(missing))
+        if missing:
+            encoded = dict(zip(missing, self._encode(list(missing.values()))))
+            self.cache.put_many(encoded)
+            vectors.update(encoded)
+
+        if not keys:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
+    def _encode(self, texts):
+        """
+        Run the model over texts, padding each chunk of ``batch_size`` texts into a single forward pass.
+
+        :param texts: The texts to encode.
+        :type texts: list
+
+        :return: A ``(len(texts), dimension)`` float32 array of embeddings, in input order.
+        :rtype: numpy.ndarray
+        """
+        tokenizer, model = self._load()
+        run = self._run_onnx if self.backend.startswith("onnx") else self._run_torch
+        chunks = []
+        with Telemetry.span("vectorizer.encode", texts=len(texts), backend=self.backend):
+            for start in range(0, len(texts), self.batch_size):
+                chunks.append(run(tokenizer, model, texts[start:start + self.batch_size]))
+        return np.concatenate(chunks).astype(np.float32, copy=False)
+
+    def _run_torch(self, tokenizer, model, texts):
+        import torch
+
+        inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True, max_length=self.max_length)
+        with torch.inference_mode():
+            outputs = model(**inputs)
+        return self._mean_pool(outputs.last_hidden_state.numpy(), inputs["attention_mask"].numpy())
+
+    def _run_onnx(self, tokenizer, session, texts):
+        inputs = tokenizer(texts, return_tensors="np", padding=True, truncation=True, max_length=self.max_length)
+        feed = {node.name: inputs[node.name].astype(np.int64, copy=False) for node in session.get_inputs()}
+        last_hidden_state, = session.run(["last_hidden_state"], feed)
+        return self._mean_pool(last_hidden_state, inputs["attention_mask"])
+
+    @staticmethod
+    def _mean_pool(last_hidden_state, attention_mask):
+        """
+        Average token embeddings, ignoring padding positions.
+
+        :param last_hidden_state: Token embeddings of shape ``(batch, tokens, dimension)``.
+        :type last_hidden_state: numpy.ndarray
+        :param attention_mask: Mask of shape ``(batch, tokens)`` with 1 for real tokens.
+        :type attention_mask: numpy.ndarray
+
+        :return: Sentence embeddings of shape ``(batch, dimension)``.
+        :rtype: numpy.ndarray
+        """
+        mask = attention_mask[..., np.newaxis].astype(last_hidden_state.dtype)
+        summed = (last_hidden_state * mask).sum(axis=1)
+        counts = np.maximum(mask.sum(axis=1), 1e-9)
+        return summed / counts
+
+    def agreement(self, texts, reference="torch"):
+        """
+        Measure how closely this backend reproduces the embeddings of another, bypassing the cache.
+
+        :param texts: The texts to compare on, e.g. a sample of the catalog.
+        :type texts: list
+        :param reference: The backend to compare with.
+        :type reference: str
+
+        :return: The lowest cosine similarity between the two embeddings of a text.
+        :rtype: float
+        """
+        other = Vectorizer(model_name=self.model_name, batch_size=self.batch_size, max_length=self.max_length,
+                           cache=self.cache, backend=reference, threads=self.threads)
+        texts = [EmbeddingCache.normalize(text) for text in texts]
+        ours = self._encode(texts)
+        theirs = other._encode(texts)
+        norms = np.linalg.norm(ours, axis=1) * np.linalg.norm(theirs, axis=1)
+        return float(((ours * theirs).sum(axis=1) / np.maximum(norms, 1e-12)).min())
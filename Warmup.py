@@ -0,0 +1,141 @@
+"""
+Background warm-up of BookWise Bot's slow-starting dependencies, and the readiness check built on it.
+
+Importing the bot's modules is cheap: the OpenAI and Elasticsearch clients, torch and transformers are imported
+on first use. :func:`start` pays those costs on a daemon thread as soon as the process starts, instead of on the
+first request. It runs these steps:
+
+* ``clients``: import the OpenAI and Elasticsearch client libraries.
+* ``model``: load the embedding model and run a warm-up inference, see :meth:`Vectorizer.warm_up`.
+* ``tokenizer``: load the tokenizer that counts prompt tokens.
+* ``elasticsearch``: connect to Elasticsearch and create the indices, so that later managers skip it.
+
+A step that fails, e.g. while Elasticsearch is still starting, is retried every WARMUP_RETRY_INTERVAL seconds.
+Requests arriving before the warm-up ends are still served; they wait for whatever they need that is still
+loading.
+
+:func:`ready` and :func:`status` report progress. Once started, the metrics server answers ``/ready`` with the
+status, so that new replicas only receive traffic once they are warm. The app starts that server on METRICS_PORT,
+or on WARMUP_READY_PORT if METRICS_PORT is 0; both are 0 by default, leaving it off.
+"""
+
+import threading
+import time
+
+import Config
+import Telemetry
+from Chatbot import default_llm
+from ConversationMemory import ConversationMemory
+from ElasticsearchManager import ElasticsearchManager
+from Vectorizer import Vectorizer
+
+
+def _import_clients():
+    import elasticsearch  # noqa: F401
+
+    default_llm()
+
+
+def _load_model():
+    Vectorizer().warm_up()
+
+
+def _load_tokenizer():
+    ConversationMemory().count_text("warm up")
+
+
+def _connect_elasticsearch():
+    ElasticsearchManager()
+
+
+STEPS = (
+    ("clients", _import_clients),
+    ("model", _load_model),
+    ("tokenizer", _load_tokenizer),
+    ("elasticsearch", _connect_elasticsearch),
+)
+
+_ready = threading.Event()
+_steps = {}
+_started_at = None
+_thread = None
+_lock = threading.Lock()
+
+
+def _run(steps):
+    pending = list(steps)
+    while pending:
+        failed = []
+        for name, step in pending:
+            started = time.perf_counter()
+            try:
+                with Telemetry.span(f"warmup.{name}"):
+                    step()
+            except Exception as error:
+                _steps[name] = {"done": False, "error": f"{type(error).__name__}: {error}"}
+                failed.append((name, step))
+            else:
+                _steps[name] = {"done": True, "seconds": round(time.perf_counter() - started, 3)}
+        pending = failed
+        if pending:
+            time.sleep(Config.WARMUP_RETRY_INTERVAL)
+    _ready.set()
+
+
+def start(steps=STEPS):
+    """
+    Start warming up on a daemon thread, once per process, and answer readiness probes from its progress.
+
+    :param steps: ``(name, function)`` pairs run in order.
+    :type steps: tuple
+
+    :return: The warm-up thread.
+    :rtype: threading.Thread
+    """
+    global _thread, _started_at
+    with _lock:
+        if _thread is None:
+            _started_at = time.time()
+            _steps.update({name: {"done": False} for name, step in steps})
+            _thread = threading.Thread(target=_run, args=(steps,), name="warm-up", daemon=True)
+            _thread.start()
+            Telemetry.set_readiness_check(status)
+    return _thread
+
+
+def ready():
+    """
+    Tell whether every warm-up step has finished.
+
+    :return: True once the process is warm.
+    :rtype: bool
+    """
+    return _ready.is_set()
+
+
+def wait(timeout=None):
+    """
+    Block until the warm-up finishes.
+
+    :param timeout: The maximum number of seconds to wait, or None to wait for as long as it takes.
+    :type timeout: float
+
+    :return: Whether the process is warm.
+    :rtype: bool
+    """
+    return _ready.wait(timeout)
+
+
+def status():
+    """
+    Describe the progress of the warm-up.
+
+    :return: Whether the process is ready, the seconds since the warm-up started, and per step whether it is done,
+             how long it took or the last error it raised.
+    :rtype: dict
+    """
+    return {
+        "ready": ready(),
+        "uptime": round(time.time() - _started_at, 3) if _started_at is not None else None,
+        "steps": {name: dict(step) for name, step in list(_steps.items())},
+    }
@@ -1,14 +1,54 @@
+import os
+import uuid
+
 import streamlit as st
-from BookManager import BookManager
+
+import Config
+import Telemetry
+import Warmup
+from AsyncChatbot import SyncChatbot
 from Chatbot import Chatbot
 
 
+@st.cache_resource
+def get_chatbot():
+    """
+    Create the chatbot shared by every session and rerun of the app.
+
+    :return: The shared chatbot.
+    :rtype: Chatbot or SyncChatbot
+    """
+    if Config.ASYNC_CHATBOT:
+        return SyncChatbot()
+    return Chatbot()
+
+
+@st.cache_resource
+def load_system_prompt(path='prompt.txt', modified=None):
+    """
+    Read the system prompt once per process and version of the file.
+
+    :param path: The path of the prompt file.
+    :type path: str
+    :param modified: The modification time of the file, so that editing it is picked up by new sessions.
+    :type modified: float
+
+    :return: The system prompt.
+    :rtype: str
+    """
+    with open(path, 'r') as file:
+        return file.read()
+
+
 def initialize_session_state():
     """
     Initialize session state variables if they don't exist.
     """
     if 'messages' not in st.session_state:
-        st.session_state.messages = []
+        system_prompt = load_system_prompt('prompt.txt', os.path.getmtime('prompt.txt'))
+        st.session_state.messages = [{"role": "system", "content": system_prompt}]
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
     if 'books' not in st.session_state:
         st.session_state.books = []
 
@@ -17,38 +57,74 @@ def app():
     """
     Main application function.
     """
+    if Config.WARMUP_ENABLED:
+        Warmup.start()
     initialize_session_state()
+    metrics_port = Config.METRICS_PORT or (Config.WARMUP_READY_PORT if Config.WARMUP_ENABLED else 0)
+    if metrics_port:
+        Telemetry.start_metrics_server(metrics_port)
     st.title("Welcome to BookWise Bot")
     placeholder = st.empty()
 
     placeholder.empty()
     st.sidebar.header("Shopping Cart")
+    if Config.WARMUP_ENABLED and not Warmup.ready():
+        st.sidebar.caption("Warming up; the first answer may take a little longer.")
 
     question = st.text_area("Ask me anything:")
 
-    chatbot = Chatbot()
-
-    with open('prompt.txt', 'r') as file:
-        # Read the contents of the file
-        system_message = file.read()
-
-    st.session_state.messages.append({"role": "system", "content": system_message})
-
-    book_manager = BookManager()
-
-    st.session_state.books_dict = book_manager.get_books()
-
-    # books = format_books_dict_to_string(st.session_state.books_dict)
-    # st.session_state.messages.append({"role": "system", "content": books})
-
     if st.button("Send"):
-        st.session_state.messages, response, carts = chatbot.handle_query(st.session_state.messages, question)
+        # Built on the first question rather than the first render, which would wait for the warm-up
+        chatbot = get_chatbot()
+        # Filled in by this session's turn; the chatbot itself is shared by every session
+        report = {}
+        if Config.STREAM_RESPONSES:
+            response_placeholder = st.empty()
+            response = ""
+            for chunk in chatbot.handle_query_stream(st.session_state.messages, question,
+                                                     st.session_state.session_id, report=report):
+                response += chunk
+                response_placeholder.write(response)
+            carts = chatbot.get_cart(st.session_state.session_id)
+        else:
+            st.session_state.messages, response, carts = chatbot.handle_query(st.session_state.messages, question,
+                                                                              st.session_state.session_id,
+                                                                              report=report)
+            st.write(response)
 
-        st.write(response)
         titles = [item['title'] for item in carts]
         for title in titles:
             st.sidebar.warning(title)
 
+        prompt = report.get("prompt")
+        if prompt:
+            st.sidebar.caption(f"Prompt: {prompt['prompt_tokens']} tokens in {prompt['messages']} messages")
+        if chatbot.response_cache is not None:
+            stats = chatbot.response_cache.stats()
+            st.sidebar.caption(f"Response cache: {stats['hit_rate']:.0%} hits, "
+                               f"{stats['latency_saved']:.1f}s of LLM time saved")
+        if Config.DEBUG_SIDEBAR and report.get("turn"):
+            show_turn_timings(report["turn"])
+
+
+def show_turn_timings(turn):
+    """
+    Show the time spent in each span of the latest turn in the sidebar.
+
+    :param turn: The spans of the turn, as described by Telemetry.Turn.breakdown.
+    :type turn: list
+    """
+    rows = []
+    for entry in turn:
+        details = {key: value for key, value in entry.items() if key not in ("span", "depth", "ms")}
+        rows.append({
+            "span": "· " * entry["depth"] + entry["span"],
+            "ms": entry["ms"],
+            "details": ", ".join(f"{key}={value}" for key, value in details.items()),
+        })
+    with st.sidebar.expander("Turn timings", expanded=True):
+        st.table(rows)
+
 
 def format_books_dict_to_string(books):
     """
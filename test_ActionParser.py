@@ -0,0 +1,60 @@
+import unittest
+
+from ActionParser import ActionParser
+
+TAG = "[ACTION: Add_to_Cart; BOOK_TITLE: Dune; AUTHOR: Frank Herbert; GENRE: Science Fiction]"
+ACTION = ("Add_to_Cart", "Dune", "Frank Herbert", "Science Fiction")
+
+
+def stream(chunks):
+    """Feed chunks to a new parser and collect the displayed text and the actions."""
+    parser = ActionParser()
+    text = []
+    actions = []
+    for chunk in chunks:
+        shown, found = parser.feed(chunk)
+        text.append(shown)
+        actions.extend(found)
+    text.append(parser.close())
+    return "".join(text), actions
+
+
+class ActionParserTest(unittest.TestCase):
+    """Tests of how action tags are stripped from a response streamed in chunks."""
+
+    def test_whole_tag_is_stripped(self):
+        self.assertEqual(stream([f"I've added Dune. {TAG}"]), ("I've added Dune. ", [ACTION]))
+
+    def test_tag_split_across_chunks(self):
+        response = f"Done! {TAG} Enjoy."
+        for size in (1, 3, 7, len(TAG)):
+            with self.subTest(size=size):
+                chunks = [response[start:start + size] for start in range(0, len(response), size)]
+                self.assertEqual(stream(chunks), ("Done!  Enjoy.", [ACTION]))
+
+    def test_possible_tag_is_held_back_until_it_closes(self):
+        parser = ActionParser()
+        self.assertEqual(parser.feed("Sure [ACT"), ("Sure ", []))
+        self.assertEqual(parser.feed("ION: Clear_Cart; BOOK_TITLE: None; "), ("", []))
+        self.assertEqual(parser.feed("AUTHOR: None; GENRE: None] done"),
+                         (" done", [("Clear_Cart", "None", "None", "None")]))
+
+    def test_unterminated_tag_is_released_on_close(self):
+        self.assertEqual(stream(["Here you go ", "[ACTION: Search; BOOK_TITLE: Du"]),
+                         ("Here you go [ACTION: Search; BOOK_TITLE: Du", []))
+
+    def test_brackets_that_are_not_tags_are_shown(self):
+        self.assertEqual(stream(["Dune [1965] is ", "a classic [", "see notes]."]),
+                         ("Dune [1965] is a classic [see notes].", []))
+
+    def test_malformed_tag_is_shown(self):
+        self.assertEqual(stream(["[ACTION: Search]", " ok"]), ("[ACTION: Search] ok", []))
+
+    def test_several_tags_in_one_response(self):
+        clear = "[ACTION: Clear_Cart; BOOK_TITLE: None; AUTHOR: None; GENRE: None]"
+        self.assertEqual(stream([f"{clear}{TAG[:20]}", f"{TAG[20:]}!"]),
+                         ("!", [("Clear_Cart", "None", "None", "None"), ACTION]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+
+from ConversationMemory import ConversationMemory
+
+SYSTEM_PROMPT = {"role": "system", "content": "You are BookWise Bot, a bookstore assistant."}
+
+
+class WordCountMemory(ConversationMemory):
+    """Counts a token per word, so budgets in the tests do not depend on the tokenizer."""
+
+    TOKENS_PER_MESSAGE = 0
+    TOKENS_PER_REPLY = 0
+
+    def count_text(self, text):
+        return len(text.split())
+
+
+class FakeSummarizer:
+    """Records the summarization requests and answers with a numbered summary."""
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        return f"summary {len(self.requests)}"
+
+
+def conversation(turns):
+    messages = [dict(SYSTEM_PROMPT)]
+    for number in range(turns):
+        messages.append({"role": "user", "content": f"question {number} about some book"})
+        messages.append({"role": "assistant", "content": f"answer {number} about some book"})
+    return messages
+
+
+class ConversationMemoryTest(unittest.TestCase):
+    """Tests of how a conversation is compacted into the token budget."""
+
+    def setUp(self):
+        self.summarize = FakeSummarizer()
+
+    def test_conversation_within_budget_is_unchanged(self):
+        memory = WordCountMemory(budget=100, min_recent=2, summary_max_tokens=5)
+        messages = conversation(3)
+        expected = [dict(message) for message in messages]
+
+        report = memory.fit(messages, self.summarize)
+
+        self.assertEqual(messages, expected)
+        self.assertEqual(report, {"prompt_tokens": 7 + 6 * 5, "messages": 7, "summarized": 0})
+        self.assertEqual(self.summarize.requests, [])
+
+    def test_old_turns_are_summarized_behind_the_pinned_prompt(self):
+        memory = WordCountMemory(budget=35, min_recent=2, summary_max_tokens=5)
+        messages = conversation(4)
+        recent = messages[-4:]
+
+        report = memory.fit(messages, self.summarize)
+
+        self.assertEqual(messages[0], SYSTEM_PROMPT)
+        self.assertEqual(messages[1], {"role": "system", "content": ConversationMemory.SUMMARY_PREFIX + "summary 1"})
+        self.assertEqual(messages[2:], recent)
+        self.assertEqual(report["summarized"], 4)
+        self.assertLessEqual(report["prompt_tokens"], 35)
+        transcript = self.summarize.requests[0][1]["content"]
+        self.assertIn("(none)", transcript)
+        self.assertIn("user: question 0 about some book", transcript)
+        self.assertIn("assistant: answer 1 about some book", transcript)
+        self.assertNotIn("question 2", transcript)
+
+    def test_summary_rolls_forward(self):
+        memory = WordCountMemory(budget=35, min_recent=2, summary_max_tokens=5)
+        messages = conversation(4)
+        memory.fit(messages, self.summarize)
+        messages.append({"role": "user", "content": "question 4 about some book"})
+        messages.append({"role": "assistant", "content": "answer 4 about some book"})
+
+        memory.fit(messages, self.summarize)
+
+        self.assertIn("Current summary:\nsummary 1", self.summarize.requests[1][1]["content"])
+        self.assertEqual(messages[1]["content"], ConversationMemory.SUMMARY_PREFIX + "summary 2")
+        self.assertEqual([message["role"] for message in messages].count("system"), 2)
+
+    def test_latest_messages_are_kept_over_budget(self):
+        memory = WordCountMemory(budget=10, min_recent=4, summary_max_tokens=5)
+        messages = conversation(3)
+        recent = messages[-4:]
+
+        report = memory.fit(messages, self.summarize)
+
+        self.assertEqual(messages[2:], recent)
+        self.assertEqual(report["summarized"], 2)
+        self.assertGreater(report["prompt_tokens"], 10)
+
+    def test_old_turns_are_dropped_without_a_summarizer(self):
+        memory = WordCountMemory(budget=35, min_recent=2, summary_max_tokens=5)
+        messages = conversation(4)
+
+        memory.fit(messages)
+
+        self.assertEqual(messages[0], SYSTEM_PROMPT)
+        self.assertEqual(len(messages), 1 + 4)
+
+    def test_duplicate_prompts_are_dropped(self):
+        memory = WordCountMemory(budget=100, min_recent=2, summary_max_tokens=5)
+        messages = conversation(1) + [dict(SYSTEM_PROMPT)]
+
+        memory.fit(messages, self.summarize)
+
+        self.assertEqual(messages, conversation(1))
+
+    def test_async_summarizer(self):
+        memory = WordCountMemory(budget=35, min_recent=2, summary_max_tokens=5)
+        messages = conversation(4)
+
+        async def summarize(request):
+            return self.summarize(request)
+
+        report = asyncio.run(memory.afit(messages, summarize))
+
+        self.assertEqual(messages[1]["content"], ConversationMemory.SUMMARY_PREFIX + "summary 1")
+        self.assertEqual(report["summarized"], 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
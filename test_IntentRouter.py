@@ -0,0 +1,48 @@
+import re
+import unittest
+
+from FakeVectorizer import FakeVectorizer
+from IntentRouter import IntentRouter
+
+CATALOG = {
+    "title": ["It", "Dune", "The Hobbit", "It Ends with Us", "Clean Code"],
+    "author": ["Stephen King", "Frank Herbert", "J.R.R. Tolkien", "Colleen Hoover", "Robert C. Martin"],
+    "genre": ["Horror", "Science Fiction", "Fantasy", "Romance", "Computer Science"],
+}
+
+
+def find_values(field, text, size):
+    words = set(re.findall(r"\w+", text.lower()))
+    return [value for value in CATALOG[field] if words & set(re.findall(r"\w+", value.lower()))][:size]
+
+
+class IntentRouterTest(unittest.TestCase):
+    """Tests of which queries the router answers locally and which it leaves to the LLM."""
+
+    def setUp(self):
+        self.router = IntentRouter(find_values, vectorizer=FakeVectorizer(), threshold=0.85)
+
+    def test_named_book_is_routed(self):
+        self.assertEqual(self.router.route("add dune to my cart")[:2], ("Add_to_Cart", "Dune"))
+        self.assertEqual(self.router.route("please remove the hobbit from the cart")[:2],
+                         ("Remove_from_Cart", "The Hobbit"))
+        self.assertEqual(self.router.route("show me books by tolkien")[2], "J.R.R. Tolkien")
+        self.assertEqual(self.router.route("Clear my cart!")[0], "Clear_Cart")
+
+    def test_references_to_earlier_turns_go_to_the_llm(self):
+        for query in ["add it to my cart", "Add it to the cart please", "put that in my basket",
+                      "add this one to my cart", "add the first one to my cart", "add both of them to my cart",
+                      "remove it from my cart", "take that book out of the cart", "do you have it?",
+                      "do you have that one"]:
+            with self.subTest(query=query):
+                self.assertIsNone(self.router.route(query))
+
+    def test_short_slots_go_to_the_llm(self):
+        self.assertIsNone(self.router.route("add xy to my cart"))
+
+    def test_unknown_book_goes_to_the_llm(self):
+        self.assertIsNone(self.router.route("add war and peace to my cart"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from LocalVectorIndex import LocalVectorIndex
+
+DIMENSION = 8
+
+
+class LocalVectorIndexTest(unittest.TestCase):
+    """Tests of the memory-mapped index across additions, removals and reopening from disk."""
+
+    def setUp(self):
+        self.vectors = np.random.default_rng(11).standard_normal((30, DIMENSION)).astype(np.float32)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "books")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def open(self):
+        # A small initial capacity makes the additions grow the memory-mapped file
+        return LocalVectorIndex(self.path, dimension=DIMENSION, initial_capacity=4)
+
+    def fill(self, index, rows):
+        index.add_many((f"book-{row}", {"title": f"Book {row}", "vector": list(self.vectors[row])},
+                        self.vectors[row]) for row in rows)
+
+    def assert_matches_brute_force(self, index, live):
+        ids = sorted(live)
+        matrix = np.stack([self.vectors[int(doc_id.split("-")[1])] for doc_id in ids])
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        results = index.search_batch(self.vectors, k=len(self.vectors))
+        for query, hits in zip(self.vectors, results):
+            self.assertEqual({hit["_id"] for hit in hits}, live)
+            expected = (1.0 + matrix @ (query / np.linalg.norm(query))) / 2.0
+            self.assertEqual([hit["_id"] for hit in hits], [ids[row] for row in np.argsort(-expected)])
+            np.testing.assert_allclose([hit["_score"] for hit in hits], np.sort(expected)[::-1], rtol=1e-5)
+            self.assertNotIn("vector", hits[0]["_source"])
+
+    def test_removed_ids_are_never_returned_after_reopening(self):
+        index = self.open()
+        self.fill(index, range(20))
+        removed = {f"book-{row}" for row in (0, 5, 6, 19)}
+        index.remove_many(removed | {"not-indexed"})
+        self.fill(index, range(20, 30))
+        live = {f"book-{row}" for row in range(30)} - removed
+        self.assertEqual(len(index), len(live))
+        self.assert_matches_brute_force(index, live)
+
+        reopened = self.open()
+        self.assertEqual(len(reopened), len(live))
+        self.assert_matches_brute_force(reopened, live)
+
+    def test_replaced_and_re_added_ids_after_reopening(self):
+        index = self.open()
+        self.fill(index, range(10))
+        index.remove_many(["book-3"])
+        self.vectors[4] = self.vectors[9] + 0.01
+        self.fill(index, [3, 4])
+
+        reopened = self.open()
+        live = {f"book-{row}" for row in range(10)}
+        self.assertEqual(len(reopened), 10)
+        self.assert_matches_brute_force(reopened, live)
+        self.assertEqual(reopened.search(self.vectors[9], k=2)[1]["_id"], "book-4")
+
+    def test_k_is_capped_by_the_live_documents(self):
+        index = self.open()
+        self.fill(index, range(3))
+        index.remove_many(["book-0", "book-1", "book-2"])
+        self.assertEqual(index.search_batch(self.vectors[:2], k=5), [[], []])
+
+
+if __name__ == "__main__":
+    unittest.main()
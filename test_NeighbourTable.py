@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from NeighbourTable import NeighbourTable
+
+K = 5
+
+
+def documents(vectors, first=0):
+    return [(f"book-{row}", {"title": f"Book {row}", "vector": list(vector)}, vector)
+            for row, vector in enumerate(vectors, start=first)]
+
+
+def brute_force(vectors, live, doc_id):
+    """The ids of the K books most similar to ``doc_id`` among the live ones, by a full argsort."""
+    ids = [f"book-{row}" for row in range(len(vectors))]
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ normalized[ids.index(doc_id)]
+    order = [row for row in np.argsort(-scores) if ids[row] in live and ids[row] != doc_id]
+    return [ids[row] for row in order[:K]]
+
+
+class NeighbourTableTest(unittest.TestCase):
+    """Tests of the precomputed neighbours against a brute-force ranking."""
+
+    def setUp(self):
+        self.vectors = np.random.default_rng(7).standard_normal((120, 16)).astype(np.float32)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "neighbours")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assert_matches_brute_force(self, table, live):
+        for doc_id in live:
+            hits = table.lookup(doc_id)
+            expected = brute_force(self.vectors, live, doc_id)
+            self.assertEqual([hit["_id"] for hit in hits][:len(expected)], expected, doc_id)
+            self.assertNotIn("vector", hits[0]["_source"])
+
+    def test_build(self):
+        table = NeighbourTable(self.path, k=K, block_size=16)
+        table.build(documents(self.vectors))
+        self.assert_matches_brute_force(table, {f"book-{row}" for row in range(120)})
+
+    def test_additions_in_batches_past_the_capacity(self):
+        table = NeighbourTable(self.path, k=K, block_size=16)
+        table.add_many(documents(self.vectors[:10]))
+        for start in range(10, 120, 13):
+            table.add_many(documents(self.vectors[start:start + 13], first=start))
+        self.assertEqual(len(table), 120)
+        self.assert_matches_brute_force(table, {f"book-{row}" for row in range(120)})
+
+    def test_removed_books_are_skipped_after_reopening(self):
+        table = NeighbourTable(self.path, k=K, block_size=16)
+        table.add_many(documents(self.vectors[:60]))
+        removed = {f"book-{row}" for row in range(0, 60, 4)}
+        table.remove_many(removed)
+        table.save()
+
+        table = NeighbourTable(self.path, block_size=16)
+        table.add_many(documents(self.vectors[60:], first=60))
+        live = {f"book-{row}" for row in range(120)} - removed
+        for doc_id in live:
+            self.assertFalse(removed & {hit["_id"] for hit in table.lookup(doc_id)}, doc_id)
+        for doc_id in removed:
+            self.assertIsNone(table.lookup(doc_id))
+        # Books added after the removals rank among the live books only
+        for row in range(60, 120):
+            expected = brute_force(self.vectors, live, f"book-{row}")
+            self.assertEqual([hit["_id"] for hit in table.lookup(f"book-{row}")], expected)
+
+    def test_replacing_a_book_moves_it(self):
+        table = NeighbourTable(self.path, k=K, block_size=16)
+        table.build(documents(self.vectors[:50]))
+        self.vectors[3] = self.vectors[40] + 0.01
+        table.add_many(documents(self.vectors[3:4], first=3))
+        self.assertEqual(len(table), 50)
+        self.assertEqual(table.lookup("book-40")[0]["_id"], "book-3")
+
+
+if __name__ == "__main__":
+    unittest.main()
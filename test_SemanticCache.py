@@ -0,0 +1,56 @@
+import unittest
+
+from FakeVectorizer import FakeVectorizer
+from SemanticCache import SemanticCache
+
+SYSTEM_PROMPT = {"role": "system", "content": "You are BookWise Bot, a bookstore assistant."}
+
+
+class SemanticCacheTest(unittest.TestCase):
+    """Tests of which conversations a cached response is reused in."""
+
+    def setUp(self):
+        self.cache = SemanticCache(vectorizer=FakeVectorizer(), threshold=0.92, ttl=60, max_size=10)
+
+    def test_opening_question_is_shared_between_conversations(self):
+        fingerprint = SemanticCache.fingerprint([SYSTEM_PROMPT])
+        self.cache.store("what is your return policy?", fingerprint, "Books can be returned within 30 days.", 1.0)
+
+        response = self.cache.lookup("what is your return policy?", SemanticCache.fingerprint([SYSTEM_PROMPT]))
+        self.assertEqual(response, "Books can be returned within 30 days.")
+
+    def test_follow_up_is_not_shared_between_conversations(self):
+        first = [SYSTEM_PROMPT,
+                 {"role": "user", "content": "do you have dune?"},
+                 {"role": "assistant", "content": "Yes, Dune by Frank Herbert. Shall I add it to your cart?"}]
+        second = [SYSTEM_PROMPT,
+                  {"role": "user", "content": "any books about gardening?"},
+                  {"role": "assistant", "content": "I found two. Would you like the first or the second one?"}]
+        self.cache.store("yes", SemanticCache.fingerprint(first), "Great, enjoy reading Dune!", 1.0)
+
+        self.assertEqual(self.cache.lookup("yes", SemanticCache.fingerprint(first)), "Great, enjoy reading Dune!")
+        self.assertIsNone(self.cache.lookup("yes", SemanticCache.fingerprint(second)))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_similar_query_in_a_crowded_conversation(self):
+        fingerprint = SemanticCache.fingerprint([SYSTEM_PROMPT])
+        for number in range(5):
+            self.cache.store(f"question {number}", fingerprint, f"answer {number}", 1.0)
+
+        self.assertEqual(self.cache.lookup("question  3", fingerprint), "answer 3")
+        self.assertIsNone(self.cache.lookup("question 7", fingerprint))
+
+    def test_least_recently_used_conversations_are_evicted_past_max_size(self):
+        fingerprints = [SemanticCache.fingerprint([SYSTEM_PROMPT, {"role": "user", "content": str(number)}])
+                        for number in range(12)]
+        for number, fingerprint in enumerate(fingerprints):
+            self.cache.store("yes", fingerprint, f"answer {number}", 1.0)
+
+        self.assertEqual(self.cache.stats()["entries"], 10)
+        self.assertIsNone(self.cache.lookup("yes", fingerprints[0]))
+        self.assertEqual(self.cache.lookup("yes", fingerprints[11]), "answer 11")
+
+
+if __name__ == "__main__":
+    unittest.main()